@@ -0,0 +1,60 @@
+"""
+`bench_service.py` 使用的插件, 按配置注册 `bench_services` 个服务
+
+第 i 个服务响应命令 `s{i}`, 按 i 依次使用下面的限制组合, 以覆盖 `Service.throttle` 的各条路径;
+另有响应命令 `c` 的服务, 并发上限为 `CONCURRENCY`, 处理器会等待一段时间并记录同时运行的数量, 供 `--check-concurrency` 使用
+"""
+
+import asyncio
+from typing import List, Dict, Any
+
+from nonebot import get_driver, on_command
+from pydantic import BaseModel, Extra
+
+from novabot import Service
+
+
+class Config(BaseModel, extra=Extra.ignore):
+    bench_services: int = 20
+    bench_cd: int = 1
+    bench_limit: int = 1000
+
+
+config = Config.parse_obj(get_driver().config)
+
+PROFILES: List[Dict[str, Any]] = [
+    {},
+    {"cd": config.bench_cd},
+    {"limit": config.bench_limit},
+    {"cd": config.bench_cd, "limit": config.bench_limit},
+    {"rate_limits": [{"calls": 20, "period": 60, "scope": "group"}], "concurrency": 8},
+]
+
+services: List[Service] = []
+
+for i in range(config.bench_services):
+    matcher = on_command(f"s{i}", block=True)
+
+    @matcher.handle()
+    async def _():
+        pass
+
+    services.append(Service(matcher, f"s{i}", cd_prompt="cd {cd}", limit_prompt="limit {limit}",
+                            rate_prompt="retry {retry}", **PROFILES[i % len(PROFILES)]))
+
+CONCURRENCY = 2
+running = {"now": 0, "peak": 0, "handled": 0}
+
+concurrent = on_command("c", block=True)
+
+
+@concurrent.handle()
+async def _():
+    running["now"] += 1
+    running["peak"] = max(running["peak"], running["now"])
+    running["handled"] += 1
+    await asyncio.sleep(0.05)
+    running["now"] -= 1
+
+
+Service(concurrent, "concurrency", concurrency=CONCURRENCY)
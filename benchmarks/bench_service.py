@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+"""
+Service 规则链的基准测试
+
+注册若干服务 (见 `bench_plugin.py`), 生成群聊 / 私聊的消息事件, 对每个事件依次执行所有匹配器的规则
+(即 `_rule_handler` 生成的规则, 包括原有规则, 开关, 限流器, 管理员判定与 cd / limit), 输出吞吐量与每个事件的延迟分位数.
+数据库默认使用 `mongomock`, 也可以通过 `--mongodb-url` 使用真实的 MongoDB.
+
+    python benchmarks/bench_service.py --events 20000 --services 50 --groups 100 --users 1000
+    python benchmarks/bench_service.py --backend mongo
+    python benchmarks/bench_service.py --handle  # 完整的 handle_event, 包括处理器与发送提示
+    python benchmarks/bench_service.py --check-concurrency  # 确认 `concurrency` 的上限确实生效
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import statistics
+import sys
+import time
+from contextlib import AsyncExitStack
+from pathlib import Path
+from typing import List
+
+ROOT = Path(__file__).resolve().parent
+sys.path[:0] = [str(ROOT.parent), str(ROOT)]
+
+import nonebot  # noqa: E402
+from nonebot.adapters.onebot.v11 import (  # noqa: E402
+    Adapter,
+    Bot,
+    Event,
+    GroupMessageEvent,
+    PrivateMessageEvent,
+    Message)
+from nonebot.rule import TrieRule  # noqa: E402
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--events", type=int, default=10000, help="number of measured events")
+    parser.add_argument("--warmup", type=int, default=1000, help="number of events before measuring")
+    parser.add_argument("--services", type=int, default=20, help="number of registered services")
+    parser.add_argument("--groups", type=int, default=50, help="number of distinct groups")
+    parser.add_argument("--users", type=int, default=500, help="number of distinct users")
+    parser.add_argument("--private", type=float, default=0.1, help="fraction of private messages")
+    parser.add_argument("--admins", type=float, default=0.05, help="fraction of group messages sent by admins")
+    parser.add_argument("--miss", type=float, default=0.3, help="fraction of messages matching no service")
+    parser.add_argument("--cd", type=int, default=1, help="cd of the services with a cooldown")
+    parser.add_argument("--limit", type=int, default=1000, help="daily limit of the services with a limit")
+    parser.add_argument("--backend", choices=["memory", "mongo"], default="memory", help="throttle backend")
+    parser.add_argument("--mongodb-url", default=None, help="use a real MongoDB instead of mongomock")
+    parser.add_argument("--handle", action="store_true", help="run the whole handle_event instead of the rules only")
+    parser.add_argument("--check-concurrency", action="store_true",
+                        help="send concurrent events to a service with a concurrency cap, fail if the cap is not kept")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", action="store_true", help="print the result as json")
+    return parser.parse_args()
+
+
+class BenchBot(Bot):
+    """不连接协议端的 Bot, 所有 API 调用直接返回"""
+
+    async def call_api(self, api: str, **data):
+        if api.startswith("send"):
+            return {"message_id": 0}
+        if api == "get_group_member_info":
+            return {"role": "member"}
+        return {}
+
+
+def group_event(text: str, user_id: int, group_id: int, message_id: int, role: str = "member") -> GroupMessageEvent:
+    return GroupMessageEvent.parse_obj(dict(time=int(time.time()), self_id=1, post_type="message", user_id=user_id,
+                                            message_id=message_id, message=Message(text),
+                                            original_message=Message(text), raw_message=text, font=0, to_me=False,
+                                            message_type="group", sub_type="normal", group_id=group_id,
+                                            sender={"user_id": user_id, "role": role}))
+
+
+def generate_events(args: argparse.Namespace, count: int, rng: random.Random) -> List[Event]:
+    events = []
+    now = int(time.time())
+    for message_id in range(count):
+        text = f"x{rng.randrange(args.services)}" if rng.random() < args.miss else f"s{rng.randrange(args.services)}"
+        user_id = 10000 + rng.randrange(args.users)
+        data = dict(time=now, self_id=1, post_type="message", user_id=user_id, message_id=message_id,
+                    message=Message(text), original_message=Message(text), raw_message=text, font=0, to_me=False)
+        if rng.random() < args.private:
+            events.append(PrivateMessageEvent.parse_obj(dict(data, message_type="private", sub_type="friend",
+                                                             sender={"user_id": user_id})))
+        else:
+            role = "admin" if rng.random() < args.admins else "member"
+            events.append(GroupMessageEvent.parse_obj(dict(data, message_type="group", sub_type="normal",
+                                                           group_id=100000 + rng.randrange(args.groups),
+                                                           sender={"user_id": user_id, "role": role})))
+    return events
+
+
+async def run_rules(bot: Bot, event: Event, matchers) -> None:
+    state = {}
+    TrieRule.get_value(bot, event, state)  # Command prefix, as `handle_event` does
+    async with AsyncExitStack() as stack:  # Concurrency slots are released when the stack closes
+        for matcher in matchers:
+            if await matcher.check_rule(bot, event, state.copy(), stack, {}):
+                break
+
+
+async def check_concurrency(bot: Bot, count: int = 10) -> bool:
+    """同时处理 `count` 个命中 `c` 的事件, 同时运行的处理器应当恰好达到并发上限"""
+    from nonebot.message import handle_event
+    from bench_plugin import CONCURRENCY, running
+
+    await asyncio.gather(*(handle_event(bot, group_event("c", 20000 + i, 200000, i)) for i in range(count)))
+    print(f"concurrency: cap {CONCURRENCY}, peak {running['peak']}, handled {running['handled']} of {count} events")
+    return running["peak"] == CONCURRENCY and running["handled"] == CONCURRENCY
+
+
+def percentile(data: List[float], q: float) -> float:
+    return data[min(len(data) - 1, int(len(data) * q))]
+
+
+async def bench(args: argparse.Namespace):
+    from nonebot.matcher import matchers
+    from nonebot.message import handle_event
+
+    bot = BenchBot(nonebot.get_driver()._adapters[Adapter.get_name()], "1")
+    ordered = [matcher for priority in sorted(matchers) for matcher in matchers[priority]]
+    rng = random.Random(args.seed)
+    warmup, events = generate_events(args, args.warmup, rng), generate_events(args, args.events, rng)
+
+    async def run(event: Event):
+        if args.handle:
+            await handle_event(bot, event)
+        else:
+            await run_rules(bot, event, ordered)
+
+    for event in warmup:
+        await run(event)
+    latencies = []
+    start = time.perf_counter()
+    for event in events:
+        t = time.perf_counter()
+        await run(event)
+        latencies.append(time.perf_counter() - t)
+    total = time.perf_counter() - start
+    latencies.sort()
+    return {
+        "mode": "handle_event" if args.handle else "rules",
+        "backend": args.backend,
+        "services": args.services,
+        "events": args.events,
+        "throughput": args.events / total,
+        "mean_us": statistics.fmean(latencies) * 1e6,
+        "p50_us": percentile(latencies, 0.5) * 1e6,
+        "p90_us": percentile(latencies, 0.9) * 1e6,
+        "p99_us": percentile(latencies, 0.99) * 1e6,
+        "max_us": latencies[-1] * 1e6,
+    }
+
+
+def main():
+    args = parse_args()
+    nonebot.init(driver="~fastapi",
+                 command_start=[""],
+                 log_level="WARNING",
+                 service_throttle_backend=args.backend,
+                 service_flush_interval=3600,  # Keep write-behind flushes out of the measurement
+                 help_image=False,  # No browser needed to prerender the help
+                 bench_services=args.services,
+                 bench_cd=args.cd,
+                 bench_limit=args.limit,
+                 **({"mongodb_url": args.mongodb_url} if args.mongodb_url else {}))
+    driver = nonebot.get_driver()
+    driver.register_adapter(Adapter)
+    nonebot.load_plugin("novabot.core")
+
+    if not args.mongodb_url:
+        import mongomock
+        from novabot.core.db import DB
+        DB._sync = mongomock.MongoClient()["NovaBot"]
+
+    nonebot.load_plugin("bench_plugin")
+    app = nonebot.get_asgi()
+
+    async def _main():
+        async with app.router.lifespan_context(app):
+            if args.check_concurrency:
+                bot = BenchBot(driver._adapters[Adapter.get_name()], "1")
+                return await check_concurrency(bot)
+            return await bench(args)
+
+    result = asyncio.run(_main())
+    if args.check_concurrency:
+        sys.exit(0 if result else 1)
+    if args.json:
+        print(json.dumps(result))
+        return
+    print(f"{result['mode']} / {result['backend']} backend, {result['services']} services, {result['events']} events")
+    print(f"  throughput: {result['throughput']:.0f} events/s")
+    print("  latency:    " + ", ".join(f"{name} {result[f'{name}_us']:.1f} us"
+                                       for name in ("mean", "p50", "p90", "p99", "max")))
+
+
+if __name__ == "__main__":
+    main()
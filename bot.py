@@ -1,6 +1,8 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import time
+
 import nonebot
 from nonebot.adapters.onebot.v11 import Adapter as ONEBOT_V11Adapter
 
@@ -22,12 +24,21 @@ driver.register_adapter(ONEBOT_V11Adapter)
 
 # Please DO NOT modify this file unless you know what you are doing!
 # As an alternative, you should use command `nb` or modify `pyproject.toml` to load plugins
+_start = time.perf_counter()
 nonebot.load_plugin("nonebot_plugin_apscheduler")
+_apscheduler_loaded = time.perf_counter()
 nonebot.load_plugin("novabot.core")
 
+# `novabot.core` must be loaded as a plugin before importing anything from it
+from novabot.core.startup import record, load_plugins_timed, report
+from novabot.core import metrics, cluster
+
+record("load", "nonebot_plugin_apscheduler", _apscheduler_loaded - _start)
+record("load", "novabot.core", time.perf_counter() - _apscheduler_loaded)
+
 # Add Plugins Under Here
 
-nonebot.load_from_toml("pyproject.toml")
+load_plugins_timed("pyproject.toml")  # Same as `nonebot.load_from_toml`, but timed per plugin
 
 # Modify some config / config depends on loaded configs
 # 
@@ -35,6 +46,12 @@ nonebot.load_from_toml("pyproject.toml")
 # do something...
 
 
+metrics.setup()  # Serves Prometheus metrics on `METRICS_PATH` (default `/metrics`) unless `METRICS_ENABLED=false`
+cluster.setup(app)  # Shards bot connections across workers when `CLUSTER_ENABLED=true`
+
+driver.on_startup(report)  # Registered last, runs after every other startup hook
+
+
 if __name__ == "__main__":
     nonebot.logger.warning("Always use `nb run` to start the bot instead of manually running!")
     nonebot.run(app="__mp_main__:app")
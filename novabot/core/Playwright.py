@@ -1,17 +1,51 @@
 """
 Copied from `SK-415`, `https://github.com/SK-415/HarukaBot`
+
+浏览器的安装不会在事件循环中进行:
+- 推荐在部署时执行 `playwright install chromium` (见 `Dockerfile`), 并设置 `PLAYWRIGHT_SKIP_INSTALL=true`
+- 否则首次启动浏览器前会在线程中执行安装, 成功后在 `data/playwright/` 下写入版本戳, 同一版本不会再次安装
+- `PLAYWRIGHT_PREWARM=["chromium"]` 会在启动时于后台启动浏览器并预热页面池
 """
 
+import asyncio
 import os
 import sys
-from typing import Optional, Literal, Dict
+import time
+from contextlib import asynccontextmanager
+from importlib.metadata import version
+from pathlib import Path
+from typing import Optional, Literal, Dict, List, Any, AsyncIterator, Callable, Awaitable, Set
 
+from nonebot import get_driver
+from nonebot.log import logger
 from playwright.__main__ import main
-from playwright.async_api import Browser, async_playwright, Playwright
+from playwright.async_api import Browser, BrowserContext, Page, async_playwright, Playwright
+from pydantic import BaseModel, Extra
+
+from . import metrics
+
+__all__ = ["get_firefox_browser", "get_chromium_browser", "get_page_pool", "PagePool"]
+
+
+class Config(BaseModel, extra=Extra.ignore):
+    playwright_pool_size: int = 4
+    playwright_pool_warm: int = 1
+    playwright_pool_max_uses: int = 50
+    playwright_pool_timeout: float = 30
+    playwright_skip_install: bool = False
+    playwright_prewarm: List[Literal['chromium', 'firefox']] = []
+
 
-__all__ = ["get_firefox_browser", "get_chromium_browser"]
+config = Config.parse_obj(get_driver().config)
+driver = get_driver()
 
-sys.argv = ["", "install", "chromium"]
+browser_seconds = metrics.Histogram("novabot_browser_get_seconds",
+                                    "Browser getters, including launching and installing when needed",
+                                    ["browser"], buckets=(0.0001, 0.001, 0.01, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 300))
+page_wait_seconds = metrics.Histogram("novabot_page_pool_wait_seconds",
+                                      "Time waiting for a free page pool slot", ["browser"])
+
+STAMP_PATH = Path.cwd() / "data" / "playwright"
 
 PLAYWRIGHT: Optional[Playwright] = None
 chromium_browser: Optional[Browser] = None
@@ -20,45 +54,88 @@ success: Optional[Dict[Literal['chromium', 'firefox'], bool]] = {
     "chromium": False,
     "firefox": False
 }
+_locks: Dict[Literal['chromium', 'firefox'], asyncio.Lock] = {
+    "chromium": asyncio.Lock(),
+    "firefox": asyncio.Lock()
+}
+_install_locks: Dict[Literal['chromium', 'firefox'], asyncio.Lock] = {
+    "chromium": asyncio.Lock(),
+    "firefox": asyncio.Lock()
+}
+_playwright_lock = asyncio.Lock()
 
 
-async def init_chromium(**kwargs) -> Browser:
-    if not success['chromium']:
-        install('chromium')
+async def _get_playwright() -> Playwright:
     global PLAYWRIGHT
-    if not PLAYWRIGHT:
-        PLAYWRIGHT = await async_playwright().start()
+    async with _playwright_lock:
+        if not PLAYWRIGHT:
+            PLAYWRIGHT = await async_playwright().start()
+    return PLAYWRIGHT
+
+
+async def ensure_installed(browser: Literal["chromium", "firefox"] = "chromium"):
+    """
+    确认浏览器已安装, 版本戳与当前 `playwright` 版本不一致时在线程中执行 `install`
+    同时首次渲染的协程中只有一个会执行 `install`, 其他的等待其完成
+    """
+    if success[browser] or config.playwright_skip_install:
+        return
+    async with _install_locks[browser]:
+        if success[browser]:
+            return
+        stamp = STAMP_PATH / browser
+        current = version("playwright")
+        if stamp.exists() and stamp.read_text() == current:
+            success[browser] = True
+            return
+        await asyncio.to_thread(install, browser)
+        stamp.parent.mkdir(parents=True, exist_ok=True)
+        stamp.write_text(current)
+
+
+async def init_chromium(**kwargs) -> Browser:
+    await ensure_installed('chromium')
     global chromium_browser
-    chromium_browser = await PLAYWRIGHT.chromium.launch(**kwargs)
+    chromium_browser = await (await _get_playwright()).chromium.launch(**kwargs)
     return chromium_browser
 
 
+@metrics.timed(browser_seconds, "chromium")
 async def get_chromium_browser(**kwargs) -> Browser:
-    return chromium_browser or await init_chromium(**kwargs)
+    if chromium_browser and chromium_browser.is_connected():
+        return chromium_browser
+    async with _locks['chromium']:  # Only one coroutine launches the browser
+        if chromium_browser and chromium_browser.is_connected():
+            return chromium_browser
+        return await init_chromium(**kwargs)
 
 
 async def init_firefox(**kwargs) -> Browser:
-    if not success['firefox']:
-        install('firefox')
-    global PLAYWRIGHT
-    if not PLAYWRIGHT:
-        PLAYWRIGHT = await async_playwright().start()
+    await ensure_installed('firefox')
     global firefox_browser
-    firefox_browser = await PLAYWRIGHT.firefox.launch(**kwargs)
+    firefox_browser = await (await _get_playwright()).firefox.launch(**kwargs)
     return firefox_browser
 
 
+@metrics.timed(browser_seconds, "firefox")
 async def get_firefox_browser(**kwargs) -> Browser:
-    return firefox_browser or await init_firefox(**kwargs)
+    if firefox_browser and firefox_browser.is_connected():
+        return firefox_browser
+    async with _locks['firefox']:
+        if firefox_browser and firefox_browser.is_connected():
+            return firefox_browser
+        return await init_firefox(**kwargs)
 
 
 def install(browser: Literal["chromium", "firefox"] = "chromium"):
-    """自动安装、更新浏览器"""
+    """自动安装、更新浏览器, 会阻塞当前线程, 请勿直接在事件循环中调用"""
 
     def restore_env():
+        sys.argv = original_argv
         if original_proxy is not None:
             os.environ["HTTPS_PROXY"] = original_proxy
 
+    original_argv = sys.argv
     sys.argv = ["", "install", browser]
     original_proxy = os.environ.get("HTTPS_PROXY")
     global success
@@ -76,5 +153,146 @@ def install(browser: Literal["chromium", "firefox"] = "chromium"):
             if e.code != 0:
                 restore_env()
                 raise RuntimeError(f"未知错误，{browser} 下载失败")
+        success[browser] = True
     restore_env()
 
+
+class PooledPage:
+    __slots__ = ('context', 'page', 'uses', 'crashed')
+
+    def __init__(self, context: BrowserContext, page: Page):
+        self.context = context
+        self.page = page
+        self.uses = 0
+        self.crashed = False
+        page.on("crash", lambda _: setattr(self, 'crashed', True))
+
+    @property
+    def healthy(self) -> bool:
+        return not self.crashed and not self.page.is_closed()
+
+    async def close(self):
+        try:
+            await self.context.close()
+        except Exception:  # Browser may be gone already
+            pass
+
+
+class PagePool:
+    """
+    页面池, 同时检出的页面数不超过 `size`, 池满时按先后顺序排队等待, 超时抛出 `asyncio.TimeoutError`
+    每个页面拥有独立的 `BrowserContext`, 使用 `max_uses` 次或崩溃后会被关闭并在下次检出时重新创建
+
+    ```
+    async with (await get_page_pool()).page() as page:
+        await page.set_content(html)
+        image = await page.screenshot()
+    ```
+    """
+
+    def __init__(self,
+                 browser_getter: Callable[[], Awaitable[Browser]],
+                 *,
+                 size: int = 4,
+                 warm: int = 1,
+                 max_uses: int = 50,
+                 timeout: float = 30,
+                 name: str = '',
+                 **context_kwargs: Any):
+        self.browser_getter = browser_getter
+        self.name = name
+        self.size = size
+        self.warm = min(warm, size)
+        self.max_uses = max_uses
+        self.timeout = timeout
+        self.context_kwargs = context_kwargs
+        self._semaphore = asyncio.Semaphore(size)
+        self._idle: List[PooledPage] = []
+
+    async def _create(self) -> PooledPage:
+        browser = await self.browser_getter()
+        context = await browser.new_context(**self.context_kwargs)
+        return PooledPage(context, await context.new_page())
+
+    async def warm_up(self):
+        """预先创建 `warm` 个空闲页面"""
+        pages = await asyncio.gather(*(self._create() for _ in range(self.warm - len(self._idle))))
+        self._idle.extend(pages)
+
+    async def _checkout(self) -> PooledPage:
+        while self._idle:
+            if (pooled := self._idle.pop()).healthy:
+                return pooled
+            await pooled.close()
+        return await self._create()
+
+    async def _checkin(self, pooled: PooledPage, failed: bool):
+        pooled.uses += 1
+        if failed or not pooled.healthy or pooled.uses >= self.max_uses:
+            await pooled.close()
+        else:
+            self._idle.append(pooled)
+
+    @asynccontextmanager
+    async def page(self, timeout: Optional[float] = None) -> AsyncIterator[Page]:
+        start = time.perf_counter()
+        await asyncio.wait_for(self._semaphore.acquire(), self.timeout if timeout is None else timeout)
+        if metrics.enabled:
+            page_wait_seconds.observe(time.perf_counter() - start, self.name)
+        try:
+            pooled = await self._checkout()
+            failed = True
+            try:
+                yield pooled.page
+                failed = False
+            finally:
+                await self._checkin(pooled, failed)
+        finally:
+            self._semaphore.release()
+
+    async def close(self):
+        idle, self._idle = self._idle, []
+        await asyncio.gather(*(pooled.close() for pooled in idle))
+
+
+pools: Dict[Literal['chromium', 'firefox'], PagePool] = {}
+_background: Set[asyncio.Task] = set()
+
+
+async def get_page_pool(browser: Literal["chromium", "firefox"] = "chromium") -> PagePool:
+    """获取对应浏览器的页面池, 首次获取时会预热 `PLAYWRIGHT_POOL_WARM` 个页面"""
+    if (pool := pools.get(browser)) is None:
+        pool = pools[browser] = PagePool(get_chromium_browser if browser == 'chromium' else get_firefox_browser,
+                                         size=config.playwright_pool_size,
+                                         warm=config.playwright_pool_warm,
+                                         max_uses=config.playwright_pool_max_uses,
+                                         timeout=config.playwright_pool_timeout,
+                                         name=browser)
+        try:
+            await pool.warm_up()
+        except Exception as e:
+            logger.opt(exception=e).warning(f"Failed to warm up {browser} page pool")
+    return pool
+
+
+@driver.on_startup
+async def _():
+    async def prewarm(browser: Literal["chromium", "firefox"]):
+        try:
+            await get_page_pool(browser)
+        except Exception as e:
+            logger.opt(exception=e).warning(f"Failed to prewarm {browser}")
+
+    for browser in config.playwright_prewarm:  # Runs in background so that startup is not delayed by installation
+        _background.add(task := asyncio.create_task(prewarm(browser)))
+        task.add_done_callback(_background.discard)
+
+
+@driver.on_shutdown
+async def _():
+    await asyncio.gather(*(pool.close() for pool in pools.values()))
+    for browser in (chromium_browser, firefox_browser):
+        if browser and browser.is_connected():
+            await browser.close()
+    if PLAYWRIGHT:
+        await PLAYWRIGHT.stop()
@@ -1,5 +1,9 @@
 from nonebot import load_plugin, require
 
 from .service.service import Service
-from .Playwright import get_firefox_browser, get_chromium_browser
+from .Playwright import get_firefox_browser, get_chromium_browser, get_page_pool
+from .render import html_to_image
 from .db import DB
+from .cluster import get_bot, get_bots
+from .history import message_history
+from .dedup import event_dedup
@@ -0,0 +1,331 @@
+"""
+多进程 (多 worker) 部署
+
+在 `.env.prod` 中设置 `CLUSTER_ENABLED=true` 后即可增加 `MAX_WORKERS`:
+- 连接按 `self_id` 分片: 每个 `self_id` 同一时刻只属于一个 worker, 由 `data/cluster/bots/{self_id}.lock` 上的文件锁保证,
+  其他 worker 收到同一 `self_id` 的 WebSocket 连接时直接拒绝, 协议端重连后落到空闲的 worker 上
+- 每个 worker 在 `data/cluster/{pid}.sock` 上监听, `get_bot(self_id)` 找不到本地连接时返回 `RemoteBot`,
+  其 API 调用会被转发给持有连接的 worker
+- cd / limit 改为使用 `mongo` 后端 (原子的 `find_one_and_update`), 进程内的 `memory` 后端不再可用
+- `broadcast` / `subscribe` 用于在 worker 之间同步进程内的状态, 例如服务开关
+"""
+
+import asyncio
+import json
+import os
+from pathlib import Path
+from typing import Any, Dict, Optional, Callable, Awaitable, List, Set, Union
+
+import nonebot
+from nonebot import get_driver
+from nonebot.adapters.onebot.v11 import Adapter, Bot, ActionFailed, NetworkError
+from nonebot.log import logger
+from nonebot.utils import DataclassEncoder
+from pydantic import BaseModel, Extra
+
+from .utils import TTLCache
+
+
+class Config(BaseModel, extra=Extra.ignore):
+    cluster_enabled: bool = False
+    cluster_path: Path = Path.cwd() / "data" / "cluster"
+    cluster_timeout: float = 5
+
+
+config = Config.parse_obj(get_driver().config)
+driver = get_driver()
+
+STREAM_LIMIT = 64 * 1024 * 1024  # A line may carry base64 images
+
+Handler = Callable[[Any], Union[Awaitable[None], None]]
+
+
+class BotRegistry:
+    """`self_id` 到持有连接的 worker 地址的映射, 以文件锁表示所有权, 进程退出时锁自动释放"""
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._owners = TTLCache(maxsize=1024, ttl=5)
+
+    def claim(self, self_id: str, address: str) -> Optional[int]:
+        """尝试取得 `self_id` 的所有权, 成功时返回需要在连接结束后 `release` 的文件描述符"""
+        import fcntl
+
+        self.path.mkdir(parents=True, exist_ok=True)
+        fd = os.open(self.path / f"{self_id}.lock", os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return None
+        os.ftruncate(fd, 0)
+        os.pwrite(fd, address.encode(), 0)
+        self._owners.pop(self_id)
+        return fd
+
+    def release(self, self_id: str, fd: int):
+        import fcntl
+
+        os.ftruncate(fd, 0)  # The file stays, unlinking it would race with other workers locking it
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+        self._owners.pop(self_id)
+
+    def owner(self, self_id: str) -> Optional[str]:
+        """持有 `self_id` 的 worker 的地址, 没有 worker 持有时返回 `None`"""
+        if (address := self._owners.get(self_id)) is None:
+            address = self._read_owner(self.path / f"{self_id}.lock")
+            self._owners.set(self_id, address)
+        return address or None
+
+    def owners(self) -> Dict[str, str]:
+        if not self.path.exists():
+            return {}
+        return {file.stem: address for file in self.path.glob("*.lock")
+                if (address := self._read_owner(file))}
+
+    @staticmethod
+    def _read_owner(file: Path) -> str:
+        import fcntl
+
+        try:
+            fd = os.open(file, os.O_RDONLY)
+        except FileNotFoundError:
+            return ''
+        try:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+            except BlockingIOError:  # Locked, so the owner is alive
+                return os.pread(fd, 4096, 0).decode()
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            return ''
+        finally:
+            os.close(fd)
+
+
+class Peer:
+    """到另一个 worker 的连接, 请求与响应都是一行 JSON, 以 `id` 对应"""
+
+    def __init__(self, address: str):
+        self.address = address
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._lock = asyncio.Lock()
+        self._pending: Dict[int, 'asyncio.Future[Any]'] = {}
+        self._next_id = 0
+
+    async def _connect(self) -> asyncio.StreamWriter:
+        if self._writer is None or self._writer.is_closing():
+            reader, self._writer = await asyncio.open_unix_connection(self.address, limit=STREAM_LIMIT)
+            task = asyncio.create_task(self._read(reader, self._writer))
+            _tasks.add(task)
+            task.add_done_callback(_tasks.discard)
+        return self._writer
+
+    async def _read(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while line := await reader.readline():
+                response = json.loads(line)
+                if (future := self._pending.pop(response["id"], None)) and not future.done():
+                    if error := response.get("error"):
+                        future.set_exception(ActionFailed(**error["info"]) if error["type"] == "ActionFailed"
+                                             else NetworkError(error["message"]))
+                    else:
+                        future.set_result(response.get("result"))
+        except Exception as e:
+            logger.opt(exception=e).warning(f"Connection to worker {self.address} broken")
+        finally:
+            writer.close()
+            if self._writer is writer:
+                self._writer = None
+            for future in self._pending.values():
+                if not future.done():
+                    future.set_exception(NetworkError(f"Connection to worker {self.address} closed"))
+            self._pending.clear()
+
+    async def request(self, message: Dict[str, Any], timeout: float) -> Any:
+        self._next_id += 1
+        message_id = message["id"] = self._next_id
+        future = self._pending[message_id] = asyncio.get_running_loop().create_future()
+        try:
+            async with self._lock:
+                writer = await self._connect()
+                writer.write(json.dumps(message, cls=DataclassEncoder).encode() + b"\n")
+                await writer.drain()
+            return await asyncio.wait_for(future, timeout)
+        except (OSError, asyncio.TimeoutError) as e:
+            raise NetworkError(f"Failed to reach worker {self.address}: {e!r}") from e
+        finally:
+            self._pending.pop(message_id, None)
+
+    async def close(self):
+        if self._writer is not None:
+            self._writer.close()
+
+
+class RemoteBot(Bot):
+    """连接在其他 worker 上的 Bot, API 调用由持有连接的 worker 执行, 调用钩子也在那里运行"""
+
+    def __init__(self, adapter: Adapter, self_id: str, address: str):
+        super().__init__(adapter, self_id)
+        self.address = address
+
+    async def call_api(self, api: str, **data: Any) -> Any:
+        timeout = (driver.config.api_timeout or 30) + config.cluster_timeout  # The owner applies `api_timeout`
+        return await _peer(self.address).request({"op": "call_api", "self_id": self.self_id,
+                                                  "api": api, "data": data}, timeout)
+
+
+registry = BotRegistry(config.cluster_path / "bots")
+handlers: Dict[str, List[Handler]] = {}
+_peers: Dict[str, Peer] = {}
+_tasks: Set[asyncio.Task] = set()
+_server: Optional[asyncio.AbstractServer] = None
+
+
+def worker_address() -> str:
+    """本 worker 监听的地址, 在调用时计算, 以免 `gunicorn --preload` 时得到主进程的 pid"""
+    return str(config.cluster_path / f"{os.getpid()}.sock")
+
+
+def _peer(peer_address: str) -> Peer:
+    if (peer := _peers.get(peer_address)) is None:
+        peer = _peers[peer_address] = Peer(peer_address)
+    return peer
+
+
+def get_bot(self_id: Optional[str] = None) -> Bot:
+    """与 `nonebot.get_bot` 相同, 但集群模式下也能获取连接在其他 worker 上的 Bot"""
+    bots = nonebot.get_bots()
+    if not config.cluster_enabled or (bots if self_id is None else self_id in bots):
+        return nonebot.get_bot(self_id)
+    if self_id is None:
+        for self_id, peer_address in registry.owners().items():
+            return RemoteBot(nonebot.get_adapter(Adapter), self_id, peer_address)
+    elif peer_address := registry.owner(self_id):
+        return RemoteBot(nonebot.get_adapter(Adapter), self_id, peer_address)
+    return nonebot.get_bot(self_id)  # Raises as nonebot does
+
+
+def get_bots() -> Dict[str, Bot]:
+    """所有 worker 上的 Bot, 本地连接的为原 Bot, 其他为 `RemoteBot`"""
+    bots: Dict[str, Bot] = dict(nonebot.get_bots())
+    if config.cluster_enabled:
+        adapter = nonebot.get_adapter(Adapter)
+        for self_id, peer_address in registry.owners().items():
+            if self_id not in bots and peer_address != worker_address():
+                bots[self_id] = RemoteBot(adapter, self_id, peer_address)
+    return bots
+
+
+def subscribe(topic: str) -> Callable[[Handler], Handler]:
+    """注册在其他 worker `broadcast` 时调用的函数, 本 worker 的 `broadcast` 不会调用它"""
+
+    def decorator(func: Handler) -> Handler:
+        handlers.setdefault(topic, []).append(func)
+        return func
+
+    return decorator
+
+
+async def broadcast(topic: str, payload: Any):
+    """发送给其他所有 worker, 未启用集群时不做任何事, 发送失败只记录日志"""
+    if not config.cluster_enabled:
+        return
+    peers = [str(path) for path in config.cluster_path.glob("*.sock") if str(path) != worker_address()]
+    results = await asyncio.gather(*(_peer(peer).request({"op": "broadcast", "topic": topic, "payload": payload},
+                                                         config.cluster_timeout) for peer in peers),
+                                   return_exceptions=True)
+    for peer, result in zip(peers, results):
+        if isinstance(result, Exception):
+            logger.warning(f"Failed to broadcast {topic} to worker {peer}: {result!r}")
+
+
+async def _dispatch(request: Dict[str, Any]) -> Any:
+    if request["op"] == "call_api":
+        if (bot := nonebot.get_bots().get(request["self_id"])) is None:
+            raise NetworkError(f"Bot {request['self_id']} is not connected to worker {worker_address()}")
+        return await bot.call_api(request["api"], **request["data"])
+    if request["op"] == "broadcast":
+        for handler in handlers.get(request["topic"], []):
+            if asyncio.iscoroutine(result := handler(request["payload"])):
+                await result
+        return None
+    raise ValueError(f"Unknown op {request['op']}")
+
+
+async def _serve(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    lock = asyncio.Lock()
+
+    async def respond(request: Dict[str, Any]):
+        try:
+            response = {"id": request["id"], "result": await _dispatch(request)}
+        except ActionFailed as e:
+            response = {"id": request["id"], "error": {"type": "ActionFailed", "info": e.info}}
+        except Exception as e:
+            response = {"id": request["id"], "error": {"type": "NetworkError", "message": repr(e)}}
+        async with lock:
+            writer.write(json.dumps(response, cls=DataclassEncoder).encode() + b"\n")
+            await writer.drain()
+
+    try:
+        while line := await reader.readline():
+            task = asyncio.create_task(respond(json.loads(line)))
+            _tasks.add(task)
+            task.add_done_callback(_tasks.discard)
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+
+class ShardMiddleware:
+    """ASGI 中间件, 只接受本 worker 能取得所有权的 `self_id` 的 WebSocket 连接"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "websocket":
+            return await self.app(scope, receive, send)
+        self_id = dict(scope["headers"]).get(b"x-self-id", b"").decode()
+        if not self_id:  # Rejected by the adapter
+            return await self.app(scope, receive, send)
+        if (fd := registry.claim(self_id, worker_address())) is None:
+            logger.info(f"Bot {self_id} is connected to another worker, rejected")
+            await send({"type": "websocket.close", "code": 1013, "reason": "Connected to another worker"})
+            return
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            registry.release(self_id, fd)
+
+
+def setup(app):
+    """为 ASGI 应用安装分片中间件并在启动时开始监听, 未启用集群时不做任何事"""
+    if not config.cluster_enabled:
+        return
+    app.add_middleware(ShardMiddleware)
+
+    @driver.on_startup
+    async def _():
+        global _server
+        config.cluster_path.mkdir(parents=True, exist_ok=True)
+        for path in config.cluster_path.glob("*.sock"):  # Left behind by workers that were killed
+            try:
+                os.kill(int(path.stem), 0)
+            except (ValueError, ProcessLookupError):
+                path.unlink(missing_ok=True)
+            except PermissionError:
+                pass
+        _server = await asyncio.start_unix_server(_serve, path=worker_address(), limit=STREAM_LIMIT)
+        logger.info(f"Cluster worker listening on {worker_address()}")
+
+    @driver.on_shutdown
+    async def _():
+        if _server is not None:
+            _server.close()
+        Path(worker_address()).unlink(missing_ok=True)
+        await asyncio.gather(*(peer.close() for peer in _peers.values()))
+
+
+__all__ = ["get_bot", "get_bots", "RemoteBot", "broadcast", "subscribe", "setup", "BotRegistry", "ShardMiddleware"]
@@ -1,22 +1,50 @@
 """
 安全性相关的模块
 - 对于数据库泄漏的情形, 提供了 `AES` 和 `RSA` 加密, 可以有效阻止敏感信息泄漏.
+    批量加密请使用 `encrypt_many` / `encrypt_documents`, 大文件请使用 `transform_stream` / `transform_buffer`
     Warning: 对于被拿 Shell 或者可以 RCE 的情形, 加密的作用微乎其微.
 - 对于需要身份验证的情形, 提供了 `SCrypt` 哈希算法
+    在事件循环中请使用 `async_scrypt` / `async_scrypt_many`, 哈希计算会在进程池中进行, 不会阻塞事件循环
+    进程数为 `SCRYPT_WORKERS` (默认为 CPU 核心数), 进程由 `SCRYPT_START_METHOD` 启动且不会导入主模块, 关闭时进程池随之关闭
 
 默认情况下, 以 `QQ_ID` 为单位进行 `SECRET` / `IV` 的生成, 意即每个 `QQ_ID` 使用相同的 `SECRET` 和 `IV`, 可以通过传入适当的参数更改
+所有 `QQ_ID` 的 `SECRET` / `IV` 保存在 `Nova-Bot/data/crypto.db` 中 (见 `KeyStore`), 旧版的 `data/crypto/` 目录会被自动导入
 默认情况下, 在 `$HOME/.secret/Nova-Bot/` 目录下生成盐文件, 可以通过传入适当的参数更改
 """
 
+import asyncio
 import base64
+import multiprocessing
+import os
 import random
+import sqlite3
 import string
+import sys
+import threading
+import types
+from collections import OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor
+from functools import partial
 from pathlib import Path
-from typing import Union, Optional, Tuple
+from typing import Union, Optional, Tuple, Dict, Iterable, List, Callable, Any, BinaryIO, Literal
 
 from Crypto.Cipher import AES
 from Crypto.Protocol.KDF import scrypt
 from Crypto.Random import get_random_bytes
+from nonebot import get_driver
+from pydantic import BaseModel, Extra
+
+
+class Config(BaseModel, extra=Extra.ignore):
+    scrypt_workers: Optional[int] = None  # CPU count by default
+    scrypt_start_method: Literal['forkserver', 'spawn'] = 'forkserver'
+
+
+config = Config.parse_obj(get_driver().config)
+driver = get_driver()
+
+_salts: Dict[Path, str] = {}
+_executor: Optional[ProcessPoolExecutor] = None
 
 
 def get_salt(path: Optional[Union[str, Path]] = None,
@@ -25,6 +53,7 @@ def get_salt(path: Optional[Union[str, Path]] = None,
              force: Optional[bool] = False) -> str:
     """
     获取盐值, 默认情况下, 在 `$HOME/.secret/Nova-Bot/salt` 文件里写入一个 32bits 的盐
+    读取过的盐会被缓存在内存中, 只有 `force == True` 时才会重新写入文件
     :param force: 是否强制生成新的 `salt`, 默认为 `否`
     :param path: 盐文件的完整路径
     :param length: 生成盐的长度 [bit(s)], 默认为 `32`, 在盐文件存在且 `force == False` 的情况下无作用
@@ -34,6 +63,8 @@ def get_salt(path: Optional[Union[str, Path]] = None,
         path = Path("~/.secret/Nova-Bot/salt").expanduser()
     if isinstance(path, str):
         path = Path(path)
+    if not force and (salt := _salts.get(path)) is not None:
+        return salt
     path.parent.mkdir(parents=True, exist_ok=True)
     # Generate New Salt
     if not path.exists() or force:
@@ -44,6 +75,7 @@ def get_salt(path: Optional[Union[str, Path]] = None,
     else:
         with open(path, 'r') as f:
             salt = f.read()
+    _salts[path] = salt
     return salt
 
 
@@ -72,43 +104,221 @@ def SCrypt(content: str,
         else scrypt(content, salt, key_len, N, r, p)
 
 
-def __get_qq_secret_and_iv(qq: Union[int, str],
-                           path: Optional[Union[str, Path]] = None,
-                           *,
-                           secret: Optional[bytes] = None,
-                           iv: Optional[bytes] = None,
-                           force: Optional[bool] = False) -> Tuple[bytes, bytes]:
+def _mp_context() -> multiprocessing.context.BaseContext:
     """
-    获取 `QQ_ID` 对应的 `SECRET` 和 `IV`, 在文件不存在的情况下, 生成新的 `SECRET` 和 `IV`, 可被指定特定内容
-    否则 `SECRET` 为 32 位随机字节, `IV` 为 16 位随机字节
-    :param qq: QQ 号
-    :param path: 文件所在的目录路径, 默认为 `Nova-Bot/data/crypto/`
-    :param secret: 仅在 `文件不存在` 或 `force == True` 的情况下作用, 指定文件的 `SECRET` 值 32 bits
-    :param iv: 仅在 `文件不存在` 或 `force == True` 的情况下作用, 指定文件的 `IV` 值 16 bits
-    :param force: 是否强制更新文件, 默认为 `否`
-    :return: 包含 `SECRET` 与 `IV` 的元组
+    不使用 `fork`: 复制持有事件循环, 线程池与数据库连接的进程并不安全
+    `forkserver` 会预先导入 `scrypt` 所在的模块, 不支持时使用 `spawn`
+    """
+    if config.scrypt_start_method == 'forkserver' and 'forkserver' in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context('forkserver')
+        context.set_forkserver_preload([scrypt.__module__])
+        return context
+    return multiprocessing.get_context('spawn')
+
+
+class _ScryptExecutor(ProcessPoolExecutor):
+    """
+    `forkserver` / `spawn` 启动的进程默认会以 `__mp_main__` 再导入一次主模块, 对 `bot.py` 而言即初始化整个机器人;
+    进程池在 `submit` 时按需启动进程, 此时暂时以空模块替换 `__main__`, 进程中只会导入 `scrypt` 所在的模块
+    """
+    _main_lock = threading.Lock()
+
+    def submit(self, fn, /, *args, **kwargs) -> Future:
+        with self._main_lock:
+            main = sys.modules['__main__']
+            sys.modules['__main__'] = types.ModuleType('__main__')
+            try:
+                return super().submit(fn, *args, **kwargs)
+            finally:
+                sys.modules['__main__'] = main
+
+
+def scrypt_executor(max_workers: Optional[int] = None) -> ProcessPoolExecutor:
+    """
+    获取 `async_scrypt` 使用的进程池, 首次调用时创建
+    :param max_workers: 进程数, 默认为 `SCRYPT_WORKERS` 或 CPU 核心数, 仅在首次调用时作用
+    """
+    global _executor
+    if _executor is None:
+        _executor = _ScryptExecutor(max_workers=max_workers or config.scrypt_workers or os.cpu_count(),
+                                    mp_context=_mp_context())
+    return _executor
+
+
+@driver.on_shutdown
+async def _():
+    global _executor
+    if _executor is not None:
+        executor, _executor = _executor, None
+        await asyncio.to_thread(executor.shutdown, cancel_futures=True)
+
+
+async def async_scrypt(content: str,
+                       salt: Optional[str] = None,
+                       *,
+                       key_len: Optional[int] = 32,
+                       N: Optional[int] = 8192,
+                       r: Optional[int] = 8,
+                       p: Optional[int] = 1,
+                       base64_: Optional[bool] = True,
+                       executor: Optional[ProcessPoolExecutor] = None) -> bytes:
+    """
+    `SCrypt` 的异步版本, 在进程池中计算哈希, 参数与 `SCrypt` 相同
+    :param executor: 使用的进程池, 默认为 `scrypt_executor()`
     """
-    if isinstance(qq, int):
+    if not salt:
+        salt = get_salt()
+    result = await asyncio.get_running_loop().run_in_executor(executor or scrypt_executor(),
+                                                              scrypt, content, salt, key_len, N, r, p)
+    return base64.b64encode(result) if base64_ else result
+
+
+async def async_scrypt_many(contents: Iterable[str],
+                            salt: Optional[str] = None,
+                            **kwargs) -> List[bytes]:
+    """批量计算 `async_scrypt`, 各项在进程池中并行计算, 结果顺序与 `contents` 相同"""
+    salt = salt or get_salt()
+    return list(await asyncio.gather(*(async_scrypt(content, salt, **kwargs) for content in contents)))
+
+
+def _database_path(path: Path) -> Path:
+    return path / "crypto.db" if path.is_dir() else path
+
+
+class KeyStore:
+    """
+    所有 `QQ_ID` 的 `SECRET` / `IV` 保存在同一个 SQLite 数据库中, 最近使用的 `cache_size` 个缓存在内存中
+    缓存命中时不会产生任何磁盘读写, 可以在多个线程中使用
+    """
+
+    def __init__(self, path: Optional[Union[str, Path]] = None, *, cache_size: int = 4096):
+        """
+        :param path: 数据库文件的路径, 默认为 `Nova-Bot/data/crypto.db`;
+                     为目录时 (旧版的 `path` 参数), 数据库文件为其中的 `crypto.db`, 目录中的旧版文件会被导入
+        :param cache_size: 内存中缓存的 `QQ_ID` 数量
+        """
+        path = Path(path) if path else Path.cwd() / "data" / "crypto.db"
+        legacy = path if path.is_dir() else None
+        path = _database_path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        new = not path.exists()
+        self.path = path
+        self.cache_size = cache_size
+        self._cache: 'OrderedDict[str, Tuple[bytes, bytes]]' = OrderedDict()
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS keys (qq TEXT PRIMARY KEY, secret BLOB, iv BLOB)")
+        if new:
+            path.chmod(0o600)
+        if legacy:
+            self.migrate(legacy)
+
+    def _remember(self, qq: str, keys: Tuple[bytes, bytes]) -> Tuple[bytes, bytes]:
+        self._cache[qq] = keys
+        self._cache.move_to_end(qq)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return keys
+
+    def get(self,
+            qq: Union[int, str],
+            *,
+            secret: Optional[bytes] = None,
+            iv: Optional[bytes] = None,
+            force: Optional[bool] = False) -> Tuple[bytes, bytes]:
+        """
+        获取 `QQ_ID` 对应的 `SECRET` 和 `IV`, 在不存在的情况下, 生成新的 `SECRET` 和 `IV`, 可被指定特定内容
+        否则 `SECRET` 为 32 位随机字节, `IV` 为 16 位随机字节
+        :param qq: QQ 号
+        :param secret: 仅在 `不存在` 或 `force == True` 的情况下作用, 指定 `SECRET` 值 32 bits
+        :param iv: 仅在 `不存在` 或 `force == True` 的情况下作用, 指定 `IV` 值 16 bits
+        :param force: 是否强制更新, 默认为 `否`
+        :return: 包含 `SECRET` 与 `IV` 的元组
+        """
         qq = str(qq)
-    if not path:
-        path = Path.cwd() / "data" / "crypto"
-    if isinstance(path, str):
-        path = Path(path)
-    path.mkdir(parents=True, exist_ok=True)
-    path = path / qq
-    if not path.exists() or force:
-        with open(path, 'wb') as f:
-            results = (secret or get_random_bytes(32),
-                       iv or get_random_bytes(16))
-            f.write(b"\r\n".join(results))
-        path.chmod(0o600)
-    else:
-        with open(path, 'rb') as f:
-            results = f.readlines()
-            results = tuple(map(lambda x: x.replace(b"\r\n", b""), results))
-        if len(results) != 2:  # Re-generate secret and iv for corrupted file
-            __get_qq_secret_and_iv(qq, path, secret=secret, iv=iv, force=True)
-    return results
+        with self._lock:
+            if not force:
+                if (keys := self._cache.get(qq)) is not None:
+                    self._cache.move_to_end(qq)
+                    return keys
+                if row := self._conn.execute("SELECT secret, iv FROM keys WHERE qq = ?", (qq,)).fetchone():
+                    return self._remember(qq, (row[0], row[1]))
+            keys = (secret or get_random_bytes(32), iv or get_random_bytes(16))
+            self._conn.execute("INSERT OR REPLACE INTO keys VALUES (?, ?, ?)", (qq, *keys))
+            return self._remember(qq, keys)
+
+    def cipher_factory(self, qq: Union[int, str], mode: Optional[int] = AES.MODE_CFB) -> Callable[[], AES]:
+        """获取 `QQ_ID` 对应的 AES 工厂, 每次调用返回一个新的 AES 对象, 调用时不会读取数据库"""
+        secret, iv = self.get(qq)
+        return partial(AES.new, secret, mode, iv)
+
+    def migrate(self, path: Optional[Union[str, Path]] = None) -> int:
+        """
+        从旧版的 `每个 QQ_ID 一个文件` 的目录导入, 已存在的 `QQ_ID` 不会被覆盖, 子目录会被跳过
+        所有文件都导入后目录会被重命名为 `*.migrated`, 数据库文件就在该目录中时, 导入的文件移动到其中的 `.migrated/`;
+        有无法读取或格式错误的文件时不会重命名, 其他文件照常导入
+        :param path: 旧版文件所在的目录路径, 默认为 `Nova-Bot/data/crypto/`
+        :return: 导入的数量
+        """
+        path = Path(path) if path else Path.cwd() / "data" / "crypto"
+        if not path.is_dir():
+            return 0
+        inside = path.resolve() == self.path.parent.resolve()
+        rows, files, failed = [], [], 0
+        for file in path.iterdir():
+            if not file.is_file() or inside and file.name.startswith(self.path.name):  # Including -wal / -shm
+                continue
+            try:
+                content = file.read_bytes()
+            except OSError:
+                failed += 1
+                continue
+            # secret + b"\r\n" + iv(16), the secret is any AES key and may contain b"\r\n" itself
+            if len(content) - 18 in (16, 24, 32) and content[-18:-16] == b"\r\n":
+                rows.append((file.name, content[:-18], content[-16:]))
+                files.append(file)
+            else:
+                failed += 1
+        with self._lock:
+            self._conn.execute("BEGIN")
+            self._conn.executemany("INSERT OR IGNORE INTO keys VALUES (?, ?, ?)", rows)
+            self._conn.execute("COMMIT")
+        if failed:
+            return len(rows)
+        if inside:
+            (path / ".migrated").mkdir(exist_ok=True)
+            for file in files:
+                file.rename(path / ".migrated" / file.name)
+        else:
+            path.rename(path.with_name(f"{path.name}.migrated"))
+        return len(rows)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+_keystores: Dict[Path, KeyStore] = {}
+_keystore_args: Dict[Optional[Union[str, Path]], KeyStore] = {}  # Raw `path` arguments, so a hit touches no disk
+
+
+def get_keystore(path: Optional[Union[str, Path]] = None) -> KeyStore:
+    """
+    获取 `path` 对应的 `KeyStore`, 同一路径只会打开一次, `path` 可以是目录, 参见 `KeyStore`
+    默认的 `KeyStore` 首次打开时会自动从 `Nova-Bot/data/crypto/` 导入旧版文件
+    """
+    arg = path or None
+    if (keystore := _keystore_args.get(arg)) is not None:
+        return keystore
+    path = Path(path) if path else None
+    key = _database_path(path) if path else Path.cwd() / "data" / "crypto.db"
+    if (keystore := _keystores.get(key)) is None:
+        keystore = _keystores[key] = KeyStore(path or key)
+        if not path:
+            keystore.migrate()
+    _keystore_args[arg] = keystore
+    return keystore
 
 
 def QQ_AES(qq: Union[int, str],
@@ -121,31 +331,183 @@ def QQ_AES(qq: Union[int, str],
            force: Optional[bool] = False) -> AES:
     """
     获取 `QQ_ID` 对应的 AES
-    - 若 `temp == false`, 将会从文件中读取 (若不存在或 `force == True` 则会新生成) `SECRET` 和 `IV`
+    - 若 `temp == false`, 将会从 `KeyStore` 中读取 (若不存在或 `force == True` 则会新生成) `SECRET` 和 `IV`
         -- 若指定了 `SECRET` 和 `IV`, 在新生成的过程中会写入指定值, 否则 `SECRET` 为 32 位随机字节, `IV` 为 16 位随机字节
     :param qq: QQ 号
-    :param path: 文件所在的目录路径, 默认为 `Nova-Bot/data/crypto/`
+    :param path: `KeyStore` 数据库文件的路径, 默认为 `Nova-Bot/data/crypto.db`, 也可以是旧版的目录路径
     :param mode: AES 加密模式, 默认为 CFB
-    :param secret: 强制指定 AES 使用的 `SECRET`, 在 `temp == False` 的情况下还会将其传入 `__get_qq_secret_and_iv` 作为初始参数
-    :param iv: 强制指定 AES 使用的 `IV`, 在 `temp == False` 的情况下还会将其传入 `__get_qq_secret_and_iv` 作为初始参数
-    :param temp: 是否为临时 AES , 意即不保存到文件中, 默认为 `否`
-    :param force: 是否强制刷新 `QQ_ID` 对应的 `SECRET` 和 `IV` 文件, 默认为 `否`
+    :param secret: 强制指定 AES 使用的 `SECRET`, 在 `temp == False` 的情况下还会将其传入 `KeyStore.get` 作为初始参数
+    :param iv: 强制指定 AES 使用的 `IV`, 在 `temp == False` 的情况下还会将其传入 `KeyStore.get` 作为初始参数
+    :param temp: 是否为临时 AES , 意即不保存到 `KeyStore` 中, 默认为 `否`
+    :param force: 是否强制刷新 `QQ_ID` 对应的 `SECRET` 和 `IV`, 默认为 `否`
     :return: 对应的 AES
     """
     if temp:
         secret = secret or get_random_bytes(32)
         iv = iv or get_random_bytes(16)
     else:
-        _temp_secret, _temp_iv = __get_qq_secret_and_iv(qq,
-                                                        path,
-                                                        secret=secret,
-                                                        iv=iv,
-                                                        force=force)
+        _temp_secret, _temp_iv = get_keystore(path).get(qq, secret=secret, iv=iv, force=force)
         secret = secret or _temp_secret
         iv = iv or _temp_iv
     return AES.new(secret, mode, iv)
 
 
+def _group_by_qq(pairs: Iterable[Tuple[Union[int, str], Union[bytes, str]]]) -> Dict[str, List[Tuple[int, bytes]]]:
+    groups: Dict[str, List[Tuple[int, bytes]]] = {}
+    for index, (qq, value) in enumerate(pairs):
+        groups.setdefault(str(qq), []).append((index, value.encode() if isinstance(value, str) else value))
+    return groups
+
+
+def _transform_many(pairs: Iterable[Tuple[Union[int, str], Union[bytes, str]]],
+                    decrypt: bool,
+                    keystore: Optional[KeyStore],
+                    mode: int) -> List[bytes]:
+    keystore = keystore or get_keystore()
+    groups = _group_by_qq(pairs)
+    results: List[Optional[bytes]] = [None] * sum(map(len, groups.values()))
+    for qq, values in groups.items():
+        factory = keystore.cipher_factory(qq, mode)  # Keys are looked up once per QQ_ID
+        for index, value in values:
+            results[index] = factory().decrypt(value) if decrypt else factory().encrypt(value)
+    return results
+
+
+def encrypt_many(pairs: Iterable[Tuple[Union[int, str], Union[bytes, str]]],
+                 *,
+                 keystore: Optional[KeyStore] = None,
+                 mode: Optional[int] = AES.MODE_CFB) -> List[bytes]:
+    """
+    批量加密 `(QQ_ID, 明文)`, 同一 `QQ_ID` 的密钥只获取一次, 每个值都可以单独用 `QQ_AES(qq).decrypt` 解密
+    :param pairs: `(QQ_ID, 明文)` 的序列, `str` 会以 UTF-8 编码
+    :param keystore: 使用的 `KeyStore`, 默认为 `get_keystore()`
+    :param mode: AES 加密模式, 默认为 CFB
+    :return: 与 `pairs` 顺序相同的密文列表
+    """
+    return _transform_many(pairs, False, keystore, mode)
+
+
+def decrypt_many(pairs: Iterable[Tuple[Union[int, str], bytes]],
+                 *,
+                 keystore: Optional[KeyStore] = None,
+                 mode: Optional[int] = AES.MODE_CFB) -> List[bytes]:
+    """批量解密 `(QQ_ID, 密文)`, 参见 `encrypt_many`"""
+    return _transform_many(pairs, True, keystore, mode)
+
+
+def transform_buffer(qq: Union[int, str],
+                     buffer: Union[bytearray, memoryview],
+                     *,
+                     decrypt: Optional[bool] = False,
+                     keystore: Optional[KeyStore] = None,
+                     mode: Optional[int] = AES.MODE_CFB) -> memoryview:
+    """
+    原地加密 / 解密可写缓冲区, 不会产生额外的拷贝
+    :return: 指向 `buffer` 的 `memoryview`
+    """
+    view = memoryview(buffer)
+    cipher = (keystore or get_keystore()).cipher_factory(qq, mode)()
+    (cipher.decrypt if decrypt else cipher.encrypt)(view, output=view)
+    return view
+
+
+def transform_stream(qq: Union[int, str],
+                     src: BinaryIO,
+                     dst: BinaryIO,
+                     *,
+                     decrypt: Optional[bool] = False,
+                     chunk_size: Optional[int] = 64 * 1024,
+                     keystore: Optional[KeyStore] = None,
+                     mode: Optional[int] = AES.MODE_CFB) -> int:
+    """
+    分块加密 / 解密文件对象, 只使用一个 `chunk_size` 大小的缓冲区, 结果与一次性处理整个内容相同
+    :param src: 可读的二进制文件对象, 需支持 `readinto`
+    :param dst: 可写的二进制文件对象
+    :return: 处理的字节数
+    """
+    cipher = (keystore or get_keystore()).cipher_factory(qq, mode)()
+    transform = cipher.decrypt if decrypt else cipher.encrypt
+    buffer = memoryview(bytearray(chunk_size))
+    total = 0
+    while size := src.readinto(buffer):
+        transform(buffer[:size], output=buffer[:size])
+        dst.write(buffer[:size])
+        total += size
+    return total
+
+
+def _get_path(document: Dict[str, Any], path: str) -> Any:
+    for key in path.split('.'):
+        if not isinstance(document, dict) or key not in document:
+            return None
+        document = document[key]
+    return document
+
+
+def _set_path(document: Dict[str, Any], path: str, value: Any):
+    *parents, last = path.split('.')
+    for key in parents:
+        document = document[key]
+    document[last] = value
+
+
+def _transform_documents(documents: List[Dict[str, Any]],
+                         fields: Iterable[str],
+                         qq_field: str,
+                         decrypt: bool,
+                         keystore: Optional[KeyStore]) -> List[Dict[str, Any]]:
+    targets: List[Tuple[Dict[str, Any], str]] = []
+    pairs = []
+    for document in documents:
+        qq = _get_path(document, qq_field)
+        for field in fields:
+            if qq is not None and (value := _get_path(document, field)) is not None:
+                targets.append((document, field))
+                pairs.append((qq, value))
+    for (document, field), value in zip(targets, _transform_many(pairs, decrypt, keystore, AES.MODE_CFB)):
+        _set_path(document, field, value.decode() if decrypt else value)
+    return documents
+
+
+def encrypt_documents(documents: Iterable[Dict[str, Any]],
+                      fields: Iterable[str],
+                      *,
+                      qq_field: Optional[str] = "user_id",
+                      keystore: Optional[KeyStore] = None) -> List[Dict[str, Any]]:
+    """
+    在写入数据库前原地加密文档中声明的字段, 所有文档的所有字段一次性按 `QQ_ID` 分组加密
+    ```
+    await DB["User"].insert_many(encrypt_documents(users, ["password", "profile.phone"]))
+    ```
+    :param documents: 文档列表, 会被原地修改
+    :param fields: 需要加密的字段, 支持 `a.b` 形式的路径, 不存在或为 `None` 的字段会被跳过
+    :param qq_field: 文档中保存 `QQ_ID` 的字段
+    :param keystore: 使用的 `KeyStore`, 默认为 `get_keystore()`
+    :return: 加密后的文档列表, 字段值为 `bytes`
+    """
+    return _transform_documents(list(documents), list(fields), qq_field, False, keystore)
+
+
+def decrypt_documents(documents: Iterable[Dict[str, Any]],
+                      fields: Iterable[str],
+                      *,
+                      qq_field: Optional[str] = "user_id",
+                      keystore: Optional[KeyStore] = None) -> List[Dict[str, Any]]:
+    """原地解密 `encrypt_documents` 加密的字段, 字段值会以 UTF-8 解码为 `str`"""
+    return _transform_documents(list(documents), list(fields), qq_field, True, keystore)
+
+
 __all__ = ["get_salt",
            "QQ_AES",
-           "SCrypt"]
+           "KeyStore",
+           "get_keystore",
+           "encrypt_many",
+           "decrypt_many",
+           "transform_buffer",
+           "transform_stream",
+           "encrypt_documents",
+           "decrypt_documents",
+           "SCrypt",
+           "async_scrypt",
+           "async_scrypt_many",
+           "scrypt_executor"]
@@ -1,14 +1,183 @@
+"""
+异步数据库访问层
+
+`pymongo` 的所有调用都会被放入一个有界的线程池中执行, 不会阻塞事件循环
+- `DB["collection"]` 得到 `AsyncCollection`, 其方法与 `pymongo.collection.Collection` 同名, 但需要 `await`
+- 需要同步访问时 (例如在线程中) 可以使用 `AsyncCollection.sync` / `AsyncDatabase.sync`
+- 任意 `pymongo` 兼容的数据库对象 (例如 `mongomock`) 都可以传入 `AsyncDatabase` 用于测试
+- 每次调用按集合与操作名记录到 `novabot_db_seconds` (`METRICS_ENABLED=false` 时不计时)
+- 导入时不会创建客户端, 客户端在 `on_startup` 中 (或首次访问 `sync` 时) 创建
+"""
+
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Any, Callable, Dict, List, Optional
+
 import pymongo
 from nonebot import get_driver
 from pydantic import BaseModel, Extra
+from pymongo.collection import Collection
+from pymongo.database import Database
+
+from . import metrics
+from .startup import timed
+
+_CURSOR_OPS = {'find', 'aggregate'}  # Read out in the worker thread and returned as lists
 
 
 class Config(BaseModel, extra=Extra.ignore):
     mongodb_url: str = "mongodb://localhost:27017"
+    mongodb_max_pool_size: int = 100
+    mongodb_min_pool_size: int = 0
+    mongodb_timeout_ms: int = 5000
+    mongodb_workers: int = 16
 
 
 config = Config.parse_obj(get_driver().config)
 
-DB = pymongo.MongoClient(config.mongodb_url)["NovaBot"]
+db_seconds = metrics.Histogram("novabot_db_seconds", "MongoDB calls by collection and operation, "
+                                                     "including time queued for a worker thread",
+                               ["collection", "operation"])
+
+
+class AsyncCollection:
+    def __init__(self, database: 'AsyncDatabase', name: str):
+        self.database = database
+        self.name = name
+        self._sync: Optional[Collection] = None
+
+    @property
+    def sync(self) -> Collection:
+        if self._sync is None:
+            self._sync = self.database.sync[self.name]
+        return self._sync
+
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        return self.database.executor
+
+    def _call(self, op: str, *args, **kwargs) -> Any:
+        result = getattr(self.sync, op)(*args, **kwargs)
+        return list(result) if op in _CURSOR_OPS else result
+
+    if metrics.enabled:
+        async def _run(self, op: str, *args, **kwargs) -> Any:
+            start = time.perf_counter()
+            try:
+                return await asyncio.get_running_loop().run_in_executor(self.executor,
+                                                                        partial(self._call, op, *args, **kwargs))
+            finally:
+                db_seconds.observe(time.perf_counter() - start, self.name, op)
+    else:
+        def _run(self, op: str, *args, **kwargs) -> 'asyncio.Future[Any]':
+            return asyncio.get_running_loop().run_in_executor(self.executor, partial(self._call, op, *args, **kwargs))
+
+    async def find_one(self, *args, **kwargs) -> Optional[Dict[str, Any]]:
+        return await self._run('find_one', *args, **kwargs)
+
+    async def find(self, *args, **kwargs) -> List[Dict[str, Any]]:
+        """与 `Collection.find` 不同, 会在线程中把游标完整读出并返回列表"""
+        return await self._run('find', *args, **kwargs)
+
+    async def find_one_and_update(self, *args, **kwargs) -> Optional[Dict[str, Any]]:
+        return await self._run('find_one_and_update', *args, **kwargs)
+
+    async def count_documents(self, *args, **kwargs) -> int:
+        return await self._run('count_documents', *args, **kwargs)
+
+    async def insert_one(self, *args, **kwargs):
+        return await self._run('insert_one', *args, **kwargs)
+
+    async def insert_many(self, *args, **kwargs):
+        return await self._run('insert_many', *args, **kwargs)
+
+    async def update_one(self, *args, **kwargs):
+        return await self._run('update_one', *args, **kwargs)
+
+    async def update_many(self, *args, **kwargs):
+        return await self._run('update_many', *args, **kwargs)
+
+    async def delete_one(self, *args, **kwargs):
+        return await self._run('delete_one', *args, **kwargs)
+
+    async def delete_many(self, *args, **kwargs):
+        return await self._run('delete_many', *args, **kwargs)
+
+    async def bulk_write(self, *args, **kwargs):
+        return await self._run('bulk_write', *args, **kwargs)
+
+    async def aggregate(self, *args, **kwargs) -> List[Dict[str, Any]]:
+        return await self._run('aggregate', *args, **kwargs)
+
+    async def create_index(self, *args, **kwargs) -> str:
+        return await self._run('create_index', *args, **kwargs)
+
+    def __repr__(self):
+        return f"<AsyncCollection {self.name}>"
+
+
+class AsyncDatabase:
+    def __init__(self,
+                 database: Optional[Database] = None,
+                 executor: Optional[ThreadPoolExecutor] = None,
+                 *,
+                 factory: Optional[Callable[[], Database]] = None):
+        """
+        :param database: 数据库对象
+        :param executor: 执行数据库调用的线程池
+        :param factory: 未指定 `database` 时, 在首次使用时创建数据库对象的函数
+        """
+        if database is None and factory is None:
+            raise ValueError("Either database or factory must be given")
+        self._sync = database
+        self._factory = factory
+        self.executor = executor or ThreadPoolExecutor(max_workers=config.mongodb_workers,
+                                                       thread_name_prefix="novabot-db")
+        self._collections: Dict[str, AsyncCollection] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def sync(self) -> Database:
+        """首次访问时创建数据库对象, 多个线程同时首次访问时也只会创建一个客户端"""
+        if self._sync is None:
+            with self._lock:
+                if self._sync is None:
+                    self._sync = self._factory()
+        return self._sync
+
+    async def connect(self):
+        """在线程中创建客户端"""
+        await asyncio.get_running_loop().run_in_executor(self.executor, lambda: self.sync)
+
+    def __getitem__(self, name: str) -> AsyncCollection:
+        if (collection := self._collections.get(name)) is None:
+            collection = self._collections[name] = AsyncCollection(self, name)
+        return collection
+
+    def __repr__(self):
+        return f"<AsyncDatabase {self._sync.name if self._sync is not None else 'NovaBot (not connected)'}>"
+
+
+def _create_database() -> Database:
+    client = pymongo.MongoClient(config.mongodb_url,
+                                 maxPoolSize=config.mongodb_max_pool_size,
+                                 minPoolSize=config.mongodb_min_pool_size,
+                                 serverSelectionTimeoutMS=config.mongodb_timeout_ms,
+                                 connectTimeoutMS=config.mongodb_timeout_ms,
+                                 socketTimeoutMS=config.mongodb_timeout_ms)
+    return client["NovaBot"]
+
+
+DB = AsyncDatabase(factory=_create_database)
+
+
+@get_driver().on_startup
+async def _():
+    with timed("startup", "mongo client"):
+        await DB.connect()
+
 
-__all__ = ['DB']
+__all__ = ['DB', 'AsyncDatabase', 'AsyncCollection']
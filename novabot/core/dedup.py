@@ -0,0 +1,210 @@
+"""
+多个账号所在群的事件去重
+
+同一个群里有多个 Bot 账号时, 每个账号都会收到同一条消息. 事件预处理时 (早于 `run_preprocessor` 与所有服务的规则)
+为每条群消息计算一个键, 同一个键只由选出的一个账号处理, 其他账号收到的副本直接忽略:
+- 键默认为 (群号, 发送者, 消息内容的哈希, 时间段), 协议端在各账号间共用 message_id 时可以设置 `EVENT_DEDUP_KEY=message_id`
+- 键保存在有上限的过期集合中; 前后相邻的时间段也会检查, 副本的时间跨过时间段的边界也能识别
+- 处理的账号由 `EVENT_DEDUP_ELECTION` 选出: `first` 最先收到的账号, `lowest` self_id 最小的账号,
+  `hash` 按群号散列到群内的账号, `least_loaded` 近期处理的事件最少的账号
+- 群内的账号来自各账号的群列表, 在连接时与每 `EVENT_DEDUP_REFRESH` 秒刷新, 收到的消息与入群 / 退群通知也会更新
+
+`lowest` 与 `hash` 只取决于群内的账号, 集群模式下各 worker 也会选出同一个账号;
+`first` 与 `least_loaded` 取决于本进程收到的副本, 只在同一个 worker 内去重
+"""
+
+import math
+import time
+from collections import defaultdict
+from typing import Dict, Set, Tuple, List, Hashable, Iterable, Literal
+
+from nonebot import get_driver, require
+from nonebot.adapters.onebot.v11 import (
+    Bot,
+    Event,
+    GroupMessageEvent,
+    GroupIncreaseNoticeEvent,
+    GroupDecreaseNoticeEvent,
+    ActionFailed,
+    NetworkError)
+from nonebot.exception import IgnoredException
+from nonebot.log import logger
+from nonebot.message import event_preprocessor
+from pydantic import BaseModel, Extra
+
+from . import metrics
+from .cluster import get_bots
+from .utils import TTLCache
+
+require("nonebot_plugin_apscheduler")
+from nonebot_plugin_apscheduler import scheduler  # noqa: E402
+
+
+class Config(BaseModel, extra=Extra.ignore):
+    event_dedup_enabled: bool = True
+    event_dedup_key: Literal['content', 'message_id'] = 'content'
+    event_dedup_election: Literal['first', 'lowest', 'hash', 'least_loaded'] = 'hash'
+    event_dedup_bucket: float = 5
+    event_dedup_size: int = 10000
+    event_dedup_refresh: float = 600
+    event_dedup_load_window: float = 60
+
+
+config = Config.parse_obj(get_driver().config)
+driver = get_driver()
+
+
+class GroupMembers:
+    """每个群中的 Bot 账号"""
+
+    def __init__(self):
+        self._groups: Dict[int, Set[str]] = defaultdict(set)
+        self._bots: Dict[str, Set[int]] = {}
+
+    def __len__(self) -> int:
+        return len(self._bots)
+
+    def bots(self) -> List[str]:
+        return list(self._bots)
+
+    def get(self, group_id: int) -> Set[str]:
+        return self._groups.get(group_id, set())
+
+    def add(self, self_id: str, group_id: int):
+        self._bots.setdefault(self_id, set()).add(group_id)
+        self._groups[group_id].add(self_id)
+
+    def discard(self, self_id: str, group_id: int):
+        self._bots.get(self_id, set()).discard(group_id)
+        if (members := self._groups.get(group_id)) is not None:
+            members.discard(self_id)
+            if not members:
+                del self._groups[group_id]
+
+    def update(self, self_id: str, group_ids: Iterable[int]):
+        """以群列表覆盖 `self_id` 所在的群"""
+        self.remove(self_id)
+        for group_id in group_ids:
+            self.add(self_id, group_id)
+
+    def remove(self, self_id: str):
+        for group_id in self._bots.pop(self_id, set()):
+            self.discard(self_id, group_id)
+
+
+class Load:
+    """按 `window` 秒指数衰减的事件计数"""
+
+    def __init__(self, window: float):
+        self.window = window
+        self._values: Dict[str, Tuple[float, float]] = {}  # self_id: (value, updated)
+
+    def get(self, self_id: str, now: float) -> float:
+        value, updated = self._values.get(self_id, (0, now))
+        return value * math.exp((updated - now) / self.window)
+
+    def add(self, self_id: str, now: float):
+        self._values[self_id] = (self.get(self_id, now) + 1, now)
+
+
+class EventDedup:
+    def __init__(self,
+                 key: Literal['content', 'message_id'],
+                 election: Literal['first', 'lowest', 'hash', 'least_loaded'],
+                 bucket: float,
+                 size: int,
+                 load_window: float):
+        self.key = key
+        self.election = election
+        self.bucket = bucket
+        self.members = GroupMembers()
+        self.load = Load(load_window)
+        self._seen: TTLCache[Hashable, str] = TTLCache(size, bucket * 3)  # key: self_id of the handler
+
+    def keys(self, event: GroupMessageEvent) -> List[Hashable]:
+        """事件的键, 第一个为记录时使用的键"""
+        if self.key == 'message_id':
+            return [(event.group_id, event.message_id)]
+        content = hash(tuple((segment.type, tuple(sorted((k, str(v)) for k, v in segment.data.items()
+                                                           if k != 'url')))  # Image urls differ per account
+                             for segment in event.original_message))
+        bucket = int(event.time // self.bucket)
+        return [(event.group_id, event.user_id, content, bucket + offset) for offset in (0, -1, 1)]
+
+    def elect(self, group_id: int, candidates: List[str], now: float) -> str:
+        """从按 self_id 排序的账号中选出处理事件的账号"""
+        if self.election == 'lowest':
+            return candidates[0]
+        if self.election == 'hash':
+            return candidates[group_id % len(candidates)]
+        return min(candidates, key=lambda self_id: self.load.get(self_id, now))
+
+    def accept(self, self_id: str, event: GroupMessageEvent) -> bool:
+        """`self_id` 是否应当处理这个事件, 同一事件的所有副本中只有一个返回 `True`"""
+        self.members.add(self_id, event.group_id)
+        keys = self.keys(event)
+        handler = next((handler for key in keys if (handler := self._seen.get(key)) is not None), None)
+        now = time.monotonic()
+        if handler is None:
+            candidates = sorted(self.members.get(event.group_id), key=int)
+            handler = self_id if self.election == 'first' or len(candidates) == 1 \
+                else self.elect(event.group_id, candidates, now)
+            self._seen.set(keys[0], handler)
+        if handler != self_id:
+            return False
+        self.load.add(self_id, now)
+        return True
+
+
+event_dedup = EventDedup(config.event_dedup_key,
+                         config.event_dedup_election,
+                         config.event_dedup_bucket,
+                         config.event_dedup_size,
+                         config.event_dedup_load_window)
+
+duplicates = metrics.Counter("novabot_event_duplicates_total", "Group messages ignored as copies from another account")
+
+
+async def refresh(bot: Bot):
+    try:
+        groups = await bot.get_group_list()
+    except (ActionFailed, NetworkError) as e:
+        logger.warning(f"Failed to get group list of {bot.self_id}: {e!r}")
+        return
+    event_dedup.members.update(bot.self_id, (group["group_id"] for group in groups))
+
+
+async def refresh_all():
+    bots = get_bots()
+    for self_id in [self_id for self_id in event_dedup.members.bots() if self_id not in bots]:
+        event_dedup.members.remove(self_id)
+    for bot in bots.values():
+        await refresh(bot)
+
+
+if config.event_dedup_enabled:
+    @event_preprocessor
+    async def _(bot: Bot, event: Event):
+        if isinstance(event, GroupMessageEvent):
+            if len(event_dedup.members) > 1 and not event_dedup.accept(bot.self_id, event):
+                if metrics.enabled:
+                    duplicates.inc()
+                raise IgnoredException("Handled by another account")
+            event_dedup.members.add(bot.self_id, event.group_id)
+        elif isinstance(event, GroupIncreaseNoticeEvent) and event.user_id == event.self_id:
+            event_dedup.members.add(bot.self_id, event.group_id)
+        elif isinstance(event, GroupDecreaseNoticeEvent) and event.user_id == event.self_id:
+            event_dedup.members.discard(bot.self_id, event.group_id)
+
+    driver.on_bot_connect(refresh)
+
+    @driver.on_bot_disconnect
+    async def _(bot: Bot):
+        event_dedup.members.remove(bot.self_id)
+
+    @driver.on_startup
+    async def _():
+        scheduler.add_job(refresh_all, "interval", seconds=config.event_dedup_refresh,
+                          id="event_dedup_refresh", replace_existing=True)
+
+__all__ = ["EventDedup", "GroupMembers", "event_dedup"]
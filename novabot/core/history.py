@@ -0,0 +1,114 @@
+"""
+近期群消息记录
+
+按 (self_id, group_id) 保存最近 `MESSAGE_HISTORY_SIZE` 条消息的 message_id 与发送者, 超出时淘汰最早的消息
+- Bot 通过 `send_msg` / `send_group_msg` / `send_group_forward_msg` 发出的消息在 API 调用成功后记录
+- 收到的群消息在事件预处理时记录, 撤回通知会移除对应的消息
+- 按发送者建有索引, 查询某人的消息不需要遍历整个群的记录
+"""
+
+from collections import OrderedDict
+from itertools import islice
+from typing import Dict, List, Optional, Tuple, Any, Iterable
+
+from nonebot import get_driver
+from nonebot.adapters import Bot as BaseBot
+from nonebot.adapters.onebot.v11 import Bot, Event, GroupMessageEvent, GroupRecallNoticeEvent
+from nonebot.message import event_preprocessor
+from pydantic import BaseModel, Extra
+
+
+class Config(BaseModel, extra=Extra.ignore):
+    message_history_size: int = 200
+
+
+config = Config.parse_obj(get_driver().config)
+
+SEND_APIS = {"send_msg", "send_group_msg", "send_group_forward_msg"}
+
+
+class GroupHistory:
+    __slots__ = ("size", "messages", "senders")
+
+    def __init__(self, size: int):
+        self.size = size
+        self.messages: 'OrderedDict[int, int]' = OrderedDict()  # message_id: user_id, oldest first
+        self.senders: Dict[int, Dict[int, None]] = {}  # user_id: ordered set of message_id
+
+    def add(self, message_id: int, user_id: int):
+        if message_id in self.messages:
+            return
+        self.messages[message_id] = user_id
+        self.senders.setdefault(user_id, {})[message_id] = None
+        while len(self.messages) > self.size:
+            self._remove(*self.messages.popitem(last=False))
+
+    def discard(self, message_id: int):
+        if (user_id := self.messages.pop(message_id, None)) is not None:
+            self._remove(message_id, user_id)
+
+    def _remove(self, message_id: int, user_id: int):
+        sent = self.senders[user_id]
+        del sent[message_id]
+        if not sent:
+            del self.senders[user_id]
+
+    def last(self, count: int, user_id: Optional[int] = None) -> List[int]:
+        """最近的 `count` 条消息, 新的在前"""
+        messages = self.messages if user_id is None else self.senders.get(user_id, {})
+        return list(islice(reversed(messages), count))
+
+    def since(self, message_id: int) -> Optional[List[int]]:
+        """`message_id` 及之后的所有消息, 新的在前, `message_id` 不在记录中时返回 `None`"""
+        if message_id not in self.messages:
+            return None
+        found = []
+        for current in reversed(self.messages):
+            found.append(current)
+            if current == message_id:
+                return found
+        return found
+
+
+class MessageHistory:
+    def __init__(self, size: int):
+        self.size = size
+        self._groups: Dict[Tuple[str, int], GroupHistory] = {}
+
+    def group(self, self_id: str, group_id: int) -> GroupHistory:
+        if (history := self._groups.get((self_id, group_id))) is None:
+            history = self._groups[(self_id, group_id)] = GroupHistory(self.size)
+        return history
+
+    def record(self, self_id: str, group_id: int, message_id: int, user_id: int):
+        self.group(self_id, group_id).add(message_id, user_id)
+
+    def discard(self, self_id: str, group_id: int, message_ids: Iterable[int]):
+        if (history := self._groups.get((self_id, group_id))) is not None:
+            for message_id in message_ids:
+                history.discard(message_id)
+
+
+message_history = MessageHistory(config.message_history_size)
+
+
+@Bot.on_called_api
+async def _(bot: BaseBot, exception: Optional[Exception], api: str, data: Dict[str, Any], result: Any):
+    if exception is not None or api not in SEND_APIS or not isinstance(result, dict):
+        return
+    if (message_id := result.get("message_id")) is None or not (group_id := data.get("group_id")):
+        return
+    if api == "send_msg" and data.get("message_type", "group") != "group":
+        return
+    message_history.record(bot.self_id, int(group_id), int(message_id), int(bot.self_id))
+
+
+@event_preprocessor
+async def _(event: Event):
+    if isinstance(event, GroupMessageEvent):
+        message_history.record(str(event.self_id), event.group_id, event.message_id, event.user_id)
+    elif isinstance(event, GroupRecallNoticeEvent):
+        message_history.discard(str(event.self_id), event.group_id, [event.message_id])
+
+
+__all__ = ["message_history", "MessageHistory", "GroupHistory"]
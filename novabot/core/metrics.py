@@ -0,0 +1,180 @@
+"""
+运行时指标
+
+计数器与直方图保存在内存中, 由 `setup()` 以 Prometheus 文本格式在 `METRICS_PATH` (默认 `/metrics`) 上提供
+- `METRICS_ENABLED=false` 时 `timed` 直接返回原函数, 各模块也不会安装任何计时代码, 没有额外开销
+- 标签值按位置传入, 顺序与 `labelnames` 一致
+"""
+
+import time
+from bisect import bisect_left
+from functools import wraps
+from typing import Dict, Tuple, List, Callable, Awaitable, TypeVar, Sequence
+
+from nonebot import get_driver
+from nonebot.drivers import ReverseDriver, HTTPServerSetup, Request, Response, URL
+from nonebot.log import logger
+from pydantic import BaseModel, Extra
+
+T = TypeVar('T')
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Config(BaseModel, extra=Extra.ignore):
+    metrics_enabled: bool = True
+    metrics_path: str = "/metrics"
+
+
+config = Config.parse_obj(get_driver().config)
+enabled = config.metrics_enabled
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names: Sequence[str], values: Sequence[str], extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return f"{{{','.join(pairs)}}}" if pairs else ''
+
+
+def _number(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class Metric:
+    type = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        registry.append(self)
+
+    def samples(self) -> List[str]:
+        raise NotImplementedError
+
+    def expose(self) -> str:
+        return "\n".join([f"# HELP {self.name} {self.documentation}",
+                          f"# TYPE {self.name} {self.type}",
+                          *self.samples()])
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, *labels: str, amount: float = 1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def samples(self) -> List[str]:
+        return [f"{self.name}{_labels(self.labelnames, labels)} {_number(value)}"
+                for labels, value in self._values.items()]
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self,
+                 name: str,
+                 documentation: str,
+                 labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._values: Dict[Tuple[str, ...], List[float]] = {}  # labels: [count per bucket..., +Inf, sum]
+
+    def observe(self, value: float, *labels: str):
+        if (values := self._values.get(labels)) is None:
+            values = self._values[labels] = [0] * (len(self.buckets) + 2)
+        values[bisect_left(self.buckets, value)] += 1
+        values[-1] += value
+
+    def samples(self) -> List[str]:
+        lines = []
+        for labels, values in self._values.items():
+            cumulative = 0
+            for bound, count in zip((*self.buckets, '+Inf'), values):
+                cumulative += count
+                le = 'le="+Inf"' if bound == '+Inf' else f'le="{_number(bound)}"'
+                lines.append(f"{self.name}_bucket{_labels(self.labelnames, labels, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, labels)} {_number(values[-1])}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, labels)} {cumulative}")
+        return lines
+
+
+class Gauge(Metric):
+    """读取时才调用 `collect` 计算的值, `collect` 返回 {标签值: 数值}"""
+    type = 'gauge'
+
+    def __init__(self,
+                 name: str,
+                 documentation: str,
+                 labelnames: Sequence[str] = (),
+                 collect: Callable[[], Dict[Tuple[str, ...], float]] = dict,
+                 type_: str = 'gauge'):
+        super().__init__(name, documentation, labelnames)
+        self.collect = collect
+        self.type = type_
+
+    def samples(self) -> List[str]:
+        return [f"{self.name}{_labels(self.labelnames, labels)} {_number(value)}"
+                for labels, value in self.collect().items()]
+
+
+registry: List[Metric] = []
+
+
+def timed(histogram: Histogram, *labels: str) -> Callable[[Callable[..., Awaitable[T]]],
+                                                           Callable[..., Awaitable[T]]]:
+    """记录协程函数耗时的装饰器, 指标关闭时返回原函数; 保留原函数的签名, 可以用于 `Rule`"""
+
+    def decorator(func: Callable[..., Awaitable[T]]) -> Callable[..., Awaitable[T]]:
+        if not enabled:
+            return func
+
+        @wraps(func)
+        async def wrapper(*args, **kwargs) -> T:
+            start = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - start, *labels)
+
+        return wrapper
+
+    return decorator
+
+
+def expose() -> str:
+    blocks = []
+    for metric in registry:
+        try:
+            blocks.append(metric.expose())
+        except Exception as e:
+            logger.opt(exception=e).warning(f"Failed to collect metric {metric.name}")
+    return "\n".join(blocks) + "\n"
+
+
+async def _handle(request: Request) -> Response:
+    return Response(200, headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}, content=expose())
+
+
+def setup():
+    """在驱动器的 ASGI 应用上注册 `METRICS_PATH`, 指标关闭或驱动器不是反向驱动器时不做任何事"""
+    if not enabled:
+        return
+    driver = get_driver()
+    if not isinstance(driver, ReverseDriver):
+        logger.warning(f"Driver {driver.type} cannot serve {config.metrics_path}, metrics disabled")
+        return
+    driver.setup_http_server(HTTPServerSetup(URL(config.metrics_path), "GET", "metrics", _handle))
+
+
+__all__ = ["enabled", "Counter", "Histogram", "Gauge", "Metric", "timed", "expose", "setup", "registry"]
@@ -0,0 +1,213 @@
+"""
+HTML 转图片的渲染服务
+
+渲染结果以输入 (HTML, 模板, 视口, 图片格式等) 的哈希为键缓存:
+- 内存中的 LRU, 以总字节数 `RENDER_CACHE_MEMORY_MB` 为上限
+- 磁盘上的 `data/render_cache/`, 以总字节数 `RENDER_CACHE_DISK_MB` 为上限, 超出时淘汰最久未访问的文件
+同一时刻相同输入的多个请求只会渲染一次; 设置了 `RENDER_WORKERS` 时由渲染进程完成渲染 (见 `render_pool.py`)
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from string import Template
+from typing import Optional, Literal, Tuple, Dict, Any
+
+from nonebot import get_driver
+from pydantic import BaseModel, Extra
+
+from . import metrics
+from .Playwright import get_page_pool
+from .render_pool import render_pool
+
+
+class Config(BaseModel, extra=Extra.ignore):
+    render_cache_memory_mb: float = 64
+    render_cache_disk_mb: float = 512
+    render_cache_path: Path = Path.cwd() / "data" / "render_cache"
+
+
+config = Config.parse_obj(get_driver().config)
+
+
+class MemoryCache:
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._data: 'OrderedDict[str, bytes]' = OrderedDict()
+
+    def get(self, key: str) -> Optional[bytes]:
+        if (data := self._data.get(key)) is not None:
+            self._data.move_to_end(key)
+        return data
+
+    def set(self, key: str, data: bytes):
+        if len(data) > self.max_bytes:
+            return
+        if (old := self._data.pop(key, None)) is not None:
+            self.size -= len(old)
+        self._data[key] = data
+        self.size += len(data)
+        while self.size > self.max_bytes:
+            self.size -= len(self._data.popitem(last=False)[1])
+
+
+class DiskCache:
+    def __init__(self, path: Path, max_bytes: int):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._index: 'Optional[OrderedDict[str, int]]' = None  # name: size, least recently used first
+        self._lock = threading.Lock()  # `get` / `set` run in worker threads
+
+    def _load_index(self) -> 'OrderedDict[str, int]':
+        if self._index is None:
+            self.path.mkdir(parents=True, exist_ok=True)
+            files = sorted(os.scandir(self.path), key=lambda x: x.stat().st_atime)
+            self._index = OrderedDict((file.name, file.stat().st_size) for file in files
+                                      if file.is_file() and not file.name.startswith('.'))
+            self.size = sum(self._index.values())
+        return self._index
+
+    def get(self, name: str) -> Optional[bytes]:
+        with self._lock:
+            index = self._load_index()
+            if name not in index:
+                return None
+            try:
+                data = (self.path / name).read_bytes()
+            except FileNotFoundError:
+                self.size -= index.pop(name)
+                return None
+            index.move_to_end(name)
+            return data
+
+    def set(self, name: str, data: bytes):
+        if len(data) > self.max_bytes:
+            return
+        with self._lock:
+            index = self._load_index()
+            tmp = self.path / f".{name}.tmp"
+            tmp.write_bytes(data)
+            tmp.replace(self.path / name)
+            self.size += len(data) - index.pop(name, 0)
+            index[name] = len(data)
+            while self.size > self.max_bytes:
+                old, size = index.popitem(last=False)
+                self.size -= size
+                (self.path / old).unlink(missing_ok=True)
+
+
+class RenderCache:
+    def __init__(self, memory_bytes: int, disk_path: Path, disk_bytes: int):
+        self.memory = MemoryCache(memory_bytes)
+        self.disk = DiskCache(disk_path, disk_bytes)
+        self._inflight: Dict[str, 'asyncio.Task[bytes]'] = {}
+        self._waiters: Dict[str, int] = {}
+        self.stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "coalesced": 0}
+
+    @staticmethod
+    def key(**kwargs: Any) -> str:
+        return hashlib.sha256(json.dumps(kwargs, sort_keys=True, ensure_ascii=False).encode()).hexdigest()
+
+    async def _load(self, key: str, ext: str, render) -> bytes:
+        name = f"{key}.{ext}"
+        if (data := await asyncio.to_thread(self.disk.get, name)) is not None:
+            self.stats["disk_hits"] += 1
+        else:
+            self.stats["misses"] += 1
+            data = await render()
+            await asyncio.to_thread(self.disk.set, name, data)
+        self.memory.set(key, data)
+        return data
+
+    def _done(self, key: str, task: 'asyncio.Task[bytes]'):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+            del self._waiters[key]
+
+    async def get_or_render(self, key: str, ext: str, render) -> bytes:
+        """
+        按 内存 -> 磁盘 -> 渲染 的顺序获取结果, 相同 `key` 的并发请求共享同一次渲染
+        渲染在独立的任务中进行, 某个请求被取消不影响其他请求; 所有请求都被取消时才取消渲染
+        """
+        if (data := self.memory.get(key)) is not None:
+            self.stats["memory_hits"] += 1
+            return data
+        if (task := self._inflight.get(key)) is not None:
+            self.stats["coalesced"] += 1
+        else:
+            task = self._inflight[key] = asyncio.create_task(self._load(key, ext, render))
+            task.add_done_callback(lambda x: self._done(key, x))
+            self._waiters[key] = 0
+        self._waiters[key] += 1
+        try:
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if self._inflight.get(key) is task:
+                self._waiters[key] -= 1
+                if not self._waiters[key]:
+                    # Nobody is waiting any more, later requests start a new render
+                    self._done(key, task)
+                    task.cancel()
+            raise
+
+
+render_seconds = metrics.Histogram("novabot_render_seconds", "HTML renders that missed the cache", ["browser"])
+render_cache_events = metrics.Gauge("novabot_render_cache_total", "Render cache lookups by result", ["result"],
+                                    collect=lambda: {(name,): value for name, value in render_cache.stats.items()},
+                                    type_="counter")
+
+render_cache = RenderCache(int(config.render_cache_memory_mb * 1024 * 1024),
+                           config.render_cache_path,
+                           int(config.render_cache_disk_mb * 1024 * 1024))
+
+
+async def html_to_image(html: str,
+                        *,
+                        template: Optional[str] = None,
+                        viewport: Tuple[int, int] = (800, 600),
+                        type_: Literal['png', 'jpeg'] = 'png',
+                        quality: Optional[int] = None,
+                        full_page: bool = True,
+                        browser: Literal['chromium', 'firefox'] = 'chromium',
+                        cache: bool = True,
+                        **params: Any) -> bytes:
+    """
+    将 HTML 渲染为图片
+    :param html: 要渲染的 HTML, 指定了 `template` 时作为模板中的 `$content`
+    :param template: `string.Template` 格式的模板, 可以使用 `$content` 以及 `params` 中的变量
+    :param viewport: 视口大小 (宽, 高)
+    :param type_: 图片格式
+    :param quality: `jpeg` 的图片质量
+    :param full_page: 是否截取整个页面
+    :param browser: 使用的浏览器
+    :param cache: 是否使用缓存
+    :param params: 模板变量
+    :return: 图片的字节串
+    """
+    if template is not None:
+        html = Template(template).safe_substitute(params, content=html)
+
+    @metrics.timed(render_seconds, browser)
+    async def render() -> bytes:
+        if render_pool.enabled:
+            return await render_pool.render(html, viewport=viewport, type_=type_, quality=quality,
+                                            full_page=full_page, browser=browser)
+        async with (await get_page_pool(browser)).page() as page:
+            await page.set_viewport_size({"width": viewport[0], "height": viewport[1]})
+            await page.set_content(html, wait_until="networkidle")
+            return await page.screenshot(type=type_, quality=quality, full_page=full_page)
+
+    if not cache:
+        return await render()
+    key = RenderCache.key(html=html, viewport=list(viewport), type=type_,
+                          quality=quality, full_page=full_page, browser=browser)
+    return await render_cache.get_or_render(key, type_, render)
+
+
+__all__ = ["html_to_image", "render_cache", "RenderCache"]
@@ -0,0 +1,245 @@
+"""
+进程外的渲染
+
+设置 `RENDER_WORKERS` 为正数时, 启动时创建对应数量的渲染进程 (见 `render_worker.py`), `html_to_image` 的渲染交给它们完成,
+浏览器不再运行在 Bot 的事件循环中:
+- 与渲染进程之间通过管道传递请求, 截图经由共享内存传回
+- 请求交给待处理请求最少的进程, 每个进程同时渲染至多 `RENDER_WORKER_PAGES` 个页面
+- 每 `RENDER_WORKER_HEALTH_INTERVAL` 秒检查一次所有进程, 退出或没有响应的进程, 以及请求超时的进程会被重启
+"""
+
+import asyncio
+import itertools
+import json
+import struct
+import sys
+from multiprocessing import shared_memory
+from pathlib import Path
+from typing import Dict, Optional, Any, Literal, Tuple, Set
+
+from nonebot import get_driver
+from nonebot.log import logger
+from pydantic import BaseModel, Extra
+
+from . import metrics
+from .Playwright import ensure_installed
+
+
+class Config(BaseModel, extra=Extra.ignore):
+    render_workers: int = 0
+    render_worker_pages: int = 2
+    render_worker_max_uses: int = 50
+    render_worker_timeout: float = 60
+    render_worker_health_interval: float = 15
+
+
+config = Config.parse_obj(get_driver().config)
+driver = get_driver()
+
+HEADER = struct.Struct(">I")
+WORKER_SCRIPT = Path(__file__).with_name("render_worker.py")
+
+
+class RenderWorkerError(RuntimeError):
+    pass
+
+
+def _take(name: str, size: int) -> bytes:
+    """读出并释放渲染进程创建的共享内存"""
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        return bytes(shm.buf[:size])
+    finally:
+        shm.close()
+        shm.unlink()
+
+
+class RenderWorker:
+    def __init__(self, index: int, pages: int, max_uses: int):
+        self.index = index
+        self.pages = pages
+        self.max_uses = max_uses
+        self.process: Optional[asyncio.subprocess.Process] = None
+        self.restarting = False
+        self._ids = itertools.count()
+        self._pending: Dict[int, asyncio.Future] = {}
+        self._reader: Optional[asyncio.Task] = None
+
+    @property
+    def alive(self) -> bool:
+        return self.process is not None and self.process.returncode is None and not self.restarting
+
+    @property
+    def load(self) -> int:
+        return len(self._pending)
+
+    async def start(self):
+        self.process = await asyncio.create_subprocess_exec(
+            sys.executable, str(WORKER_SCRIPT), "--pages", str(self.pages), "--max-uses", str(self.max_uses),
+            stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE)
+        self._reader = asyncio.create_task(self._read(self.process))
+        logger.info(f"Render worker {self.index} started, pid {self.process.pid}")
+
+    async def _read(self, process: asyncio.subprocess.Process):
+        try:
+            while True:
+                header = await process.stdout.readexactly(HEADER.size)
+                response = json.loads(await process.stdout.readexactly(HEADER.unpack(header)[0]))
+                result: Any = response
+                if "shm" in response:  # Read even if the request has timed out, so that the memory is released
+                    try:
+                        result = _take(response["shm"], response["size"])
+                    except FileNotFoundError:
+                        response["error"] = f"Shared memory {response['shm']} is gone"
+                future = self._pending.pop(response["id"], None)
+                if future is None or future.done():
+                    continue
+                if "error" in response:
+                    future.set_exception(RenderWorkerError(response["error"]))
+                else:
+                    future.set_result(result)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            pending, self._pending = self._pending, {}
+            for future in pending.values():
+                if not future.done():
+                    future.set_exception(RenderWorkerError(f"Render worker {self.index} exited"))
+
+    async def request(self, payload: Dict[str, Any], timeout: float) -> Any:
+        """发送请求并等待响应, 超时抛出 `asyncio.TimeoutError`"""
+        if not self.alive:
+            raise RenderWorkerError(f"Render worker {self.index} is not running")
+        request_id = next(self._ids)
+        future = self._pending[request_id] = asyncio.get_running_loop().create_future()
+        try:
+            body = json.dumps({**payload, "id": request_id}).encode()
+            self.process.stdin.write(HEADER.pack(len(body)) + body)
+            await self.process.stdin.drain()
+            return await asyncio.wait_for(future, timeout)
+        except ConnectionError as e:
+            raise RenderWorkerError(f"Render worker {self.index} exited") from e
+        finally:
+            self._pending.pop(request_id, None)
+
+    async def stop(self):
+        if self.process is None:
+            return
+        if self.process.returncode is None:
+            self.process.stdin.close()  # The worker closes its browsers and exits on EOF
+            try:
+                await asyncio.wait_for(self.process.wait(), 5)
+            except asyncio.TimeoutError:
+                self.process.kill()
+                await self.process.wait()
+        if self._reader:
+            await self._reader
+        self.process = None
+
+
+class RenderPool:
+    def __init__(self, size: int, pages: int, max_uses: int, timeout: float, health_interval: float):
+        self.timeout = timeout
+        self.health_interval = health_interval
+        self.workers = [RenderWorker(index, pages, max_uses) for index in range(size)]
+        self._task: Optional[asyncio.Task] = None
+        self._background: Set[asyncio.Task] = set()
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.workers)
+
+    async def start(self):
+        await asyncio.gather(*(worker.start() for worker in self.workers))
+        self._task = asyncio.create_task(self._health_loop())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        await asyncio.gather(*(worker.stop() for worker in self.workers))
+
+    async def render(self,
+                     html: str,
+                     *,
+                     viewport: Tuple[int, int],
+                     type_: Literal['png', 'jpeg'],
+                     quality: Optional[int],
+                     full_page: bool,
+                     browser: Literal['chromium', 'firefox']) -> bytes:
+        """交给待处理请求最少的渲染进程, 参数与 `html_to_image` 相同"""
+        await ensure_installed(browser)
+        worker = min((worker for worker in self.workers if worker.alive), key=lambda x: x.load, default=None)
+        if worker is None:
+            raise RenderWorkerError("No render worker is running")
+        try:
+            return await worker.request({"op": "render", "html": html, "viewport": list(viewport), "type": type_,
+                                         "quality": quality, "full_page": full_page, "browser": browser},
+                                        self.timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Render worker {worker.index} timed out, restarting")
+            self._restart_later(worker, "timeout")
+            raise
+
+    def _restart_later(self, worker: RenderWorker, reason: str):
+        task = asyncio.create_task(self._restart(worker, reason))
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+
+    async def _restart(self, worker: RenderWorker, reason: str):
+        if worker.restarting:
+            return
+        worker.restarting = True
+        if metrics.enabled:
+            restarts.inc(reason)
+        try:
+            await worker.stop()
+            await worker.start()
+        except Exception as e:
+            logger.opt(exception=e).error(f"Failed to restart render worker {worker.index}")
+        finally:
+            worker.restarting = False
+
+    async def _check(self, worker: RenderWorker):
+        if worker.restarting:
+            return
+        if not worker.alive:
+            logger.warning(f"Render worker {worker.index} exited, restarting")
+            await self._restart(worker, "exited")
+            return
+        try:
+            await worker.request({"op": "ping"}, min(self.timeout, self.health_interval))
+        except (asyncio.TimeoutError, RenderWorkerError):
+            logger.warning(f"Render worker {worker.index} is not responding, restarting")
+            await self._restart(worker, "unresponsive")
+
+    async def _health_loop(self):
+        while True:
+            await asyncio.sleep(self.health_interval)
+            await asyncio.gather(*(self._check(worker) for worker in self.workers))
+
+
+render_pool = RenderPool(config.render_workers,
+                         config.render_worker_pages,
+                         config.render_worker_max_uses,
+                         config.render_worker_timeout,
+                         config.render_worker_health_interval)
+
+restarts = metrics.Counter("novabot_render_worker_restarts_total", "Render worker restarts", ["reason"])
+metrics.Gauge("novabot_render_worker_pending", "Requests waiting for each render worker", ["worker"],
+              collect=lambda: {(str(worker.index),): worker.load for worker in render_pool.workers})
+
+
+@driver.on_startup
+async def _():
+    if render_pool.enabled:
+        await render_pool.start()
+
+
+@driver.on_shutdown
+async def _():
+    if render_pool.enabled:
+        await render_pool.stop()
+
+
+__all__ = ["RenderPool", "RenderWorker", "RenderWorkerError", "render_pool"]
@@ -0,0 +1,145 @@
+"""
+渲染进程
+
+由 `novabot.core.render_pool` 以脚本的方式启动, 不会导入 `novabot` 与 `nonebot`, 持有自己的 Playwright 与浏览器.
+- 请求与响应都是带 4 字节长度前缀的 JSON, 经由标准输入与标准输出传递, 以 `id` 对应, 多个请求并发处理
+- 截图写入新建的共享内存, 响应中只有共享内存的名称与长度, 由主进程读出后释放
+- 标准输入关闭 (主进程退出) 时关闭浏览器并退出
+"""
+
+import os
+import sys
+
+# Run as a script, so its own directory comes first in `sys.path`, where `types.py` would shadow the standard library
+sys.path = [path for path in sys.path if os.path.abspath(path or '.') != os.path.dirname(os.path.abspath(__file__))]
+
+import argparse  # noqa: E402
+import asyncio  # noqa: E402
+import json  # noqa: E402
+import struct  # noqa: E402
+from multiprocessing import resource_tracker, shared_memory  # noqa: E402
+from typing import Any, Dict, List, Optional  # noqa: E402
+
+from playwright.async_api import async_playwright, Browser, BrowserContext, Page, Playwright  # noqa: E402
+
+HEADER = struct.Struct(">I")
+
+
+class Renderer:
+    def __init__(self, playwright: Playwright, pages: int, max_uses: int):
+        self.playwright = playwright
+        self.max_uses = max_uses
+        self._semaphore = asyncio.Semaphore(pages)
+        self._lock = asyncio.Lock()
+        self._browsers: Dict[str, Browser] = {}
+        self._idle: Dict[str, List[List[Any]]] = {}  # browser: [[context, page, uses]]
+
+    async def _browser(self, name: str) -> Browser:
+        async with self._lock:
+            if (browser := self._browsers.get(name)) is None or not browser.is_connected():
+                browser = self._browsers[name] = await getattr(self.playwright, name).launch()
+                self._idle[name] = []
+        return browser
+
+    async def render(self, request: Dict[str, Any]) -> bytes:
+        async with self._semaphore:
+            browser = await self._browser(request["browser"])
+            idle = self._idle[request["browser"]]
+            pooled = idle.pop() if idle else None
+            if pooled is None or pooled[1].is_closed():
+                context: BrowserContext = await browser.new_context()
+                pooled = [context, await context.new_page(), 0]
+            page: Page = pooled[1]
+            done = False
+            try:
+                await page.set_viewport_size({"width": request["viewport"][0], "height": request["viewport"][1]})
+                await page.set_content(request["html"], wait_until="networkidle")
+                data = await page.screenshot(type=request["type"], quality=request["quality"],
+                                             full_page=request["full_page"])
+                done = True
+                return data
+            finally:
+                pooled[2] += 1
+                if done and pooled[2] < self.max_uses:
+                    idle.append(pooled)
+                else:
+                    await _close(pooled[0])
+
+    async def close(self):
+        for browser in self._browsers.values():
+            if browser.is_connected():
+                await browser.close()
+
+
+async def _close(context: BrowserContext):
+    try:
+        await context.close()
+    except Exception:  # Browser may be gone already
+        pass
+
+
+def _share(data: bytes) -> str:
+    """把数据写入新的共享内存, 返回其名称, 共享内存由读取的进程释放"""
+    try:
+        shm = shared_memory.SharedMemory(create=True, size=max(len(data), 1), track=False)
+    except TypeError:  # Before Python 3.13
+        shm = shared_memory.SharedMemory(create=True, size=max(len(data), 1))
+        resource_tracker.unregister(shm._name, "shared_memory")
+    shm.buf[:len(data)] = data
+    name = shm.name
+    shm.close()
+    return name
+
+
+async def main(pages: int, max_uses: int):
+    loop = asyncio.get_running_loop()
+    output = os.fdopen(os.dup(1), "wb")
+    os.dup2(2, 1)  # Anything else printed goes to stderr, keeping stdout for responses
+    reader = asyncio.StreamReader()
+    await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), sys.stdin.buffer)
+    transport, protocol = await loop.connect_write_pipe(asyncio.streams.FlowControlMixin, output)
+    writer = asyncio.StreamWriter(transport, protocol, None, loop)
+    tasks = set()
+
+    async with async_playwright() as playwright:
+        renderer = Renderer(playwright, pages, max_uses)
+
+        async def handle(request: Dict[str, Any]):
+            response: Dict[str, Any] = {"id": request["id"]}
+            try:
+                if request["op"] == "ping":
+                    response["pending"] = len(tasks)
+                elif request["op"] == "render":
+                    data = await renderer.render(request)
+                    response.update(shm=_share(data), size=len(data))
+                else:
+                    raise ValueError(f"Unknown op {request['op']}")
+            except Exception as e:
+                response["error"] = repr(e)
+            body = json.dumps(response).encode()
+            writer.write(HEADER.pack(len(body)) + body)
+            await writer.drain()
+
+        try:
+            while True:
+                try:
+                    header = await reader.readexactly(HEADER.size)
+                    request = json.loads(await reader.readexactly(HEADER.unpack(header)[0]))
+                except asyncio.IncompleteReadError:
+                    break
+                tasks.add(task := asyncio.create_task(handle(request)))
+                task.add_done_callback(tasks.discard)
+        finally:
+            await renderer.close()
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Headless render worker for novabot")
+    parser.add_argument("--pages", type=int, default=2, help="pages rendering at the same time")
+    parser.add_argument("--max-uses", type=int, default=50, help="renders before a page is recreated")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    asyncio.run(main(args.pages, args.max_uses))
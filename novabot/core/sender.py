@@ -0,0 +1,241 @@
+"""
+消息发送调度
+
+所有发送消息的 API 调用都要先从两个令牌桶中各取得一个令牌: 每个 Bot 一个, 每个 Bot 的每个群 / 私聊对象一个
+- 普通的发送 (例如 `matcher.send`) 在 `on_calling_api` 钩子中以 `Priority.NORMAL` 排队
+- `send` / `post` 可以指定优先级, 等待的时限与去重的键; 发往同一个群 / 私聊对象的更高优先级的消息在等待时,
+  低优先级的消息不会发出
+- 同一个键对同一个人在 `SENDER_DEDUP_WINDOW` 秒内只会发送一次, 用于 cd / limit 等提示; 以实际发出的时间计算,
+  等待超时而没有发出的提示不会影响之后的提示
+"""
+
+import asyncio
+import contextvars
+import time
+from enum import IntEnum
+from typing import Any, Dict, List, Optional, Hashable, Set, Tuple
+
+from nonebot import get_driver
+from nonebot.adapters import Bot as BaseBot, MessageTemplate
+from nonebot.adapters.onebot.v11 import Bot, Event, Message
+from nonebot.log import logger
+from pydantic import BaseModel, Extra
+
+from novabot.core import metrics
+from novabot.core.service.limiter import RateLimiter
+from novabot.core.service.model import RateLimitModel
+from novabot.core.types import TypeMessage
+from novabot.core.utils import TTLCache
+
+
+class Config(BaseModel, extra=Extra.ignore):
+    sender_group_calls: int = 5
+    sender_group_period: float = 5
+    sender_bot_calls: int = 20
+    sender_bot_period: float = 10
+    sender_dedup_window: float = 30
+    sender_prompt_ttl: float = 10
+
+
+config = Config.parse_obj(get_driver().config)
+
+SEND_APIS = {"send_msg", "send_group_msg", "send_private_msg", "send_group_forward_msg", "send_private_forward_msg"}
+
+
+class Priority(IntEnum):
+    HIGH = 0
+    NORMAL = 1
+    LOW = 2
+
+
+class Waiter:
+    __slots__ = ('self_id', 'target', 'future', 'deadline')
+
+    def __init__(self, self_id: str, target: str, future: 'asyncio.Future[bool]', deadline: float):
+        self.self_id = self_id
+        self.target = target
+        self.future = future
+        self.deadline = deadline
+
+
+class SendScheduler:
+    def __init__(self, group_rule: RateLimitModel, bot_rule: RateLimitModel):
+        self.groups = RateLimiter(group_rule)
+        self.bots = RateLimiter(bot_rule)
+        self._queues: List[List[Waiter]] = [[] for _ in Priority]
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def _wait(self, self_id: str, target: str, now: float) -> float:
+        return max(self.bots.check(self_id, now), self.groups.check(f"{self_id}:{target}", now))
+
+    def _consume(self, self_id: str, target: str, now: float):
+        self.bots.consume(self_id, now)
+        self.groups.consume(f"{self_id}:{target}", now)
+
+    async def acquire(self,
+                      self_id: str,
+                      target: str,
+                      priority: Priority = Priority.NORMAL,
+                      ttl: Optional[float] = None) -> bool:
+        """
+        等待发送的许可
+        :param self_id: Bot 的 self_id
+        :param target: 群 (`g{group_id}`) 或私聊对象 (`u{user_id}`)
+        :param priority: 优先级
+        :param ttl: 最长等待时间, `None` 为一直等待
+        :return: 是否取得许可, 等待超时时为 `False`
+        """
+        now = time.monotonic()
+        if not any(self._queues[:priority + 1]) and self._wait(self_id, target, now) == 0:
+            self._consume(self_id, target, now)
+            return True
+        waiter = Waiter(self_id, target, asyncio.get_running_loop().create_future(),
+                        now + ttl if ttl is not None else float('inf'))
+        self._queues[priority].append(waiter)
+        if self._task is None or self._task.done():
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._dispatch())
+        self._wakeup.set()
+        return await waiter.future
+
+    def _schedule(self, now: float) -> float:
+        """发出所有可以发出的许可, 返回距离下一次需要检查的秒数"""
+        delay = float('inf')
+        blocked: Set[Tuple[str, str]] = set()  # (self_id, target) with a waiter of higher priority still waiting
+        for priority, queue in enumerate(self._queues):
+            waiting = []
+            for waiter in queue:
+                if waiter.future.done():  # Cancelled by the caller
+                    continue
+                if waiter.deadline <= now:
+                    waiter.future.set_result(False)
+                    continue
+                wait = self._wait(waiter.self_id, waiter.target, now)
+                if wait == 0 and (waiter.self_id, waiter.target) not in blocked:
+                    self._consume(waiter.self_id, waiter.target, now)
+                    waiter.future.set_result(True)
+                    continue
+                waiting.append(waiter)
+                delay = min(delay, waiter.deadline - now, wait or float('inf'))
+            self._queues[priority] = waiting
+            blocked.update((waiter.self_id, waiter.target) for waiter in waiting)
+        return delay
+
+    async def _dispatch(self):
+        while True:
+            self._wakeup.clear()
+            delay = self._schedule(time.monotonic())
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), None if delay == float('inf') else delay)
+            except asyncio.TimeoutError:
+                pass
+
+    def queued(self) -> Dict[Priority, int]:
+        return {priority: len(queue) for priority, queue in zip(Priority, self._queues)}
+
+
+scheduler = SendScheduler(
+    RateLimitModel(calls=config.sender_group_calls, period=config.sender_group_period),
+    RateLimitModel(calls=config.sender_bot_calls, period=config.sender_bot_period))
+sent_recently: TTLCache[tuple, bool] = TTLCache(10000, config.sender_dedup_window)
+_sending: Set[tuple] = set()  # Dedup keys waiting for the scheduler, so that copies queued meanwhile are dropped
+_scheduled: contextvars.ContextVar[bool] = contextvars.ContextVar("_scheduled", default=False)
+_tasks: Set[asyncio.Task] = set()
+
+dropped = metrics.Counter("novabot_send_dropped_total", "Messages not sent by the scheduler", ["reason"])
+metrics.Gauge("novabot_send_queue", "Messages waiting for the send scheduler", ["priority"],
+              collect=lambda: {(priority.name.lower(),): count for priority, count in scheduler.queued().items()})
+
+
+def compile_prompt(prompt: TypeMessage) -> Optional[MessageTemplate]:
+    """预先解析提示的模板, 空的提示返回 `None`"""
+    if not prompt:
+        return None
+    return Message.template(Message(prompt))
+
+
+def _target(data: Dict[str, Any]) -> Optional[str]:
+    if data.get("group_id") and data.get("message_type", "group") == "group":
+        return f"g{data['group_id']}"
+    if data.get("user_id"):
+        return f"u{data['user_id']}"
+    return None
+
+
+async def send(bot: Bot,
+               event: Event,
+               message: TypeMessage,
+               *,
+               priority: Priority = Priority.NORMAL,
+               ttl: Optional[float] = None,
+               dedup: Optional[Hashable] = None,
+               **kwargs: Any) -> Optional[Any]:
+    """
+    以指定的优先级回复事件
+    :param bot: Bot
+    :param event: 回复的事件
+    :param message: 消息
+    :param priority: 优先级
+    :param ttl: 最长等待时间, 超时则放弃发送
+    :param dedup: 去重的键, 同一个键对同一个人在 `SENDER_DEDUP_WINDOW` 秒内只发送一次
+    :param kwargs: 传给 `bot.send` 的其他参数
+    :return: `bot.send` 的返回值, 没有发送时为 `None`
+    """
+    group_id, user_id = getattr(event, 'group_id', None), getattr(event, 'user_id', None)
+    target = f"g{group_id}" if group_id else f"u{user_id}"
+    key = (bot.self_id, target, user_id, dedup) if dedup is not None else None
+    if key is not None:
+        if key in sent_recently or key in _sending:
+            if metrics.enabled:
+                dropped.inc("duplicate")
+            return None
+        _sending.add(key)
+    try:
+        if not await scheduler.acquire(bot.self_id, target, priority, ttl):
+            if metrics.enabled:
+                dropped.inc("expired")
+            return None
+        token = _scheduled.set(True)
+        try:
+            result = await bot.send(event, message, **kwargs)
+        finally:
+            _scheduled.reset(token)
+        if key is not None:
+            sent_recently.set(key, True)
+        return result
+    finally:
+        _sending.discard(key)
+
+
+def post(bot: Bot, event: Event, message: TypeMessage, **kwargs: Any):
+    """在后台调用 `send`, 不等待发送完成, 发送失败只记录日志"""
+
+    async def _send():
+        try:
+            await send(bot, event, message, **kwargs)
+        except Exception as e:
+            logger.opt(exception=e).warning("Failed to send message")
+
+    task = asyncio.create_task(_send())
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
+
+
+def send_prompt(bot: Bot, event: Event, template: Optional[MessageTemplate], dedup: Hashable, **kwargs: Any):
+    """在后台以 `Priority.LOW` 发送由 `compile_prompt` 得到的提示, 同一提示对同一个人在窗口内只发送一次"""
+    if template is None:
+        return
+    message = template.format(**kwargs, user=getattr(event, 'user_id', 0) or 0)
+    if message:
+        post(bot, event, message, priority=Priority.LOW, ttl=config.sender_prompt_ttl, dedup=dedup)
+
+
+@Bot.on_calling_api
+async def _(bot: BaseBot, api: str, data: Dict[str, Any]):
+    if api not in SEND_APIS or _scheduled.get() or (target := _target(data)) is None:
+        return
+    await scheduler.acquire(bot.self_id, target, Priority.NORMAL)
+
+
+__all__ = ["Priority", "SendScheduler", "scheduler", "compile_prompt", "send", "post", "send_prompt"]
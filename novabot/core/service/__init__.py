@@ -1 +1,4 @@
-from .service import Service
+from .service import Service, find_services
+from .schedule import Scheduled
+from .switch import service_switch
+from .catalog import catalog
@@ -0,0 +1,220 @@
+"""
+服务目录与帮助
+
+启动时由所有已加载的服务一次性建立, 运行中不再遍历 `services_dict`:
+- 以插件名, 组名, 服务名, 命令 (含别名), 插件的描述与用法为词项的倒排索引;
+  查找时依次尝试完全匹配, 前缀匹配与模糊匹配 (`difflib`), 中文按整段与相邻两字切分
+- 帮助的文字与图片以群的启用状态 (`service_switch.mask`) 为键缓存, 启用状态相同的群共用同一份,
+  只有启用状态改变后才会生成新的帮助
+"""
+
+import asyncio
+import bisect
+import difflib
+import html
+import re
+from collections import defaultdict
+from typing import Dict, List, Tuple, Type, Iterable, Set, TYPE_CHECKING
+
+from nonebot import get_driver
+from nonebot.log import logger
+from nonebot.matcher import Matcher
+from nonebot.rule import CommandRule, ShellCommandRule, KeywordsRule, StartswithRule, FullmatchRule
+from pydantic import BaseModel, Extra
+
+from novabot.core.render import html_to_image
+from novabot.core.utils import TTLCache
+
+if TYPE_CHECKING:
+    from .service import Service
+
+
+class Config(BaseModel, extra=Extra.ignore):
+    help_image: bool = True
+    help_cache_size: int = 256
+
+
+config = Config.parse_obj(get_driver().config)
+
+WEIGHTS = {"plugin": 4, "service": 4, "command": 4, "bundle": 3, "description": 1, "usage": 1}
+MAX_PREFIX_TERMS = 20
+FUZZY_CUTOFF = 0.7
+_WORD = re.compile(r"[a-z0-9_]+|[^\W\da-z_]+")
+
+TEMPLATE = """<html><head><meta charset="utf-8"><style>
+body { margin: 0; padding: 24px; background: #fafafa; font: 15px/1.6 sans-serif; color: #333; }
+h2 { margin: 16px 0 4px; font-size: 18px; } h2 small { color: #888; font-weight: normal; }
+li { list-style: none; } .off { color: #bbb; text-decoration: line-through; } code { color: #a05; }
+</style></head><body>$content</body></html>"""
+
+
+def tokenize(text: str) -> List[str]:
+    """小写的英文单词与数字, 以及中文的整段与相邻两字"""
+    tokens = []
+    for word in _WORD.findall(text.lower()):
+        tokens.append(word)
+        if not word.isascii() and len(word) > 2:
+            tokens.extend(word[i:i + 2] for i in range(len(word) - 1))
+    return tokens
+
+
+def matcher_commands(matcher: Type[Matcher]) -> List[str]:
+    """事件响应器的命令与关键词, 需要在 `Service` 替换其规则之前读取"""
+    commands = []
+    for checker in matcher.rule.checkers:
+        call = checker.call
+        if isinstance(call, (CommandRule, ShellCommandRule)):
+            commands.extend(".".join(cmd) for cmd in call.cmds)
+        elif isinstance(call, KeywordsRule):
+            commands.extend(call.keywords)
+        elif isinstance(call, (StartswithRule, FullmatchRule)):
+            commands.extend(call.msg)
+    return commands
+
+
+class Entry:
+    __slots__ = ("service", "plugin", "description", "usage")
+
+    def __init__(self, service: 'Service'):
+        metadata = service.plugin.metadata
+        self.service = service
+        self.plugin = metadata.name if metadata else service.plugin.name
+        self.description = metadata.description if metadata else ""
+        self.usage = metadata.usage if metadata else ""
+
+    def fields(self) -> Iterable[Tuple[str, str]]:
+        yield "plugin", self.plugin
+        yield "plugin", self.service.plugin.name
+        yield "bundle", self.service.bundle
+        yield "service", self.service.name
+        for command in self.service.commands:
+            yield "command", command
+        yield "description", self.description
+        yield "usage", self.usage
+
+
+class Catalog:
+    def __init__(self, cache_size: int):
+        self.entries: List[Entry] = []
+        self._postings: Dict[str, Dict[int, int]] = {}  # term: {entry: weight}
+        self._terms: List[str] = []  # Sorted, for prefix lookup
+        self._plugins: Dict[str, List[Entry]] = {}  # plugin: entries, sorted by plugin name
+        self._texts: TTLCache[int, str] = TTLCache(cache_size, float('inf'))
+        self._images: TTLCache[int, bytes] = TTLCache(cache_size, float('inf'))
+        self._tasks: Set[asyncio.Task] = set()
+
+    def build(self, services: Iterable['Service']):
+        self.entries = [Entry(service) for service in services]
+        postings: Dict[str, Dict[int, int]] = defaultdict(dict)
+        plugins: Dict[str, List[Entry]] = defaultdict(list)
+        for i, entry in enumerate(self.entries):
+            plugins[entry.plugin].append(entry)
+            for field, text in entry.fields():
+                for term in tokenize(text or ""):
+                    postings[term][i] = max(postings[term].get(i, 0), WEIGHTS[field])
+        self._postings = dict(postings)
+        self._terms = sorted(postings)
+        self._plugins = {name: plugins[name] for name in sorted(plugins, key=str.lower)}
+        self._texts.clear()
+        self._images.clear()
+
+    def _match(self, token: str) -> Dict[int, float]:
+        """单个词项的得分: 完全匹配 > 前缀匹配 > 模糊匹配, 前者有结果时不再尝试后者"""
+        if postings := self._postings.get(token):
+            return dict(postings)
+        terms = []
+        for i in range(bisect.bisect_left(self._terms, token), len(self._terms)):
+            if not self._terms[i].startswith(token) or len(terms) == MAX_PREFIX_TERMS:
+                break
+            terms.append(self._terms[i])
+        factor = 0.6
+        if not terms:
+            terms, factor = difflib.get_close_matches(token, self._terms, 3, FUZZY_CUTOFF), 0.3
+        scores: Dict[int, float] = {}
+        for term in terms:
+            for i, weight in self._postings[term].items():
+                scores[i] = max(scores.get(i, 0), weight * factor)
+        return scores
+
+    def search(self, query: str, limit: int = 5) -> List[Entry]:
+        """按得分从高到低返回匹配的服务"""
+        scores: Dict[int, float] = defaultdict(float)
+        for token in set(tokenize(query)):
+            for i, score in self._match(token).items():
+                scores[i] += score
+        ranked = sorted(scores, key=lambda i: (-scores[i], self.entries[i].service.name))
+        return [self.entries[i] for i in ranked[:limit]]
+
+    def _bundles(self, entries: List[Entry], mask: int) -> List[Tuple[str, bool, List[str]]]:
+        """(组名, 是否有启用的服务, 命令)"""
+        bundles: Dict[str, Tuple[bool, List[str]]] = {}
+        for entry in entries:
+            enabled, commands = bundles.get(entry.service.bundle, (False, []))
+            bundles[entry.service.bundle] = (enabled or bool(mask >> entry.service.index & 1),
+                                             commands + [c for c in entry.service.commands if c not in commands])
+        return [(bundle, enabled, commands) for bundle, (enabled, commands) in bundles.items()]
+
+    def help_text(self, mask: int) -> str:
+        """所有插件的帮助, 标出在启用状态为 `mask` 的群中各组是否启用"""
+        if (text := self._texts.get(mask)) is not None:
+            return text
+        lines = []
+        for plugin, entries in self._plugins.items():
+            lines.append(f"{plugin}{f' - {entries[0].description}' if entries[0].description else ''}")
+            for bundle, enabled, commands in self._bundles(entries, mask):
+                lines.append(f"  {'√' if enabled else '×'} {bundle}{': ' + ' / '.join(commands) if commands else ''}")
+        text = "\n".join(lines) or "没有已加载的服务"
+        self._texts.set(mask, text)
+        return text
+
+    def plugin_help(self, plugin: str, mask: int) -> str:
+        entries = self._plugins.get(plugin, [])
+        if not entries:
+            return ""
+        lines = [plugin]
+        if entries[0].description:
+            lines.append(entries[0].description)
+        if entries[0].usage:
+            lines.append(entries[0].usage)
+        for bundle, enabled, _ in self._bundles(entries, mask):
+            lines.append(f"{'√' if enabled else '×'} {bundle}")
+        return "\n".join(lines)
+
+    def _html(self, mask: int) -> str:
+        parts = []
+        for plugin, entries in self._plugins.items():
+            description = f" <small>{html.escape(entries[0].description)}</small>" if entries[0].description else ""
+            parts.append(f"<h2>{html.escape(plugin)}{description}</h2><ul>")
+            for bundle, enabled, commands in self._bundles(entries, mask):
+                code = " ".join(f"<code>{html.escape(command)}</code>" for command in commands)
+                parts.append(f"<li class=\"{'on' if enabled else 'off'}\">{html.escape(bundle)} {code}</li>")
+            parts.append("</ul>")
+        return "".join(parts)
+
+    async def help_image(self, mask: int) -> bytes:
+        if (image := self._images.get(mask)) is not None:
+            return image
+        image = await html_to_image(self._html(mask), template=TEMPLATE, viewport=(640, 400))
+        self._images.set(mask, image)
+        return image
+
+    def prerender(self, mask: int):
+        """生成默认启用状态的帮助, 图片在后台渲染"""
+        self.help_text(mask)
+        if not config.help_image:
+            return
+
+        async def _render():
+            try:
+                await self.help_image(mask)
+            except Exception as e:
+                logger.opt(exception=e).warning("Failed to prerender the help image")
+
+        task = asyncio.create_task(_render())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+
+catalog = Catalog(config.help_cache_size)
+
+__all__ = ["Catalog", "Entry", "catalog", "tokenize", "matcher_commands"]
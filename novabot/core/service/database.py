@@ -1,44 +1,198 @@
-import datetime
+"""
+服务 cd / limit 的持久化
+
+每个 (service, group_id, user_id) 对应 `ServiceThrottle` 中的一条记录, 所有写入都只作用于单条记录的字段,
+写入代价与服务记录过的用户数量无关. `expire_at` 上的 TTL 索引会自动清理 cd 已过期且 limit 已重置的记录.
+"""
+
+import asyncio
+from datetime import datetime, timedelta, timezone
+from typing import Optional, Dict, Any, Iterable, List, Tuple
 
 import pymongo
-from typing import Optional, Tuple
-from collections import defaultdict
+from pymongo import UpdateOne, ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
 from novabot.core.db import DB
 
-from .model import DatabaseModel
+from .model import DatabaseModel, ThrottleModel
+from .throttle import ThrottleResult, day_start, evaluate
 
 ServiceDB = DB['Service']
-ServiceDB.create_index([("name", pymongo.TEXT)])
+ThrottleDB = DB['ServiceThrottle']
+LimiterDB = DB['ServiceLimiter']
+SwitchDB = DB['ServiceSwitch']
+JobDB = DB['ServiceJob']
+JobResultDB = DB['ServiceJobResult']
+
+Key = Tuple[str, str, str]  # (service_name, group_id, user_id)
+
+
+def expire_at(cd: float, date: float) -> datetime:
+    """
+    记录失效的时间: cd 结束与 limit 计数所在日期 (本地时间) 结束中较晚的一个
+    `pymongo` 把不带时区的 `datetime` 当作 UTC 保存, 因此返回带时区的 UTC 时间, 否则 TTL 索引会按时差提前或推迟清理
+    """
+    day_end = datetime.fromtimestamp(date).replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(days=1)
+    return max(datetime.fromtimestamp(cd, timezone.utc), datetime.fromtimestamp(day_end.timestamp(), timezone.utc))
 
 
 class ServiceDatabase:
-    def __init__(self, name: str):
-        self.name = name
-        if data := ServiceDB.find_one({"name": self.name}):
-            self.data = DatabaseModel.parse_obj(data)
-            self.data.cd = defaultdict(dict, self.data.cd)
-            self.data.limit = defaultdict(dict, self.data.limit)
-        else:
-            self.data = DatabaseModel(name=self.name)
-
-    def cd(self, user_id: str, group_id: Optional[str]) -> float:
-        return self.data.cd[group_id].get(user_id, 0)
-
-    def limit(self, user_id: str, group_id: Optional[str]) -> Tuple[int, float]:
-        return self.data.limit[group_id].get(user_id, {}).get('limit', 0), \
-               self.data.limit[group_id].get(user_id, {}).get('date', 0)
-
-    def update_cd(self, user_id: str, group_id: Optional[str], cd: float):
-        self.data.cd[group_id][user_id] = cd
-        self.update()
-
-    def update_limit(self, user_id: str, group_id: Optional[str]):
-        self.data.limit[group_id][user_id] = {
-            "limit": self.data.limit[group_id].get(user_id, {}).get('limit', 0) + 1,
-            "date": datetime.datetime.now().timestamp()
-        }
-        self.update()
-
-    def update(self):
-        ServiceDB.update_one({"name": self.name}, {"$set": self.data.dict()}, upsert=True)
+    @staticmethod
+    async def create_indexes():
+        await asyncio.gather(
+            ServiceDB.create_index([("name", pymongo.TEXT)]),
+            ThrottleDB.create_index([("service", pymongo.ASCENDING),
+                                     ("group_id", pymongo.ASCENDING),
+                                     ("user_id", pymongo.ASCENDING)], unique=True),
+            ThrottleDB.create_index([("expire_at", pymongo.ASCENDING)], expireAfterSeconds=0),
+            LimiterDB.create_index([("service", pymongo.ASCENDING)], unique=True),
+            SwitchDB.create_index([("group_id", pymongo.ASCENDING)], unique=True),
+            JobDB.create_index([("service", pymongo.ASCENDING)], unique=True),
+            JobResultDB.create_index([("service", pymongo.ASCENDING), ("run_at", pymongo.DESCENDING)]),
+            JobResultDB.create_index([("expire_at", pymongo.ASCENDING)], expireAfterSeconds=0))
+
+    @staticmethod
+    def _filter(name: str, user_id: str, group_id: str) -> Dict[str, str]:
+        return {"service": name, "group_id": group_id, "user_id": user_id}
+
+    @classmethod
+    async def acquire(cls, name: str, user_id: str, group_id: str, *,
+                      cd: int, limit: int, now: float) -> ThrottleResult:
+        """
+        单次判定 cd 与 limit, 两者都满足时原子地写入新的 cd 与计数
+        有 limit 时先在当天的记录上把计数加一; 记录不是当天的 (或不存在) 时, 再以带条件的 upsert 把计数重置为 1.
+        条件不满足时, 带条件的 upsert 会因唯一索引冲突而失败, 此时再读取记录得到被拒绝的原因;
+        读取时记录又变为可用 (并发写入) 则重试, 多次重试都失败时抛出 `RuntimeError`, 而不是当作被拒绝
+        """
+        key = cls._filter(name, user_id, group_id)
+        cd_free: List[Dict[str, Any]] = []
+        fields: Dict[str, Any] = {"expire_at": expire_at(now + cd, now if limit else 0)}
+        if cd:
+            cd_free.append({"$or": [{"cd": {"$lte": now}}, {"cd": {"$exists": False}}]})
+            fields["cd"] = now + cd
+        conditions = cd_free
+        if limit:
+            today = day_start(now)
+            conditions = cd_free + [{"$or": [{"date": {"$lt": today}}, {"date": {"$exists": False}}]}]
+            fields["date"] = now
+        for _ in range(3):  # Retry if a concurrent write changed the record between the attempts
+            try:
+                if limit and (data := await ThrottleDB.find_one_and_update(
+                        {**key, "$and": cd_free + [{"date": {"$gte": today}}, {"limit": {"$lt": limit}}]},
+                        {"$set": fields, "$inc": {"limit": 1}},
+                        return_document=ReturnDocument.AFTER)):
+                    return ThrottleResult(True, None, limit - data["limit"])
+                await ThrottleDB.update_one({**key, "$and": conditions} if conditions else key,
+                                            {"$set": {**fields, "limit": 1} if limit else fields},
+                                            upsert=True)
+                return ThrottleResult(True, None, limit - 1 if limit else None)
+            except DuplicateKeyError:
+                data = await ThrottleDB.find_one(key) or {}
+                result = evaluate(data.get("cd", 0), data.get("limit", 0), data.get("date", 0),
+                                  cd=cd, limit=limit, now=now)
+                if not result.available:
+                    return result
+        raise RuntimeError(f"Failed to update throttle record {key} under concurrent writes")
+
+    @staticmethod
+    async def load_many(names: Iterable[str]) -> List[ThrottleModel]:
+        """一次查询读取多个服务的全部未过期的记录 (TTL 索引的清理有延迟)"""
+        return [ThrottleModel.parse_obj(data) for data in await ThrottleDB.find(
+            {"service": {"$in": list(names)},
+             "$or": [{"expire_at": {"$gt": datetime.now(timezone.utc)}}, {"expire_at": None}]},
+            {"_id": False, "expire_at": False})]
+
+    @classmethod
+    async def bulk_set(cls, updates: Dict[Key, Dict[str, Any]]):
+        """
+        批量写入多条记录, 每条记录只写入给定的字段
+        :param updates: (name, group_id, user_id): {field: value}
+        """
+        if not updates:
+            return
+        await ThrottleDB.bulk_write([UpdateOne(cls._filter(name, user_id, group_id), {"$set": fields}, upsert=True)
+                                     for (name, group_id, user_id), fields in updates.items()], ordered=False)
+
+    @classmethod
+    async def migrate(cls) -> int:
+        """把旧版整文档 (`Service.cd` / `Service.limit`) 的数据拆分为单条记录, 返回迁移的服务数量"""
+        legacy = await ServiceDB.find({"$or": [{"cd": {"$exists": True}}, {"limit": {"$exists": True}}]})
+        for doc in legacy:
+            data = DatabaseModel.parse_obj(doc)
+            updates: Dict[Key, Dict[str, Any]] = {}
+            for group_id, users in data.cd.items():
+                for user_id, cd in users.items():
+                    updates.setdefault((data.name, group_id, user_id), {})['cd'] = cd
+            for group_id, users in data.limit.items():
+                for user_id, limit in users.items():
+                    fields = updates.setdefault((data.name, group_id, user_id), {})
+                    fields['limit'] = limit.get('limit', 0)
+                    fields['date'] = limit.get('date', 0)
+            for fields in updates.values():
+                fields['expire_at'] = expire_at(fields.get('cd', 0), fields.get('date', 0))
+            await cls.bulk_set(updates)
+            await ServiceDB.update_one({"name": data.name}, {"$unset": {"cd": "", "limit": ""}})
+        return len(legacy)
+
+    @staticmethod
+    async def load_limiters(names: Iterable[str]) -> Dict[str, List[Optional[Dict[str, Any]]]]:
+        """读取持久化的限流器状态"""
+        return {data["service"]: data.get("states", [])
+                for data in await LimiterDB.find({"service": {"$in": list(names)}})}
+
+    @staticmethod
+    async def save_limiters(states: Dict[str, List[Optional[Dict[str, Any]]]]):
+        if not states:
+            return
+        await LimiterDB.bulk_write([UpdateOne({"service": name}, {"$set": {"states": state}}, upsert=True)
+                                    for name, state in states.items()], ordered=False)
+
+    @staticmethod
+    async def load_switches() -> Dict[str, Tuple[List[str], List[str]]]:
+        """读取所有群与默认状态不同的服务名: group_id: (启用的, 禁用的)"""
+        return {data["group_id"]: (data.get("enabled", []), data.get("disabled", []))
+                for data in await SwitchDB.find({})}
+
+    @staticmethod
+    async def save_switches(switches: Dict[str, Tuple[List[str], List[str]]]):
+        if not switches:
+            return
+        await SwitchDB.bulk_write([UpdateOne({"group_id": group_id},
+                                             {"$set": {"enabled": enabled, "disabled": disabled}},
+                                             upsert=True)
+                                   for group_id, (enabled, disabled) in switches.items()], ordered=False)
+
+    @staticmethod
+    async def load_last_runs(names: Iterable[str]) -> Dict[str, float]:
+        """各定时服务最后一次运行的计划时间戳"""
+        return {data["service"]: data["last_run"]
+                for data in await JobDB.find({"service": {"$in": list(names)}}) if data.get("last_run")}
+
+    @staticmethod
+    async def claim_run(name: str, run_at: float) -> bool:
+        """
+        原子地把 `last_run` 推进到 `run_at`, 只有成功推进的进程执行这次运行, 多个 worker 不会重复推送
+        `last_run` 已不早于 `run_at` 时, 带条件的 upsert 会因唯一索引冲突而失败
+        """
+        try:
+            await JobDB.update_one({"service": name, "last_run": {"$lt": run_at}},
+                                   {"$set": {"last_run": run_at}},
+                                   upsert=True)
+        except DuplicateKeyError:
+            return False
+        return True
 
+    @staticmethod
+    async def record_run(name: str, run_at: float, results: List[Dict[str, Any]], retention: timedelta):
+        """一次写入本次运行的所有结果, 并更新汇总"""
+        expire = datetime.fromtimestamp(run_at, timezone.utc) + retention
+        failed = [result["group_id"] for result in results if not result["ok"]]
+        writes = [JobDB.update_one({"service": name},
+                                   {"$set": {"last_result": {"run_at": run_at,
+                                                             "sent": len(results) - len(failed),
+                                                             "failed": failed}}})]
+        if results:
+            writes.append(JobResultDB.insert_many([dict(result, service=name, run_at=run_at, expire_at=expire)
+                                                   for result in results], ordered=False))
+        await asyncio.gather(*writes)
@@ -0,0 +1,186 @@
+"""
+服务的限流器
+
+- `token_bucket`: 令牌桶, 容量为 `calls`, 每 `period` 秒补满, 允许短时间的突发
+- `sliding_window`: 滑动窗口日志, 任意 `period` 秒内最多 `calls` 次
+- `concurrency`: 同一服务同时运行的处理器数量上限
+
+每条规则可以作用于 `user` / `group` / `global` 范围, 单次判定与记录都是 O(1) 的.
+空闲的状态 (令牌已补满 / 窗口内无记录) 与不存在等价, 会被定期清理以限制内存占用.
+"""
+
+from collections import deque
+from contextlib import AsyncExitStack
+from typing import Dict, List, Optional, Deque, Any, Union
+
+from .model import RateLimitModel
+
+
+class TokenBucket:
+    __slots__ = ('tokens', 'updated')
+
+    def __init__(self, tokens: float, updated: float):
+        self.tokens = tokens
+        self.updated = updated
+
+
+class RateLimiter:
+    def __init__(self, rule: RateLimitModel):
+        self.rule = rule
+        self.rate = rule.calls / rule.period
+        self._states: Dict[str, Union[TokenBucket, Deque[float]]] = {}
+        self._next_sweep = 1024
+
+    def _bucket(self, key: str, now: float) -> TokenBucket:
+        if (bucket := self._states.get(key)) is None:
+            bucket = self._states[key] = TokenBucket(self.rule.calls, now)
+        else:
+            bucket.tokens = min(self.rule.calls, bucket.tokens + (now - bucket.updated) * self.rate)
+            bucket.updated = now
+        return bucket
+
+    def _window(self, key: str) -> Deque[float]:
+        if (window := self._states.get(key)) is None:
+            window = self._states[key] = deque(maxlen=self.rule.calls)
+        return window
+
+    def check(self, key: str, now: float) -> float:
+        """返回距离下一次可用的秒数, 为 0 时表示可用"""
+        if self.rule.mode == 'token_bucket':
+            bucket = self._bucket(key, now)
+            return 0 if bucket.tokens >= 1 else (1 - bucket.tokens) / self.rate
+        window = self._window(key)
+        if len(window) < self.rule.calls:
+            return 0
+        return max(0., window[0] + self.rule.period - now)
+
+    def consume(self, key: str, now: float):
+        if self.rule.mode == 'token_bucket':
+            self._bucket(key, now).tokens -= 1
+        else:
+            self._window(key).append(now)
+        if len(self._states) > self._next_sweep:
+            self.sweep(now)
+
+    def refund(self, key: str, now: float):
+        """撤销 `now` 时的一次 `consume`"""
+        if self.rule.mode == 'token_bucket':
+            bucket = self._bucket(key, now)
+            bucket.tokens = min(self.rule.calls, bucket.tokens + 1)
+        elif (window := self._states.get(key)) and now in window:
+            window.remove(now)
+
+    def _idle(self, state: Union[TokenBucket, Deque[float]], now: float) -> bool:
+        if isinstance(state, TokenBucket):
+            return state.tokens + (now - state.updated) * self.rate >= self.rule.calls
+        return not state or state[-1] + self.rule.period <= now
+
+    def sweep(self, now: float):
+        self._states = {key: state for key, state in self._states.items() if not self._idle(state, now)}
+        self._next_sweep = max(1024, len(self._states) * 2)
+
+    def dump(self, now: float) -> List[List[Any]]:
+        self.sweep(now)
+        return [[key, [state.tokens, state.updated] if isinstance(state, TokenBucket) else list(state)]
+                for key, state in self._states.items()]
+
+    def restore(self, states: List[List[Any]]):
+        for key, state in states:
+            if self.rule.mode == 'token_bucket':
+                self._states[key] = TokenBucket(*state)
+            else:
+                self._states[key] = deque(state, maxlen=self.rule.calls)
+
+
+class ConcurrencyLimiter:
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.active = 0
+
+    def available(self) -> bool:
+        return self.active < self.limit
+
+    def acquire(self) -> bool:
+        if not self.available():
+            return False
+        self.active += 1
+        return True
+
+    def release(self):
+        self.active -= 1
+
+
+class Reservation:
+    """`ServiceLimiter.reserve` 记录的一次调用, 占用的并发位置在 `release` 或 `cancel` 时释放, 只会释放一次"""
+    __slots__ = ('limiter', 'keys', 'now', 'slot')
+
+    def __init__(self, limiter: 'ServiceLimiter', keys: List[str], now: float, slot: bool):
+        self.limiter = limiter
+        self.keys = keys
+        self.now = now
+        self.slot = slot
+
+    def release(self):
+        if self.slot:
+            self.slot = False
+            self.limiter.concurrency.release()
+
+    def cancel(self):
+        """撤销记录的调用并释放并发位置, 用于 cd / limit 拒绝或不计数的调用"""
+        for limiter, key in zip(self.limiter.limiters, self.keys):
+            limiter.refund(key, self.now)
+        self.release()
+
+
+class ServiceLimiter:
+    def __init__(self, rules: List[RateLimitModel], concurrency: int = 0):
+        self.limiters = [RateLimiter(rule) for rule in rules]
+        self.concurrency = ConcurrencyLimiter(concurrency) if concurrency else None
+
+    @staticmethod
+    def _key(rule: RateLimitModel, user_id: str, group_id: str) -> str:
+        if rule.scope == 'user':
+            return user_id
+        if rule.scope == 'group':
+            return group_id if group_id != '0' else f"private.{user_id}"
+        return ''
+
+    def check(self, user_id: str, group_id: str, now: float) -> Optional[float]:
+        """
+        判定所有规则, 不做任何记录
+        :return: 可用时为 `None`, 否则为距离下一次可用的秒数 (并发已满时为 0)
+        """
+        retry = max((limiter.check(self._key(limiter.rule, user_id, group_id), now)
+                     for limiter in self.limiters), default=0)
+        if retry > 0:
+            return retry
+        if self.concurrency and not self.concurrency.available():
+            return 0
+        return None
+
+    def reserve(self, user_id: str, group_id: str, now: float, stack: Optional[AsyncExitStack]) -> Reservation:
+        """
+        记录一次调用并占用并发位置, 位置在 `stack` 关闭时释放, 没有 `stack` 时不占用
+        须紧接在返回 `None` 的 `check` 之后调用, 两者之间不能有 await, 否则判定的结果可能已经失效
+        """
+        keys = [self._key(limiter.rule, user_id, group_id) for limiter in self.limiters]
+        for limiter, key in zip(self.limiters, keys):
+            limiter.consume(key, now)
+        reservation = Reservation(self, keys, now, bool(self.concurrency and stack and self.concurrency.acquire()))
+        if reservation.slot:
+            stack.callback(reservation.release)
+        return reservation
+
+    def dump(self, now: float) -> List[Optional[Dict[str, Any]]]:
+        """导出需要持久化的规则状态, 与 `limiters` 一一对应, 不持久化的规则为 `None`"""
+        return [{"mode": limiter.rule.mode, "states": limiter.dump(now)} if limiter.rule.persist else None
+                for limiter in self.limiters]
+
+    def restore(self, states: List[Optional[Dict[str, Any]]]):
+        """恢复 `dump` 导出的状态, 规则的模式已改变时忽略对应的状态"""
+        for limiter, state in zip(self.limiters, states):
+            if state and limiter.rule.persist and state.get("mode") == limiter.rule.mode:
+                limiter.restore(state["states"])
+
+
+__all__ = ["RateLimiter", "ConcurrencyLimiter", "Reservation", "ServiceLimiter"]
@@ -1,5 +1,6 @@
 from collections import defaultdict
-from typing import List, TYPE_CHECKING, Optional, Dict
+from datetime import datetime
+from typing import List, TYPE_CHECKING, Optional, Dict, Literal
 from pydantic import BaseModel, Extra
 
 from novabot.core.types import TypeMessage
@@ -8,12 +9,23 @@ if TYPE_CHECKING:
     from .service import Service
 
 
+class RateLimitModel(BaseModel, extra=Extra.ignore):
+    calls: int
+    period: float
+    mode: Literal['token_bucket', 'sliding_window'] = 'token_bucket'
+    scope: Literal['user', 'group', 'global'] = 'user'
+    persist: bool = False
+
+
 class InfoModel(BaseModel, extra=Extra.ignore):
     enable_on_default: Optional[bool] = True
     cd: Optional[int] = 0
     limit: Optional[int] = 0
     cd_prompt: Optional[TypeMessage] = None
     limit_prompt: Optional[TypeMessage] = None
+    rate_limits: Optional[List[RateLimitModel]] = []
+    concurrency: Optional[int] = 0
+    rate_prompt: Optional[TypeMessage] = None
 
 
 class BundleModel(InfoModel, extra=Extra.ignore):
@@ -28,6 +40,16 @@ class DatabaseModel(BaseModel, extra=Extra.ignore):
     """ limit: group_id: {user_id: {limit: count, date: timestamp}} """
 
 
+class ThrottleModel(BaseModel, extra=Extra.ignore):
+    service: str
+    group_id: str
+    user_id: str
+    cd: float = 0  # cd_timestamp
+    limit: int = 0
+    date: float = 0  # timestamp of the last limit update
+    expire_at: Optional[datetime] = None
+
+
 class PluginModel(BaseModel, extra=Extra.ignore):
     bundles: Dict[str, BundleModel] = {}
     plugin_name: Optional[TypeMessage]
@@ -0,0 +1,56 @@
+"""
+群成员身份缓存
+
+`GroupMessageEvent.sender.role` 会被直接写入缓存, 管理员变动 / 成员离开的通知会使对应条目失效,
+只有缓存未命中时才会调用 `get_group_member_info`
+"""
+
+from typing import Optional
+
+from nonebot import get_driver
+from nonebot.adapters.onebot.v11 import (
+    Bot,
+    Event,
+    GroupMessageEvent,
+    GroupAdminNoticeEvent,
+    GroupDecreaseNoticeEvent,
+    ActionFailed)
+from nonebot.message import event_preprocessor
+from pydantic import BaseModel, Extra
+
+from novabot.core.utils import TTLCache
+
+
+class Config(BaseModel, extra=Extra.ignore):
+    role_cache_size: int = 10000
+    role_cache_ttl: float = 600
+
+
+config = Config.parse_obj(get_driver().config)
+
+role_cache: TTLCache[tuple, str] = TTLCache(config.role_cache_size, config.role_cache_ttl)
+
+
+async def get_role(bot: Bot, group_id: int, user_id: int) -> Optional[str]:
+    """获取群成员身份 (`owner` / `admin` / `member`), 获取失败时返回 `None`"""
+    key = (group_id, user_id)
+    if (role := role_cache.get(key)) is not None:
+        return role
+    try:
+        info = await bot.call_api("get_group_member_info", group_id=group_id, user_id=user_id)
+    except ActionFailed:
+        return None
+    if role := info.get('role'):
+        role_cache.set(key, role)
+    return role
+
+
+@event_preprocessor
+async def _(event: Event):
+    if isinstance(event, GroupMessageEvent) and event.sender.role:
+        role_cache.set((event.group_id, event.user_id), event.sender.role)
+    elif isinstance(event, (GroupAdminNoticeEvent, GroupDecreaseNoticeEvent)):
+        role_cache.pop((event.group_id, event.user_id))
+
+
+__all__ = ["role_cache", "get_role"]
@@ -0,0 +1,217 @@
+"""
+定时触发的服务
+
+```
+async def morning(bot: Bot, group_id: int) -> Optional[TypeMessage]:
+    return "早上好"
+
+Service(Scheduled(morning, "cron", hour=8), "morning")
+```
+
+每次运行会把消息推送到所有 Bot 所在的, 启用了该服务的群:
+- 推送由 `concurrency` 个协程并发完成, 每条消息前随机等待至多 `jitter` 秒, 失败时退避重试 `retries` 次
+- 每次运行的结果在结束后一次性写入 `ServiceJobResult`
+- 最后一次运行的计划时间保存在 `ServiceJob` 中, 启动时按 `catch_up` 补上停机期间错过的运行:
+  `none` 不补, `once` 只补最近的一次, `all` 逐次补上 (最多 `MAX_CATCH_UP` 次);
+  从未运行过的 `date` 触发器, 其时间已过时同样按 `catch_up` 处理
+- 运行前原子地推进 `last_run`, 多个 worker 中只有一个会执行同一次运行
+  (`interval` 触发器需要指定 `start_date`, 否则各 worker 的计划时间不同)
+"""
+
+import asyncio
+import inspect
+import random
+import time
+from collections import deque
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Awaitable, Optional, Literal, Dict, List, Any, Union, Set, Deque, TYPE_CHECKING
+
+from apscheduler.triggers.base import BaseTrigger
+from apscheduler.triggers.cron import CronTrigger
+from apscheduler.triggers.date import DateTrigger
+from apscheduler.triggers.interval import IntervalTrigger
+from nonebot import get_driver, require
+from nonebot.adapters.onebot.v11 import Bot, ActionFailed, NetworkError
+from nonebot.log import logger
+from pydantic import BaseModel, Extra
+
+from novabot.core.cluster import get_bots
+from novabot.core.types import TypeMessage
+
+from .database import ServiceDatabase
+from .switch import service_switch
+
+require("nonebot_plugin_apscheduler")
+from nonebot_plugin_apscheduler import scheduler  # noqa: E402
+
+if TYPE_CHECKING:
+    from .service import Service
+
+
+class Config(BaseModel, extra=Extra.ignore):
+    service_job_retention_days: float = 7
+
+
+config = Config.parse_obj(get_driver().config)
+
+MAX_CATCH_UP = 10
+LOOKBACK = timedelta(minutes=5)  # How late a job may start and still find its scheduled time
+TRIGGERS = {"cron": CronTrigger, "interval": IntervalTrigger, "date": DateTrigger}
+
+JobFunc = Union[Callable[[Bot, int], Awaitable[Optional[TypeMessage]]],
+                Callable[[], Awaitable[Optional[TypeMessage]]]]
+
+
+class Scheduled:
+    def __init__(self,
+                 func: JobFunc,
+                 trigger: Union[Literal['cron', 'interval', 'date'], BaseTrigger] = 'cron',
+                 *,
+                 catch_up: Literal['none', 'once', 'all'] = 'once',
+                 concurrency: int = 5,
+                 jitter: float = 2,
+                 retries: int = 2,
+                 **trigger_args: Any):
+        """
+        :param func: 返回要推送的消息, 参数为 (bot, group_id) 时对每个群分别调用, 没有参数时每次运行只调用一次;
+                     返回 `None` 时不推送
+        :param trigger: `apscheduler` 的触发器或其名称
+        :param catch_up: 启动时如何补上错过的运行
+        :param concurrency: 同时推送的群数
+        :param jitter: 每条消息发送前的随机等待秒数上限
+        :param retries: 推送失败后的重试次数
+        :param trigger_args: 传给触发器的参数, 例如 `hour=8`
+        """
+        self.func = func
+        self.trigger = TRIGGERS[trigger](**trigger_args) if isinstance(trigger, str) else trigger
+        self.catch_up = catch_up
+        self.concurrency = concurrency
+        self.jitter = jitter
+        self.retries = retries
+        self.per_group = bool(inspect.signature(func).parameters)
+
+    def __repr__(self):
+        return f"<Scheduled {getattr(self.func, '__name__', self.func)} {self.trigger}>"
+
+    def fire_times(self, start: datetime, end: datetime) -> Deque[datetime]:
+        """`start` 之后, `end` 之前 (含) 的计划时间, 只保留最近的 `MAX_CATCH_UP` 个"""
+        fire_times: Deque[datetime] = deque(maxlen=MAX_CATCH_UP)
+        # The first call has no previous fire time, so that `interval` stays aligned to its `start_date`;
+        # `date` returns its run date regardless of `now`, hence the check against `start`
+        fire = self.trigger.get_next_fire_time(None, start + timedelta(microseconds=1))
+        while fire and fire <= end:
+            if fire > start:
+                fire_times.append(fire)
+            fire = self.trigger.get_next_fire_time(fire, fire + timedelta(microseconds=1))
+        return fire_times
+
+
+async def _targets(service: 'Service') -> Dict[int, Bot]:
+    """启用了服务的群, 每个群只由一个 Bot 推送"""
+    targets: Dict[int, Bot] = {}
+    for bot in get_bots().values():
+        try:
+            groups = await bot.get_group_list()
+        except (ActionFailed, NetworkError) as e:
+            logger.warning(f"Failed to get group list of {bot.self_id}: {e!r}")
+            continue
+        for group in groups:
+            group_id = group["group_id"]
+            if group_id not in targets and service_switch.is_enabled(str(group_id), service.index):
+                targets[group_id] = bot
+    return targets
+
+
+async def run(service: 'Service', run_at: float):
+    """执行一次推送, 计划时间为 `run_at`"""
+    job: Scheduled = service.Trigger
+    if not await ServiceDatabase.claim_run(service.name, run_at):
+        return  # Done by another worker, or already caught up
+    started = time.perf_counter()
+    targets = await _targets(service)
+    semaphore = asyncio.Semaphore(job.concurrency)
+    message = None if job.per_group else await job.func()
+    results: List[Dict[str, Any]] = []
+
+    async def push(group_id: int, bot: Bot):
+        async with semaphore:
+            result = {"group_id": group_id, "self_id": bot.self_id, "ok": False, "error": None}
+            try:
+                content = await job.func(bot, group_id) if job.per_group else message
+                if content is None:
+                    return
+                for attempt in range(job.retries + 1):
+                    await asyncio.sleep(random.uniform(0, job.jitter) + (2 ** attempt - 1 if attempt else 0))
+                    try:
+                        await bot.send_group_msg(group_id=group_id, message=content)
+                        result["ok"] = True
+                        break
+                    except (ActionFailed, NetworkError) as e:
+                        result["error"] = repr(e)
+            except Exception as e:
+                result["error"] = repr(e)
+                logger.opt(exception=e).warning(f"Scheduled {service.name} failed for group {group_id}")
+            results.append(result)
+
+    if job.per_group or message is not None:
+        await asyncio.gather(*(push(group_id, bot) for group_id, bot in targets.items()))
+    await ServiceDatabase.record_run(service.name, run_at, results,
+                                     timedelta(days=config.service_job_retention_days))
+    failed = sum(not result["ok"] for result in results)
+    logger.info(f"Scheduled {service.name}: sent to {len(results) - failed} groups, {failed} failed, "
+                f"{time.perf_counter() - started:.1f}s")
+
+
+async def _run_job(service: 'Service'):
+    # Stamped with the scheduled time rather than the current time, so that every worker claims the same run
+    now = datetime.now(timezone.utc)
+    if not (fire_times := service.Trigger.fire_times(now - LOOKBACK, now)):
+        logger.warning(f"Scheduled {service.name} started more than {LOOKBACK} late, skipped")
+        return
+    try:
+        await run(service, fire_times[-1].timestamp())
+    except Exception as e:
+        logger.opt(exception=e).error(f"Scheduled {service.name} failed")
+
+
+_tasks: Set[asyncio.Task] = set()
+
+
+async def start(services: List['Service']):
+    """注册定时任务, 并在后台补上错过的运行"""
+    if not services:
+        return
+    last_runs = await ServiceDatabase.load_last_runs(service.name for service in services)
+    now = datetime.now(timezone.utc)
+    for service in services:
+        job: Scheduled = service.Trigger
+        if (fire := job.trigger.get_next_fire_time(None, now)) and fire >= now:  # Past `date` runs are caught up
+            scheduler.add_job(_run_job, job.trigger, args=(service,), id=service.name,
+                              replace_existing=True, coalesce=True, misfire_grace_time=None)
+        if job.catch_up == 'none':
+            continue
+        if service.name in last_runs:
+            last_run = datetime.fromtimestamp(last_runs[service.name], timezone.utc)
+        elif isinstance(job.trigger, DateTrigger):  # Never ran, so its run date is missed if it has passed
+            last_run = datetime.fromtimestamp(0, timezone.utc)
+        else:
+            continue
+        missed = list(job.fire_times(last_run, now))
+        if job.catch_up == 'once':
+            missed = missed[-1:]
+        if missed:
+            logger.info(f"Scheduled {service.name} missed {len(missed)} run(s), catching up")
+            task = asyncio.create_task(_catch_up(service, [fire.timestamp() for fire in missed]))
+            _tasks.add(task)
+            task.add_done_callback(_tasks.discard)
+
+
+async def _catch_up(service: 'Service', run_ats: List[float]):
+    for run_at in run_ats:
+        try:
+            await run(service, run_at)
+        except Exception as e:
+            logger.opt(exception=e).error(f"Scheduled {service.name} failed to catch up {run_at}")
+
+
+__all__ = ["Scheduled", "start", "run"]
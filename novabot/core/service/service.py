@@ -1,13 +1,14 @@
 import asyncio
-import inspect
+import sys
 from contextlib import AsyncExitStack
 from datetime import datetime
-from typing import Dict, Optional, Type, Union, List, Literal, Tuple
+from typing import Dict, Optional, Type, Union, List, Literal, Set, AsyncIterator
 from collections import defaultdict
-from nonebot import get_driver, get_loaded_plugins, get_bot
-from nonebot.params import DependParam
+from types import FrameType
+from nonebot import get_driver, get_plugin
+from nonebot.plugin import Plugin
+from nonebot.params import Depends
 from nonebot.rule import Rule
-from nonebot.message import run_preprocessor
 from nonebot.log import logger
 from nonebot.matcher import Matcher
 from nonebot.adapters.onebot.v11 import (
@@ -15,14 +16,24 @@ from nonebot.adapters.onebot.v11 import (
     MessageEvent,
     NotifyEvent,
     GroupMessageEvent,
-    Bot,
-    Message)
-from nonebot.typing import T_State, T_DependencyCache
+    Bot)
+from nonebot.typing import T_State
 
 from novabot.core.types import TypeMessage
+from novabot.core.startup import timed
+from novabot.core import metrics
+from novabot.core.cluster import get_bot
+from novabot.core.sender import compile_prompt, send_prompt
 
-from .model import BundleModel, InfoModel, PluginModel
+from .model import BundleModel, InfoModel, PluginModel, RateLimitModel
+from .limiter import ServiceLimiter
 from .database import ServiceDatabase
+from .store import throttle_store, config as store_config
+from .throttle import ThrottleResult, config as throttle_config
+from .role import get_role
+from .switch import service_switch
+from .schedule import Scheduled, start as start_scheduled
+from .catalog import catalog, matcher_commands
 
 driver = get_driver()
 
@@ -31,10 +42,29 @@ trigger_to_bundle_dict: Dict[int, Dict[Literal['bundle', 'plugin', 'service'],
                                        Union[BundleModel, PluginModel, 'Service']]] = defaultdict(Dict)
 ready_services: List['Service'] = []
 
+rule_seconds = metrics.Histogram("novabot_service_rule_seconds",
+                                 "Service rule checks, including the matcher's own rules and throttling",
+                                 ["service"])
+rejections = metrics.Counter("novabot_service_rejections_total",
+                             "Events rejected by throttling", ["service", "reason"])
+
+
+def _resolve_plugin(frame: Optional[FrameType]) -> Optional[Plugin]:
+    """由调用者所在的模块找到其所属的插件, 只查看调用栈上各帧的模块名, 不读取源码"""
+    while frame:
+        module_name = frame.f_globals.get('__name__', '')
+        while module_name:  # A submodule of a plugin belongs to the plugin as well
+            plugin = get_plugin(module_name.rpartition('.')[2])
+            if plugin and plugin.module_name == module_name:
+                return plugin
+            module_name = module_name.rpartition('.')[0]
+        frame = frame.f_back
+    return None
+
 
 class Service:
     def __init__(self,
-                 Trigger: Union[Type[Matcher]],  # To-Do: Add Scheduler Trigger
+                 Trigger: Union[Type[Matcher], Scheduled],
                  bundle: Optional[str] = '_default',
                  *,
                  enable_on_default: Optional[bool] = True,
@@ -42,80 +72,98 @@ class Service:
                  limit: Optional[int] = 0,
                  cd_prompt: Optional[TypeMessage] = "",
                  limit_prompt: Optional[TypeMessage] = "",
+                 rate_limits: Optional[List[Union[RateLimitModel, dict]]] = None,
+                 concurrency: Optional[int] = 0,
+                 rate_prompt: Optional[TypeMessage] = "",
                  independent: Optional[bool] = False,
                  independent_name: Optional[str] = None):
         """
 
-        :param Trigger:
+        :param Trigger: a matcher, or `Scheduled` for a job pushed to every enabled group
         :param bundle:
         :param enable_on_default:
         :param cd:
         :param limit:
         :param cd_prompt: {cd} is the cooldown format.
         :param limit_prompt:
+        :param rate_limits: token bucket / sliding window rules, see `RateLimitModel`
+        :param concurrency: max handlers of this service running at the same time, 0 for unlimited
+        :param rate_prompt: {retry} is the seconds until rate limits allow.
         :param independent:
         :param independent_name:
         """
-        frame = map(lambda x: inspect.getmodule(x[0]), filter(lambda x: x.code_context, inspect.stack()[1:]))
-        plugins = get_loaded_plugins()
-        plugin = None
-        for i in frame:
-            plugin = next(filter(lambda x: x.module == i, plugins), None)
-            if plugin is not None:
-                break
+        plugin = _resolve_plugin(sys._getframe(1))
         self.Trigger = Trigger
         self.bundle = bundle
         self.plugin = plugin
         self.data = InfoModel(**locals())
+        self.prompts = {"cd": compile_prompt(self.data.cd_prompt),
+                        "limit": compile_prompt(self.data.limit_prompt),
+                        "rate": compile_prompt(self.data.rate_prompt)}
+        self.limiter = ServiceLimiter(self.data.rate_limits or [], self.data.concurrency or 0) \
+            if self.data.rate_limits or self.data.concurrency else None
         self.independent = independent
         self.independent_name = independent_name
         if independent and not independent_name:
             raise ValueError("You must set independent_name when independent is True")
         self.name = f"{self.plugin.name}.{self.bundle}{f'.{self.independent_name}' if self.independent else ''}"
+        self.commands = matcher_commands(Trigger) if isinstance(Trigger, type(Matcher)) else []
+        self.index = service_switch.register(self)
         ready_services.append(self)
         _rule_handler(self)
 
-    async def check_cd(self, event: Event) -> Tuple[bool, Optional[float]]:
-        if await self.admin_check(event) or not self.data.cd:
-            return True, None
-        db = ServiceDatabase(self.name)
-        cd = db.cd(str(event.user_id), str(event.group_id) if hasattr(event, 'group_id') else '0')
-        return datetime.now().timestamp() >= cd, cd - datetime.now().timestamp()
-
-    def update_cd(self, event: Event):
-        db = ServiceDatabase(self.name)
-        db.update_cd(str(event.user_id), str(event.group_id) if hasattr(event, 'group_id') else '0',
-                     datetime.now().timestamp() + self.data.cd)
-
-    async def check_limit(self, event: Event) -> Tuple[bool, Optional[float]]:
-        if await self.admin_check(event) or not self.data.limit:
-            return True, None
-        db = ServiceDatabase(self.name)
-        limit, date = db.limit(str(event.user_id), str(event.group_id) if hasattr(event, 'group_id') else '0')
-        delta = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0) - \
-                datetime.fromtimestamp(date).replace(hour=0, minute=0, second=0, microsecond=0)
-        if delta.days > 0:
-            return True, None
-        return self.data.limit > limit, self.data.limit - limit
-
-    def update_limit(self, event: Event):
-        db = ServiceDatabase(self.name)
-        db.update_limit(str(event.user_id), str(event.group_id) if hasattr(event, 'group_id') else '0')
+    async def throttle(self, event: Event, stack: Optional[AsyncExitStack] = None) -> ThrottleResult:
+        """
+        单次判定并更新限流器, cd 与 limit
+        - 限流器的判定与记录之间没有 await, 记录后 cd / limit 拒绝时撤销记录; 占用的并发位置在 `stack` 关闭时释放
+        - 限流器拒绝时不会写入 cd 与 limit
+        - 管理员不受限流器, cd 与 limit 限制也不计数
+        """
+        if not (self.data.cd or self.data.limit or self.limiter):
+            return ThrottleResult(True)
+        if await self.admin_check(event):
+            return ThrottleResult(True)
+        user_id, group_id = str(getattr(event, 'user_id', None) or 0), str(getattr(event, 'group_id', None) or 0)
+        now = datetime.now().timestamp()
+        reservation = None
+        if self.limiter:
+            if (retry := self.limiter.check(user_id, group_id, now)) is not None:
+                return ThrottleResult(False, retry=retry)
+            reservation = self.limiter.reserve(user_id, group_id, now, stack)
+        try:
+            if not (self.data.cd or self.data.limit):
+                result = ThrottleResult(True)
+            elif throttle_config.service_throttle_backend == 'mongo':
+                result = await ServiceDatabase.acquire(self.name, user_id, group_id,
+                                                       cd=self.data.cd, limit=self.data.limit, now=now)
+            else:
+                result = throttle_store.acquire(self.name, user_id, group_id,
+                                                cd=self.data.cd, limit=self.data.limit, now=now)
+        except BaseException:
+            if reservation:
+                reservation.cancel()
+            raise
+        if not result.available and reservation:
+            reservation.cancel()
+        return result
 
     @staticmethod
     async def admin_check(event: Event) -> bool:
         if not isinstance(event, (MessageEvent, NotifyEvent)):  # To-Do: add more event types
             return True
         if isinstance(event, NotifyEvent):
-            role = await get_bot(str(event.self_id)).call_api("get_group_member_info",
-                                                              group_id=event.group_id,
-                                                              user_id=event.user_id)
-            if role in ['admin', 'owner']:
+            if getattr(event, 'group_id', None) and \
+                    await get_role(get_bot(str(event.self_id)), event.group_id, event.user_id) in ['admin', 'owner']:
                 return True
         elif isinstance(event, GroupMessageEvent) and event.sender.role in ['admin', 'owner']:
             return True
         return False
 
+    def is_enabled(self, event: Event) -> bool:
+        """服务在事件所在的群是否启用, 私聊等非群事件总是启用"""
+        group_id = getattr(event, 'group_id', None)
+        return not group_id or service_switch.is_enabled(str(group_id), self.index)
+
     def __repr__(self):
         return f"<service of {self.plugin.name}, " \
                f"bundle={self.bundle}, Trigger={self.Trigger}, " \
@@ -125,30 +173,105 @@ class Service:
         return self.__repr__()
 
 
+def find_services(keyword: str) -> List[Service]:
+    """
+    按名称查找服务, `keyword` 可以是
+    - 插件名 (或其 `metadata.name`): 插件的所有服务
+    - `插件名.组名`: 整个组的服务
+    - 服务的完整名称
+    """
+    found = []
+    for service in ready_services:
+        plugin_names = {service.plugin.name}
+        if service.plugin.metadata:
+            plugin_names.add(service.plugin.metadata.name)
+        if keyword == service.name or keyword in plugin_names or \
+                any(keyword == f"{name}.{service.bundle}" for name in plugin_names):
+            found.append(service)
+    return found
+
+
+_prepare_task: Optional[asyncio.Task] = None
+
+
+async def _prepare_database(names: Set[str]):
+    """
+    在后台创建索引并迁移旧数据, 失败时每 `SERVICE_DB_RETRY_INTERVAL` 秒重试;
+    内存中的状态已经恢复, 迁移出的记录再补充进去 (不会覆盖内存中的记录)
+    """
+    while True:
+        try:
+            await ServiceDatabase.create_indexes()
+            if await ServiceDatabase.migrate():
+                await throttle_store.load(names)
+            return
+        except Exception as e:
+            logger.opt(exception=e).warning(f"Failed to create service indexes or migrate, "
+                                            f"retrying in {store_config.service_db_retry_interval}s")
+            await asyncio.sleep(store_config.service_db_retry_interval)
+
+
 @driver.on_startup
 async def _():
+    global _prepare_task
+    names = {service.name for service in ready_services}
+    if throttle_config.service_throttle_backend == 'memory':
+        # Restored before anything else touches the database, so a failing database falls back to the snapshot
+        with timed("startup", "throttle preload"):
+            await throttle_store.start(names)
+        _prepare_task = asyncio.create_task(_prepare_database(names))
+    else:  # Conditional upserts rely on the unique index
+        with timed("startup", "service indexes"):
+            await ServiceDatabase.create_indexes()
+        with timed("startup", "service migration"):
+            await ServiceDatabase.migrate()
     for service in ready_services:
-        name = service.plugin.metadata.name if service.plugin.metadata else service.plugin.name
-        if not services_dict.get(name):
-            services_dict[name] = PluginModel(plugin_name=name)
-        if not services_dict[name].bundles.get(service.bundle):
-            services_dict[name].bundles[service.bundle] = BundleModel()
-        bundles = services_dict[name].bundles[service.bundle]
-        bundles.services.append(service)
-        bundles.parse_obj(service.data)
-        trigger_to_bundle_dict[id(service.Trigger)] = {
-            "bundle": bundles,
-            "plugin": services_dict[name],
-            "service": service
-        }
+        with timed("services", service.plugin.name):
+            name = service.plugin.metadata.name if service.plugin.metadata else service.plugin.name
+            if not services_dict.get(name):
+                services_dict[name] = PluginModel(plugin_name=name)
+            if not services_dict[name].bundles.get(service.bundle):
+                services_dict[name].bundles[service.bundle] = BundleModel()
+            bundles = services_dict[name].bundles[service.bundle]
+            bundles.services.append(service)
+            bundles.parse_obj(service.data)
+            trigger_to_bundle_dict[id(service.Trigger)] = {
+                "bundle": bundles,
+                "plugin": services_dict[name],
+                "service": service
+            }
         logger.opt(colors=True).success(f'<y>{service}</y> loaded.')
+    with timed("startup", "service switches"):
+        await service_switch.load()
+    with timed("startup", "limiter restore"):
+        limiters = {service.name: service.limiter for service in ready_services if service.limiter}
+        for name, states in (await ServiceDatabase.load_limiters(limiters)).items():
+            limiters[name].restore(states)
+    with timed("startup", "service catalog"):
+        catalog.build(ready_services)
+        catalog.prerender(service_switch.default_mask)
+    with timed("startup", "scheduled services"):
+        await start_scheduled([service for service in ready_services if isinstance(service.Trigger, Scheduled)])
 
 
-@run_preprocessor
-async def _(matcher: Matcher):
-    matcher_dict = trigger_to_bundle_dict.get(id(type(matcher)), None)
-    if not matcher_dict:
-        return
+@driver.on_shutdown
+async def _():
+    if _prepare_task:
+        _prepare_task.cancel()
+    await throttle_store.stop()
+    await service_switch.flush()
+    now = datetime.now().timestamp()
+    await ServiceDatabase.save_limiters({service.name: service.limiter.dump(now) for service in ready_services
+                                         if service.limiter and any(rule.persist for rule in service.data.rate_limits or [])})
+
+
+async def _event_scope() -> AsyncIterator[AsyncExitStack]:
+    """
+    在事件处理结束时关闭的 `AsyncExitStack`, 用于释放服务占用的并发位置
+    规则的参数中 `AsyncExitStack` 不会被注入, 只能由生成器依赖进入 nonebot 为每个事件创建的 stack
+    """
+    async with AsyncExitStack() as stack:
+        yield stack
 
 
 def _rule_handler(service: Service) -> None:
@@ -158,32 +281,25 @@ def _rule_handler(service: Service) -> None:
     async def _rule(bot: Bot,
                     event: Event,
                     state: T_State,
-                    stack: Optional[AsyncExitStack] = None) -> bool:
-        return await _cd_rule(bot, event) and await _limit_rule(bot, event) \
-            if await _rules(bot=bot, event=event, state=state, stack=stack) else False
-
-    async def _cd_rule(bot: Bot,
-                       event: Event) -> bool:
-        available, cd = await service.check_cd(event)
-        if available:
-            service.update_cd(event)
-        elif service.data.cd_prompt:
-            msg = Message.template(Message(service.data.cd_prompt)).format(cd=cd,
-                                                                           user=event.user_id or 0) or ''
-            await bot.send(event, msg)
-        return available
-
-    async def _limit_rule(bot: Bot,
-                          event: Event) -> bool:
-        available, limit = await service.check_limit(event)
-        if available:
-            service.update_limit(event)
-        elif service.data.limit_prompt:
-            msg = Message.template(Message(service.data.limit_prompt)).format(limit=limit,
-                                                                              user=event.user_id or 0) or ''
-            await bot.send(event, msg)
-        return available
+                    stack: AsyncExitStack = Depends(_event_scope)) -> bool:
+        # Checked before any other rule, so disabled services neither throttle nor prompt
+        if not service.is_enabled(event) or not await _rules(bot=bot, event=event, state=state, stack=stack):
+            return False
+        result = await service.throttle(event, stack=stack)
+        if result.available:
+            return True
+        if result.retry is not None:
+            reason, kwargs = "rate", {"retry": result.retry}
+        elif result.cd is not None:
+            reason, kwargs = "cd", {"cd": result.cd}
+        else:
+            reason, kwargs = "limit", {"limit": result.limit}
+        if metrics.enabled:
+            rejections.inc(service.name, reason)
+        # Sent in the background at low priority, once per user and reason within the dedup window
+        send_prompt(bot, event, service.prompts[reason], (service.name, reason), **kwargs)
+        return False
 
     _matcher = service.Trigger
     _rules = Rule(*_matcher.rule.checkers)
-    _matcher.rule = Rule(_rule)
+    _matcher.rule = Rule(metrics.timed(rule_seconds, service.name)(_rule))
@@ -0,0 +1,200 @@
+"""
+进程内的 cd / limit 状态缓存
+
+检查与更新只读写内存, 被修改过的记录会被标记为脏数据, 由定时任务以及关闭时的 `flush` 批量写回数据库
+- 启动时以一次查询读取所有服务的未过期记录, 键中的服务名, 群号与 QQ 号都是驻留的字符串, 相同的值只保存一份
+- 每 `SERVICE_COMPACT_INTERVAL` 秒丢弃 cd 已结束且 limit 计数已不属于今天的记录
+- 设置了 `SERVICE_SNAPSHOT_PATH` 时, 压缩后与关闭时把所有记录写入本地快照:
+  启动时数据库不可用则从快照恢复, 快照中尚未写回数据库的记录总会被恢复并在之后写回
+- 使用此后端时, 状态先于索引的创建与旧数据的迁移恢复, 两者失败时每 `SERVICE_DB_RETRY_INTERVAL` 秒在后台重试
+"""
+
+import asyncio
+import json
+import sys
+import time
+from pathlib import Path
+from typing import Dict, Set, Iterable, Optional, Any, List, Tuple
+
+from nonebot import get_driver
+from nonebot.log import logger
+from pydantic import BaseModel, Extra
+
+from novabot.core import metrics
+
+from .database import ServiceDatabase, Key, expire_at
+from .throttle import ThrottleResult, evaluate, day_start
+
+
+class Config(BaseModel, extra=Extra.ignore):
+    service_flush_interval: float = 10
+    service_compact_interval: float = 3600
+    service_snapshot_path: Optional[Path] = None
+    service_db_retry_interval: float = 60
+
+
+config = Config.parse_obj(get_driver().config)
+
+
+class ThrottleRecord:
+    __slots__ = ('cd', 'limit', 'date')
+
+    def __init__(self, cd: float = 0, limit: int = 0, date: float = 0):
+        self.cd = cd
+        self.limit = limit
+        self.date = date
+
+
+def _key(name: str, group_id: str, user_id: str) -> Key:
+    return sys.intern(name), sys.intern(group_id), sys.intern(user_id)
+
+
+class ThrottleStore:
+    def __init__(self,
+                 flush_interval: float = 10,
+                 compact_interval: float = 3600,
+                 snapshot_path: Optional[Path] = None):
+        self.flush_interval = flush_interval
+        self.compact_interval = compact_interval
+        self.snapshot_path = snapshot_path
+        self._records: Dict[Key, ThrottleRecord] = {}
+        self._dirty: Set[Key] = set()
+        self._task: Optional[asyncio.Task] = None
+
+    def acquire(self, name: str, user_id: str, group_id: str, *, cd: int, limit: int, now: float) -> ThrottleResult:
+        """单次判定 cd 与 limit, 两者都满足时写入新的 cd 与计数"""
+        key = (name, group_id, user_id)
+        record = self._records.get(key) or ThrottleRecord()
+        result = evaluate(record.cd, record.limit, record.date, cd=cd, limit=limit, now=now)
+        if not result.available:
+            return result
+        if cd:
+            record.cd = now + cd
+        if limit:
+            record.limit = limit - result.limit
+            record.date = now
+        if key not in self._records:
+            key = _key(*key)
+            self._records[key] = record
+        self._dirty.add(key)
+        return result
+
+    async def load(self, names: Iterable[str]):
+        """从数据库读取服务的全部记录, 已在内存中的记录不会被覆盖"""
+        for data in await ServiceDatabase.load_many(names):
+            self._records.setdefault(_key(data.service, data.group_id, data.user_id),
+                                     ThrottleRecord(data.cd, data.limit, data.date))
+
+    def compact(self, now: float) -> int:
+        """丢弃已经不再影响判定的记录, 未写回的记录会保留到写回之后, 返回丢弃的数量"""
+        today = day_start(now)
+        expired = [key for key, record in self._records.items()
+                   if record.cd <= now and record.date < today and key not in self._dirty]
+        for key in expired:
+            del self._records[key]
+        return len(expired)
+
+    def _dump(self) -> Dict[str, Any]:
+        return {"saved_at": time.time(),
+                "records": [[*key, record.cd, record.limit, record.date, key in self._dirty]
+                            for key, record in self._records.items()]}
+
+    def _write_snapshot(self, data: Dict[str, Any]):
+        self.snapshot_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.snapshot_path.with_name(f".{self.snapshot_path.name}.tmp")
+        tmp.write_text(json.dumps(data, separators=(',', ':')), encoding="utf-8")
+        tmp.replace(self.snapshot_path)
+
+    def _read_snapshot(self) -> List[Tuple[str, str, str, float, int, float, bool]]:
+        try:
+            return json.loads(self.snapshot_path.read_text(encoding="utf-8"))["records"]
+        except FileNotFoundError:
+            return []
+
+    async def snapshot(self):
+        if not self.snapshot_path:
+            return
+        try:
+            await asyncio.to_thread(self._write_snapshot, self._dump())
+        except Exception as e:
+            logger.opt(exception=e).error("Failed to write service throttle snapshot")
+
+    async def restore(self, names: Iterable[str]):
+        """
+        读取数据库中的记录, 并以快照补充:
+        快照中未写回的记录覆盖数据库中的记录; 数据库不可用时使用快照中的全部记录
+        """
+        names = set(names)
+        records = []
+        if self.snapshot_path:
+            try:
+                records = [record for record in await asyncio.to_thread(self._read_snapshot) if record[0] in names]
+            except Exception as e:
+                logger.opt(exception=e).warning("Failed to read service throttle snapshot, ignored")
+        for name, group_id, user_id, cd, limit, date, dirty in records:
+            if dirty:
+                key = _key(name, group_id, user_id)
+                self._records[key] = ThrottleRecord(cd, limit, date)
+                self._dirty.add(key)
+        try:
+            await self.load(names)
+        except Exception:
+            if not records:
+                raise
+            logger.opt(exception=True).warning("Failed to load service throttle state, restored from the snapshot")
+            for name, group_id, user_id, cd, limit, date, _ in records:
+                self._records.setdefault(_key(name, group_id, user_id), ThrottleRecord(cd, limit, date))
+        self.compact(time.time())
+
+    def _collect(self, dirty: Set[Key]) -> Dict[Key, Dict[str, Any]]:
+        updates: Dict[Key, Dict[str, Any]] = {}
+        for key in dirty:
+            record = self._records[key]
+            updates[key] = {"cd": record.cd,
+                            "limit": record.limit,
+                            "date": record.date,
+                            "expire_at": expire_at(record.cd, record.date)}
+        return updates
+
+    async def flush(self):
+        if not self._dirty:
+            return
+        dirty, self._dirty = self._dirty, set()
+        try:
+            await ServiceDatabase.bulk_set(self._collect(dirty))
+        except Exception as e:
+            self._dirty |= dirty  # Retry on next flush
+            logger.opt(exception=e).error("Failed to flush service throttle state")
+
+    async def _flush_loop(self):
+        compacted = time.monotonic()
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+            if time.monotonic() - compacted >= self.compact_interval:
+                compacted = time.monotonic()
+                if count := self.compact(time.time()):
+                    logger.debug(f"Dropped {count} expired service throttle records")
+                await self.snapshot()
+
+    async def start(self, names: Iterable[str]):
+        await self.restore(names)
+        if not self._task:
+            self._task = asyncio.create_task(self._flush_loop())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        await self.flush()
+        await self.snapshot()
+
+
+throttle_store = ThrottleStore(config.service_flush_interval,
+                              config.service_compact_interval,
+                              config.service_snapshot_path)
+
+metrics.Gauge("novabot_throttle_records", "Cached cd / limit records by state", ["state"],
+              collect=lambda: {("cached",): len(throttle_store._records), ("dirty",): len(throttle_store._dirty)})
+
+__all__ = ["ThrottleStore", "ThrottleRecord", "throttle_store"]
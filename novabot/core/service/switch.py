@@ -0,0 +1,100 @@
+"""
+服务在各群的启用状态
+
+每个服务注册时获得一个整数下标, 每个群的启用状态是一个以下标为位的整数, 未设置过的群使用 `default_mask`
+(由 `enable_on_default` 决定), 因此每条消息的判定都是 O(1) 的, 不会访问数据库.
+状态以服务名的形式保存, 启动时一次性读取, 修改后在后台批量写回, 集群模式下同时广播给其他 worker.
+"""
+
+import asyncio
+from typing import Dict, List, Set, Iterable, Optional, Tuple, TYPE_CHECKING
+
+from nonebot.log import logger
+
+from novabot.core import cluster
+
+from .database import ServiceDatabase
+
+if TYPE_CHECKING:
+    from .service import Service
+
+
+class ServiceSwitch:
+    def __init__(self, flush_delay: float = 1):
+        self.flush_delay = flush_delay
+        self.services: List['Service'] = []
+        self.default_mask = 0
+        self._indexes: Dict[str, int] = {}  # service name: bits of all services with this name
+        self._masks: Dict[str, int] = {}  # group_id: mask
+        self._dirty: Set[str] = set()
+        self._task: Optional[asyncio.Task] = None
+
+    def register(self, service: 'Service') -> int:
+        index = len(self.services)
+        self.services.append(service)
+        self._indexes[service.name] = self._indexes.get(service.name, 0) | 1 << index
+        if service.data.enable_on_default:
+            self.default_mask |= 1 << index
+        return index
+
+    def mask(self, group_id: str) -> int:
+        return self._masks.get(group_id, self.default_mask)
+
+    def is_enabled(self, group_id: str, index: int) -> bool:
+        return bool(self._masks.get(group_id, self.default_mask) >> index & 1)
+
+    def set_enabled(self, group_id: str, services: Iterable['Service'], enabled: bool):
+        """在内存中修改群内服务的启用状态, 并在后台写回数据库"""
+        bits = 0
+        for service in services:
+            bits |= self._indexes[service.name]
+        mask = self.mask(group_id)
+        self._masks[group_id] = mask | bits if enabled else mask & ~bits
+        self._dirty.add(group_id)
+        if not self._task or self._task.done():
+            self._task = asyncio.create_task(self._delayed_flush())
+        if cluster.config.cluster_enabled:
+            asyncio.create_task(cluster.broadcast("service_switch", {group_id: self._names(group_id)}))
+
+    def _names(self, group_id: str) -> Tuple[List[str], List[str]]:
+        """与默认状态不同的服务名: (启用的, 禁用的)"""
+        diff = self.mask(group_id) ^ self.default_mask
+        enabled, disabled = [], []
+        for name, bits in self._indexes.items():
+            if diff & bits:
+                (enabled if self.mask(group_id) & bits else disabled).append(name)
+        return enabled, disabled
+
+    def apply(self, switches: Dict[str, Tuple[Iterable[str], Iterable[str]]]):
+        """以 {group_id: (启用的服务名, 禁用的服务名)} 覆盖群的启用状态"""
+        for group_id, (enabled, disabled) in switches.items():
+            mask = self.default_mask
+            for name in enabled:
+                mask |= self._indexes.get(name, 0)
+            for name in disabled:
+                mask &= ~self._indexes.get(name, 0)
+            self._masks[group_id] = mask
+
+    async def load(self):
+        self.apply(await ServiceDatabase.load_switches())
+
+    async def _delayed_flush(self):
+        await asyncio.sleep(self.flush_delay)  # Coalesce toggles of a burst of admin commands
+        await self.flush()
+
+    async def flush(self):
+        if not self._dirty:
+            return
+        dirty, self._dirty = self._dirty, set()
+        try:
+            await ServiceDatabase.save_switches({group_id: self._names(group_id) for group_id in dirty})
+        except Exception as e:
+            self._dirty |= dirty
+            logger.opt(exception=e).error("Failed to save service switches")
+
+
+service_switch = ServiceSwitch()
+
+cluster.subscribe("service_switch")(service_switch.apply)  # Written back by the worker that changed it
+
+__all__ = ["ServiceSwitch", "service_switch"]
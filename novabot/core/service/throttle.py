@@ -0,0 +1,61 @@
+"""
+cd 与 limit 的单次判定
+
+cd 与 limit 在同一次判定中完成, 只有两者同时满足时才会写入新的 cd 与 limit 计数
+- `memory`: 由进程内的 `ThrottleStore` 判定并写入, 定时批量写回数据库
+- `mongo`: 每次判定为一次带条件的 `find_one_and_update`, 适合多个进程共享同一份状态, 集群模式下总是使用此后端
+"""
+
+from datetime import datetime
+from typing import NamedTuple, Optional, Literal
+
+from nonebot import get_driver
+from nonebot.log import logger
+from pydantic import BaseModel, Extra
+
+from novabot.core.cluster import config as cluster_config
+
+
+class Config(BaseModel, extra=Extra.ignore):
+    service_throttle_backend: Literal['memory', 'mongo'] = 'memory'
+
+
+config = Config.parse_obj(get_driver().config)
+
+if cluster_config.cluster_enabled and config.service_throttle_backend == 'memory':
+    logger.warning("The memory throttle backend is per process, using mongo since cluster mode is enabled")
+    config.service_throttle_backend = 'mongo'
+
+
+class ThrottleResult(NamedTuple):
+    available: bool
+    cd: Optional[float] = None  # remaining cooldown seconds, only set when rejected by cd
+    limit: Optional[int] = None  # remaining times of today, `None` if the service has no limit
+    retry: Optional[float] = None  # seconds until rate limits allow, only set when rejected by them
+
+
+def day_start(now: float) -> float:
+    return datetime.fromtimestamp(now).replace(hour=0, minute=0, second=0, microsecond=0).timestamp()
+
+
+def evaluate(cd_until: float, used: int, date: float, *, cd: int, limit: int, now: float) -> ThrottleResult:
+    """
+    根据记录判定是否可用, 不做任何写入
+    :param cd_until: 记录中的 cd 结束时间戳
+    :param used: 记录中的 limit 计数
+    :param date: 记录中最后一次计数的时间戳, 早于今天时计数视为 0
+    :param cd: 服务的 cd
+    :param limit: 服务的每日次数限制
+    :param now: 当前时间戳
+    """
+    if date < day_start(now):
+        used = 0
+    remaining = limit - used if limit else None
+    if cd and cd_until > now:
+        return ThrottleResult(False, cd_until - now, remaining)
+    if limit and used >= limit:
+        return ThrottleResult(False, None, remaining)
+    return ThrottleResult(True, None, remaining - 1 if limit else None)
+
+
+__all__ = ["ThrottleResult", "day_start", "evaluate", "config"]
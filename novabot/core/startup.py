@@ -0,0 +1,68 @@
+"""
+启动耗时统计
+
+`timed(phase, name)` 记录一段代码的耗时, `report()` 按阶段汇总并输出到日志, 由 `bot.py` 在启动完成后调用
+`load_plugins_timed` 与 `nonebot.load_from_toml` 等价, 但会逐个加载插件以记录每个插件的耗时
+"""
+
+import pkgutil
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import List, Tuple, Iterator, Dict
+
+import nonebot
+from nonebot.log import logger
+from nonebot.utils import path_to_module_name
+
+try:
+    import tomllib
+except ModuleNotFoundError:  # Python < 3.11, `tomli` is a dependency of nonebot2
+    import tomli as tomllib
+
+timings: List[Tuple[str, str, float]] = []  # (phase, name, seconds)
+
+
+def record(phase: str, name: str, seconds: float):
+    timings.append((phase, name, seconds))
+
+
+@contextmanager
+def timed(phase: str, name: str) -> Iterator[None]:
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(phase, name, time.perf_counter() - start)
+
+
+def load_plugins_timed(file_path: str = "pyproject.toml"):
+    """按 `[tool.nonebot]` 中的 `plugins` 与 `plugin_dirs` 逐个加载插件"""
+    with open(file_path, "rb") as f:
+        data = tomllib.load(f).get("tool", {}).get("nonebot", {})
+    for plugin in data.get("plugins", []):
+        with timed("load", plugin):
+            nonebot.load_plugin(plugin)
+    for plugin_dir in data.get("plugin_dirs", []):
+        for module in pkgutil.iter_modules([plugin_dir]):
+            if module.name.startswith("_"):
+                continue
+            name = path_to_module_name(Path(plugin_dir) / module.name)  # Same module name as `nonebot.load_plugins`
+            with timed("load", name):
+                nonebot.load_plugin(name)
+
+
+def report():
+    phases: Dict[str, Dict[str, float]] = {}
+    for phase, name, seconds in timings:
+        names = phases.setdefault(phase, {})
+        names[name] = names.get(name, 0) + seconds
+    lines = [f"Startup finished in {sum(map(sum, map(dict.values, phases.values()))) * 1000:.1f} ms"]
+    for phase, names in phases.items():
+        lines.append(f"  [{phase}] {sum(names.values()) * 1000:.1f} ms")
+        for name, seconds in sorted(names.items(), key=lambda x: -x[1]):
+            lines.append(f"    {name}: {seconds * 1000:.1f} ms")
+    logger.info("\n".join(lines))
+
+
+__all__ = ["record", "timed", "load_plugins_timed", "report"]
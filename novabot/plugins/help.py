@@ -0,0 +1,40 @@
+from nonebot import on_command
+from nonebot.adapters.onebot.v11 import MessageEvent, GroupMessageEvent, Message, MessageSegment
+from nonebot.log import logger
+from nonebot.params import CommandArg
+from nonebot.plugin import PluginMetadata
+
+from novabot.core.service import catalog, service_switch
+from novabot.core.service.catalog import config as catalog_config
+
+__plugin_meta__ = PluginMetadata(
+    name='Help',
+    description='查看所有服务的帮助, 或按名称, 命令与用法查找服务',
+    usage=""".help
+.help <关键词>"""
+)
+
+help_ = on_command("帮助",
+                   aliases={".help"},
+                   priority=1,
+                   block=True)
+
+
+@help_.handle()
+async def _(event: MessageEvent, arg: Message = CommandArg()):
+    mask = service_switch.mask(str(event.group_id)) if isinstance(event, GroupMessageEvent) \
+        else service_switch.default_mask
+    if not (keyword := arg.extract_plain_text().strip()):
+        image = None
+        if catalog_config.help_image:
+            try:
+                image = await catalog.help_image(mask)
+            except Exception as e:  # Falls back to text when the browser is unavailable
+                logger.opt(exception=e).warning("Failed to render the help image")
+        await help_.finish(MessageSegment.image(image) if image else catalog.help_text(mask))
+    found = catalog.search(keyword)
+    if not found:
+        await help_.finish(f"没有找到与 {keyword} 相关的服务")
+    plugins = list(dict.fromkeys(entry.plugin for entry in found))
+    others = f"\n\n相关: {', '.join(plugins[1:])}" if len(plugins) > 1 else ""
+    await help_.finish(catalog.plugin_help(plugins[0], mask) + others)
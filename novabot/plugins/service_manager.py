@@ -0,0 +1,59 @@
+from nonebot import on_command
+from nonebot.adapters.onebot.v11 import GroupMessageEvent, Message, GROUP_ADMIN, GROUP_OWNER
+from nonebot.params import CommandArg
+from nonebot.permission import SUPERUSER
+from nonebot.plugin import PluginMetadata
+
+from novabot.core.service import find_services, service_switch
+from novabot.core.service.service import ready_services
+
+__plugin_meta__ = PluginMetadata(
+    name='ServiceManager',
+    description='在群内启用或禁用服务, 可以是整个插件, 整个组或单个服务',
+    usage=""".enable <插件名 | 插件名.组名 | 服务名>
+.disable <插件名 | 插件名.组名 | 服务名>
+.services"""
+)
+
+enable = on_command("启用",
+                    aliases={".enable"},
+                    permission=GROUP_ADMIN | GROUP_OWNER | SUPERUSER,
+                    priority=1,
+                    block=True)
+disable = on_command("禁用",
+                     aliases={".disable"},
+                     permission=GROUP_ADMIN | GROUP_OWNER | SUPERUSER,
+                     priority=1,
+                     block=True)
+services = on_command("服务列表",
+                      aliases={".services"},
+                      priority=1,
+                      block=True)
+
+
+@enable.handle()
+async def _(event: GroupMessageEvent, arg: Message = CommandArg()):
+    await _toggle(event, arg.extract_plain_text().strip(), True)
+
+
+@disable.handle()
+async def _(event: GroupMessageEvent, arg: Message = CommandArg()):
+    await _toggle(event, arg.extract_plain_text().strip(), False)
+
+
+async def _toggle(event: GroupMessageEvent, keyword: str, enabled: bool):
+    matcher = enable if enabled else disable
+    if not keyword:
+        await matcher.finish(__plugin_meta__.usage)
+    found = find_services(keyword)
+    if not found:
+        await matcher.finish(f"没有找到服务 {keyword}")
+    service_switch.set_enabled(str(event.group_id), found, enabled)
+    names = sorted({service.name for service in found})
+    await matcher.finish(f"已{'启用' if enabled else '禁用'} {len(names)} 个服务:\n" + "\n".join(names))
+
+
+@services.handle()
+async def _(event: GroupMessageEvent):
+    lines = sorted({f"{'√' if service.is_enabled(event) else '×'} {service.name}" for service in ready_services})
+    await services.finish("\n".join(lines) or "没有已加载的服务")
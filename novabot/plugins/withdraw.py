@@ -1,17 +1,45 @@
+import asyncio
+import time
+from typing import List, Tuple
+
 from nonebot import get_driver, on_command
-from nonebot.adapters.onebot.v11 import MessageEvent, Bot, ActionFailed
+from nonebot.adapters.onebot.v11 import (
+    MessageEvent,
+    GroupMessageEvent,
+    Bot,
+    Message,
+    ActionFailed,
+    NetworkError,
+    GROUP_ADMIN,
+    GROUP_OWNER)
+from nonebot.params import CommandArg
+from nonebot.permission import SUPERUSER
 from nonebot.plugin import PluginMetadata
 from nonebot.rule import Rule
+from pydantic import BaseModel, Extra
 
 from novabot import Service
+from novabot.core.history import message_history
+
+
+class Config(BaseModel, extra=Extra.ignore):
+    withdraw_concurrency: int = 3
+    withdraw_max: int = 50
+    withdraw_retries: int = 3
+
 
 config = get_driver().config
+withdraw_config = Config.parse_obj(config)
 __plugin_meta__ = PluginMetadata(
     name='Withdraw',
     description='通过回复BOT的发言并输入"撤回"即可撤回bot的发言，用于防止色图炸群刷屏等',
     usage=""".withdraw
 撤回
-撤"""
+撤
+以下仅限管理员:
+撤回 <N>: 撤回 bot 最近的 N 条消息
+撤回 之后: 回复一条消息, 撤回它及之后的所有消息
+撤回 @某人 / 撤回 <QQ>: 撤回某人最近的所有消息"""
 )
 
 
@@ -24,15 +52,107 @@ def _is_reply_to_me(event: MessageEvent):
                  str(event.sender.user_id) in config.superusers if config.superusers else False))
 
 
+def _is_bulk_arg(arg: Message) -> bool:
+    """
+    批量撤回的参数: 条数, 之后 / since, @某人或 QQ 号
+    命令前缀包含空字符串, "撤退了" 之类的普通聊天也会以 "撤" 的参数出现, 其他参数都不视为命令
+    """
+    text = arg.extract_plain_text().strip()
+    if any(segment.type == 'at' and segment.data["qq"] != "all" for segment in arg):
+        return not text
+    return text.isdigit() or text in ("之后", "since")
+
+
+async def _can_bulk_withdraw(bot: Bot, event: MessageEvent, arg: Message) -> bool:
+    return isinstance(event, GroupMessageEvent) and _is_bulk_arg(arg) and \
+        await (GROUP_ADMIN | GROUP_OWNER | SUPERUSER)(bot, event)
+
+
+async def _can_withdraw(bot: Bot, event: MessageEvent, arg: Message = CommandArg()):
+    return _is_reply_to_me(event) or await _can_bulk_withdraw(bot, event, arg)
+
+
 with_draw = on_command("撤回",
                        aliases={"撤", ".withdraw"},
-                       rule=Rule(_is_reply_to_me),
+                       rule=Rule(_can_withdraw),
                        priority=1,
                        block=True)
 
 
+def _rate_limited(e: Exception) -> bool:
+    """超时与 "操作频繁" 类错误值得重试, 其他错误 (消息过期, 没有权限等) 重试也不会成功"""
+    if isinstance(e, NetworkError):
+        return True
+    text = f"{e.info.get('msg', '')} {e.info.get('wording', '')}".lower() if isinstance(e, ActionFailed) else ''
+    return any(word in text for word in ("频繁", "frequen", "rate", "limit", "timeout"))
+
+
+async def withdraw_many(bot: Bot, message_ids: List[int]) -> Tuple[List[int], List[int]]:
+    """
+    并发撤回消息, 同时进行的请求不超过 `WITHDRAW_CONCURRENCY`, 遇到频率限制时所有请求一起退避后重试
+    :return: (撤回成功的, 撤回失败的)
+    """
+    semaphore = asyncio.Semaphore(withdraw_config.withdraw_concurrency)
+    pause_until = 0.0
+    deleted, failed = [], []
+
+    async def withdraw(message_id: int):
+        nonlocal pause_until
+        async with semaphore:
+            for attempt in range(withdraw_config.withdraw_retries + 1):
+                if (delay := pause_until - time.monotonic()) > 0:
+                    await asyncio.sleep(delay)
+                try:
+                    await bot.delete_msg(message_id=message_id)
+                    deleted.append(message_id)
+                    return
+                except (ActionFailed, NetworkError) as e:
+                    if not _rate_limited(e) or attempt == withdraw_config.withdraw_retries:
+                        break
+                    pause_until = max(pause_until, time.monotonic() + 0.5 * 2 ** attempt)
+            failed.append(message_id)
+
+    await asyncio.gather(*(withdraw(message_id) for message_id in message_ids))
+    return deleted, failed
+
+
+async def bulk_withdraw(bot: Bot, event: GroupMessageEvent, arg: Message):
+    history = message_history.group(bot.self_id, event.group_id)
+    text = arg.extract_plain_text().strip()
+    at = [int(segment.data["qq"]) for segment in arg if segment.type == 'at' and segment.data["qq"] != "all"]
+    if at or text.isdigit() and len(text) >= 5:  # QQ numbers have at least 5 digits
+        users = at or [int(text)]
+        message_ids = [message_id for user_id in users
+                       for message_id in history.last(withdraw_config.withdraw_max, user_id)]
+    elif text.isdigit():
+        message_ids = history.last(min(int(text), withdraw_config.withdraw_max), int(bot.self_id))
+    elif text in ("之后", "since"):
+        if not event.reply:
+            await with_draw.finish("请回复一条消息")
+        if (message_ids := history.since(event.reply.message_id)) is None:
+            await with_draw.finish("这条消息太早了, 没有记录")
+        message_ids = [message_id for message_id in message_ids if message_id != event.message_id]
+        message_ids = message_ids[:withdraw_config.withdraw_max]
+    else:
+        await with_draw.finish(__plugin_meta__.usage)
+    message_ids.append(event.message_id)  # Withdraw the triggering message as well
+    deleted, failed = await withdraw_many(bot, message_ids)
+    message_history.discard(bot.self_id, event.group_id, deleted)
+    count = len(deleted) - (event.message_id in deleted)
+    if failed and failed != [event.message_id]:
+        await with_draw.finish(f"已撤回 {count} 条消息, "
+                                   f"{len(failed) - (event.message_id in failed)} 条撤回失败 (超时或没有权限)")
+    elif not count:
+        await with_draw.finish("没有可以撤回的消息")
+
+
 @with_draw.handle()
-async def _(bot: Bot, event: MessageEvent):
+async def _(bot: Bot, event: MessageEvent, arg: Message = CommandArg()):
+    if await _can_bulk_withdraw(bot, event, arg):
+        await bulk_withdraw(bot, event, arg)
+        return
+    if not _is_reply_to_me(event):
+        return
     try:
         await bot.call_api("delete_msg", message_id=event.reply.message_id)
     except ActionFailed:  # Timed-out